@@ -0,0 +1,250 @@
+"""Minimal MQTT 3.1.1 broker running in the current process.
+
+A stand-in for a real broker in benchmarks: it accepts connections on the
+loopback interface, routes messages with QoS 0, 1 and 2 to matching
+subscriptions and keeps retained messages. It has no authentication, no
+persistent sessions and no MQTT 5 support.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import socket
+import socketserver
+import struct
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from flask_mqtt.router import topic_matches
+
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def _packet(command: int, body: bytes = b"") -> bytes:
+    # fixed header with the remaining length as variable byte integer
+    header = bytearray([command])
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def _string(data: bytes, pos: int) -> Tuple[bytes, int]:
+    (length,) = struct.unpack_from("!H", data, pos)
+    return data[pos + 2 : pos + 2 + length], pos + 2 + length
+
+
+class _Connection(socketserver.BaseRequestHandler):
+    server: "_Server"
+
+    def setup(self) -> None:
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.subscriptions: Dict[str, int] = {}
+        self._send_lock = threading.Lock()
+        self._mid = 0
+
+    def send(self, packet: bytes) -> None:
+        with self._send_lock:
+            try:
+                self.request.sendall(packet)
+            except OSError:
+                pass
+
+    def next_mid(self) -> int:
+        with self._send_lock:
+            self._mid = self._mid % 65535 + 1
+            return self._mid
+
+    def _read(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def handle(self) -> None:
+        broker = self.server.broker
+        broker._add(self)
+        try:
+            while True:
+                command = self._read(1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self._read(1)[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self._read(length) if length else b""
+                if not self._handle_packet(command, body):
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker._remove(self)
+
+    def _handle_packet(self, command: int, body: bytes) -> bool:
+        broker = self.server.broker
+        kind = command >> 4
+        if kind == PUBLISH:
+            qos = (command >> 1) & 0x03
+            topic, pos = _string(body, 0)
+            if qos:
+                mid = body[pos : pos + 2]
+                pos += 2
+                self.send(_packet(PUBACK << 4 if qos == 1 else PUBREC << 4, mid))
+            broker.publish(topic.decode("utf-8"), body[pos:], qos, bool(command & 0x01))
+        elif kind == PUBREL:
+            self.send(_packet(PUBCOMP << 4, body[:2]))
+        elif kind == PUBREC:
+            # QoS 2 message delivered to this client
+            self.send(_packet(PUBREL << 4 | 0x02, body[:2]))
+        elif kind == SUBSCRIBE:
+            pos, granted = 2, bytearray()
+            topics = []
+            while pos < len(body):
+                topic, pos = _string(body, pos)
+                qos = body[pos] & 0x03
+                pos += 1
+                topics.append(topic.decode("utf-8"))
+                self.subscriptions[topics[-1]] = qos
+                granted.append(qos)
+            self.send(_packet(0x90, body[:2] + bytes(granted)))
+            broker._send_retained(self, topics)
+        elif kind == UNSUBSCRIBE:
+            pos = 2
+            while pos < len(body):
+                topic, pos = _string(body, pos)
+                self.subscriptions.pop(topic.decode("utf-8"), None)
+            self.send(_packet(0xB0, body[:2]))
+        elif kind == CONNECT:
+            self.send(_packet(0x20, b"\x00\x00"))
+        elif kind == PINGREQ:
+            self.send(_packet(0xD0))
+        elif kind == DISCONNECT:
+            return False
+        # PUBACK and PUBCOMP of delivered messages need no answer
+        return True
+
+    def deliver(self, topic: bytes, payload: bytes, qos: int, retain: bool) -> None:
+        header = PUBLISH << 4 | qos << 1 | int(retain)
+        body = struct.pack("!H", len(topic)) + topic
+        if qos:
+            body += struct.pack("!H", self.next_mid())
+        self.send(_packet(header, body + payload))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    broker: "Broker"
+
+
+class Broker:
+    """MQTT broker stand-in serving clients in background threads.
+
+    :param host: address to listen on
+    :param port: port to listen on, 0 picks a free port
+
+    **Example usage:**::
+
+        with Broker() as broker:
+            app.config['MQTT_BROKER_PORT'] = broker.port
+
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self._server = _Server((host, port), _Connection)
+        self._server.broker = self
+        self._thread: Optional[threading.Thread] = None
+        self._connections: Set[_Connection] = set()
+        self._retained: Dict[str, Tuple[bytes, int]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "Broker":
+        """Start accepting connections."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="benchmark-broker", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Close all connections and stop accepting new ones."""
+        self._server.shutdown()
+        self._server.server_close()
+        self.drop_connections()
+
+    def drop_connections(self) -> None:
+        """Close all client connections as if the network failed."""
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self) -> "Broker":
+        return self.start()
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+    def _add(self, connection: _Connection) -> None:
+        with self._lock:
+            self._connections.add(connection)
+
+    def _remove(self, connection: _Connection) -> None:
+        with self._lock:
+            self._connections.discard(connection)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> None:
+        """Send a message to all matching subscriptions."""
+        if retain:
+            with self._lock:
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+        with self._lock:
+            connections = list(self._connections)
+        encoded = topic.encode("utf-8")
+        for connection in connections:
+            granted = [
+                q for f, q in list(connection.subscriptions.items()) if topic_matches(f, topic)
+            ]
+            if granted:
+                connection.deliver(encoded, payload, min(qos, max(granted)), False)
+
+    def _send_retained(self, connection: _Connection, topic_filters: List[str]) -> None:
+        with self._lock:
+            retained = list(self._retained.items())
+        for topic, (payload, qos) in retained:
+            granted = [
+                connection.subscriptions[f] for f in topic_filters if topic_matches(f, topic)
+            ]
+            if granted:
+                connection.deliver(topic.encode("utf-8"), payload, min(qos, max(granted)), True)
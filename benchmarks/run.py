@@ -0,0 +1,357 @@
+"""Benchmarks of Flask-MQTT against a broker running in the same process.
+
+Run from the repository root::
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json
+
+The results are written as JSON. With ``--compare`` every result is
+compared with the same benchmark in an earlier result file and the exit
+code is 1 if one of them is worse by more than ``--threshold``.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import platform
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from flask import Flask
+from paho.mqtt.client import MQTTMessage
+
+import flask_mqtt
+from flask_mqtt import Mqtt, loopback
+from flask_mqtt.loopback import LoopbackBroker
+
+from .broker import Broker
+
+Result = Dict[str, Any]
+AnyBroker = Union[Broker, LoopbackBroker]
+
+
+def result(
+    name: str, params: Dict[str, Any], value: float, unit: str, higher_is_better: bool
+) -> Result:
+    return {
+        "name": name,
+        "params": params,
+        "value": round(value, 6),
+        "unit": unit,
+        "higher_is_better": higher_is_better,
+    }
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError("Benchmark timed out")
+        time.sleep(0.001)
+
+
+def client(broker: AnyBroker, name: str, **config: Any) -> Mqtt:
+    app = Flask(name)
+    if isinstance(broker, LoopbackBroker):
+        config["MQTT_TRANSPORT"] = "loopback"
+    app.config.update(
+        MQTT_BROKER_URL=broker.host,
+        MQTT_BROKER_PORT=broker.port,
+        MQTT_CLIENT_ID=name,
+        MQTT_KEEPALIVE=60,
+        **config
+    )
+    mqtt = Mqtt(app)
+    wait_for(lambda: mqtt.connected, 10)
+    return mqtt
+
+
+def bench_publish_throughput(broker: AnyBroker, messages: int) -> List[Result]:
+    """Messages per second from publish() until paho reports them sent."""
+    results = []
+    payload = b"x" * 64
+    for qos in (0, 1, 2):
+        mqtt = client(broker, "throughput-{0}".format(qos))
+        done = threading.Event()
+        count = [0]
+
+        @mqtt.on_publish()
+        def handle_publish(client: Any, userdata: Any, mid: int) -> None:
+            count[0] += 1
+            if count[0] == messages:
+                done.set()
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            mqtt.publish("bench/throughput", payload, qos)
+        if not done.wait(120):
+            raise RuntimeError("Benchmark timed out")
+        elapsed = time.perf_counter() - start
+        mqtt._disconnect()
+        results.append(
+            result(
+                "publish_throughput",
+                {"qos": qos, "messages": messages, "payload_bytes": len(payload)},
+                messages / elapsed,
+                "msg/s",
+                True,
+            )
+        )
+    return results
+
+
+def bench_latency(broker: AnyBroker, messages: int) -> List[Result]:
+    """Time from publish() until the handler of a subscriber is called."""
+    results = []
+    for qos in (0, 1, 2):
+        subscriber = client(broker, "latency-sub-{0}".format(qos))
+        publisher = client(broker, "latency-pub-{0}".format(qos))
+        received = threading.Event()
+        latencies: List[float] = []
+
+        @subscriber.on_topic("bench/latency")
+        def handle_latency(client: Any, userdata: Any, message: Any) -> None:
+            (sent,) = struct.unpack("d", message.payload)
+            latencies.append(time.perf_counter() - sent)
+            received.set()
+
+        subscribed = threading.Event()
+        subscriber.on_subscribe()(lambda *args: subscribed.set())
+        subscriber.subscribe("bench/latency", qos)
+        subscribed.wait(10)
+
+        # one message at a time, so queueing does not add to the latency
+        for _ in range(messages):
+            received.clear()
+            publisher.publish("bench/latency", struct.pack("d", time.perf_counter()), qos)
+            if not received.wait(10):
+                raise RuntimeError("Benchmark timed out")
+        subscriber._disconnect()
+        publisher._disconnect()
+
+        params = {"qos": qos, "messages": messages}
+        for p in (50, 90, 99):
+            results.append(
+                result(
+                    "latency_p{0}".format(p),
+                    params,
+                    percentile(latencies, p) * 1e6,
+                    "us",
+                    False,
+                )
+            )
+        results.append(result("latency_max", params, max(latencies) * 1e6, "us", False))
+    return results
+
+
+def bench_dispatch(broker: AnyBroker, messages: int) -> List[Result]:
+    """Cost of routing a received message to its on_topic handlers."""
+    results = []
+    for handlers in (1, 10, 100, 1000, 10000):
+        mqtt = client(broker, "dispatch-{0}".format(handlers))
+        calls = [0]
+
+        def handle(client: Any, userdata: Any, message: Any) -> None:
+            calls[0] += 1
+
+        for i in range(handlers):
+            mqtt.on_topic("bench/{0}/value".format(i))(handle)
+        mqtt.on_topic("bench/+/value")(handle)
+
+        topics = []
+        for i in range(100):
+            message = MQTTMessage(topic="bench/{0}/value".format(i % handlers).encode())
+            message.payload = b"1"
+            topics.append(message)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            mqtt._handle_message(mqtt.client, None, topics[i % 100])
+        elapsed = time.perf_counter() - start
+        mqtt._disconnect()
+        assert calls[0] == 2 * messages
+        results.append(
+            result(
+                "dispatch_per_message",
+                {"handlers": handlers, "messages": messages},
+                elapsed / messages * 1e6,
+                "us",
+                False,
+            )
+        )
+    return results
+
+
+def bench_resubscribe(broker: AnyBroker, topic_counts: List[int]) -> List[Result]:
+    """Time to reconnect and restore the subscriptions after a network failure."""
+    results = []
+    for topics in topic_counts:
+        mqtt = client(broker, "resubscribe-{0}".format(topics))
+        mqtt.client.reconnect_delay_set(0, 1)
+        batches = math.ceil(topics / mqtt.subscribe_batch_size)
+        acks = [0]
+        connected_at = [0.0]
+        subscribed_at = [0.0]
+
+        @mqtt.on_subscribe()
+        def handle_subscribe(*args: Any) -> None:
+            acks[0] += 1
+            if acks[0] == batches:
+                subscribed_at[0] = time.perf_counter()
+
+        @mqtt.on_connect()
+        def handle_connect(*args: Any) -> None:
+            connected_at[0] = time.perf_counter()
+
+        mqtt.subscribe_many("bench/{0}/value".format(i) for i in range(topics))
+        wait_for(lambda: acks[0] == batches)
+
+        acks[0] = 0
+        start = time.perf_counter()
+        broker.drop_connections()
+        wait_for(lambda: acks[0] == batches)
+        mqtt._disconnect()
+
+        params = {"topics": topics}
+        # the loopback transport acknowledges the subscriptions before the
+        # connect handler is called
+        resubscribe = max(subscribed_at[0] - connected_at[0], 0.0)
+        results.append(
+            result("reconnect_seconds", params, connected_at[0] - start, "s", False)
+        )
+        results.append(
+            result(
+                "resubscribe_seconds",
+                params,
+                resubscribe,
+                "s",
+                False,
+            )
+        )
+    return results
+
+
+def run(
+    quick: bool = False, only: Optional[List[str]] = None, in_memory: bool = False
+) -> Dict[str, Any]:
+    scale = 10 if quick else 1
+    benchmarks: Dict[str, Callable[[AnyBroker], List[Result]]] = {
+        "publish_throughput": lambda b: bench_publish_throughput(b, 20000 // scale),
+        "latency": lambda b: bench_latency(b, 2000 // scale),
+        "dispatch": lambda b: bench_dispatch(b, 100000 // scale),
+        "resubscribe": lambda b: bench_resubscribe(
+            b, [10, 100, 1000] if quick else [10, 100, 1000, 10000]
+        ),
+    }
+    results: List[Result] = []
+    with Broker() as tcp_broker:
+        broker: AnyBroker = tcp_broker
+        if in_memory:
+            loopback.reset()
+            broker = loopback.get_broker(tcp_broker.host, tcp_broker.port)
+        for name, benchmark in benchmarks.items():
+            if only and name not in only:
+                continue
+            print("running {0}".format(name), file=sys.stderr)
+            results.extend(benchmark(broker))
+    return {
+        "meta": {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "flask_mqtt": flask_mqtt.__version__,
+            "quick": quick,
+            "transport": "loopback" if in_memory else "tcp",
+        },
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> int:
+    """Print the change of each result and return the number of regressions."""
+
+    def key(item: Result) -> str:
+        return item["name"] + json.dumps(item["params"], sort_keys=True)
+
+    previous = {key(item): item for item in baseline["results"]}
+    regressions = 0
+    for item in current["results"]:
+        old = previous.get(key(item))
+        if old is None or not old["value"]:
+            continue
+        change = item["value"] / old["value"] - 1
+        worse = -change if item["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(
+            "{0:<32} {1:<45} {2:>14.6g} {3:>14.6g} {4:>+8.1%}{5}".format(
+                item["name"],
+                json.dumps(item["params"], sort_keys=True),
+                old["value"],
+                item["value"],
+                change,
+                flag,
+            )
+        )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative change counted as regression (default: 0.2)",
+    )
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations")
+    parser.add_argument(
+        "--loopback",
+        action="store_true",
+        help="use the in-memory loopback transport instead of the broker stand-in",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=["publish_throughput", "latency", "dispatch", "resubscribe"],
+        help="run only these benchmarks",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(args.quick, args.only, args.loopback)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare(results, baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,14 +5,40 @@
 
 """
 
+import asyncio
+import base64
+import concurrent.futures
+import copy
+import functools
+import inspect
+import itertools
+import json
 import logging
+import os
 import socket
 import ssl
 import sys
-from collections import namedtuple
-from typing import Any, Callable, Dict, List, Optional, Tuple
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future as ConcurrentFuture
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
-from flask import Flask
+from flask import Flask, Response, current_app, has_app_context
 
 # noinspection PyUnresolvedReferences
 from paho.mqtt.client import (
@@ -39,9 +65,39 @@ from paho.mqtt.client import (
     MQTT_LOG_NOTICE,
     MQTT_LOG_WARNING,
     Client,
+    MQTTv5,
     MQTTv31,
     MQTTv311,
+    error_string,
+)
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from .brokers import fastest_broker, next_broker, parse_broker, set_client_broker
+from .cache import CacheStats, LastValueCache
+from .coalesce import Coalescer
+from .codecs import Codec, DecodedMessage, JsonCodec, get_codec
+from .compression import (
+    COMPRESSIONS,
+    CONTENT_ENCODING,
+    MARKERS,
+    Compressor,
+    DecompressedMessage,
+    get_compressor,
 )
+from .dispatch import Dispatcher, DispatchStats
+from .loopback import LoopbackClient
+from .metrics import Metrics
+from .outbound import (
+    OutboundMessage,
+    OutboundQueue,
+    OutboundQueueFull,
+    OutboundStats,
+    payload_size,
+)
+from .router import TopicRouter, filter_covers, strip_share, topic_matches
+from .spool import Spool, to_bytes
+from .stream import Listener, StreamHub, StreamStats, format_event, server_sent_events
 
 # define some alias for python2 compatibility
 if sys.version_info[0] >= 3:
@@ -53,6 +109,28 @@ __version__ = "1.3.0"
 #: Container for topic + qos
 TopicQos = namedtuple("TopicQos", ["topic", "qos"])
 
+
+class PublishFuture(ConcurrentFuture):
+    """Future of a published message.
+
+    Returned by :meth:`Mqtt.publish` if called with ``track=True``. The
+    result is the message ID and is set when the message has been written to
+    the socket (QoS 0), on PUBACK (QoS 1) or on PUBCOMP (QoS 2).
+
+    Like the tuple returned by an untracked publish it can be unpacked into
+    ``(result, mid)``.
+
+    """
+
+    def __init__(self, rc: int, mid: int) -> None:
+        super().__init__()
+        self.rc = rc
+        self.mid = mid
+
+    def __iter__(self) -> Any:
+        return iter((self.rc, self.mid))
+
+
 # Init logger
 logger = logging.getLogger(__name__)
 
@@ -76,28 +154,86 @@ class Mqtt:
         self._connect_async: bool = connect_async
         self._connect_handler: Optional[Callable] = None
         self._disconnect_handler: Optional[Callable] = None
+        self._publish_handler: Optional[Callable] = None
+        self._subscribe_handler: Optional[Callable] = None
+        self._unsubscribe_handler: Optional[Callable] = None
+        self._message_handler: Optional[Callable] = None
+        self._router = TopicRouter()
+        self._codecs = TopicRouter()
+        # topic -> number of subscribe() calls not undone by unsubscribe()
+        self._subscribers: Dict[str, int] = {}
+        self._subscribe_lock = threading.RLock()
+        # topics counted before a reconnect, subscribed again by on_connect()
+        self._restored: Set[str] = set()
+        self._restoring: Optional[int] = None
+        # mid -> (future, qos, size) of messages waiting for on_publish
+        self._pending_acks: Dict[int, Tuple[Optional[PublishFuture], int, Optional[int]]] = {}
+        self._early_acks: Set[int] = set()
+        self._tracking = 0
+        self._ack_lock = threading.RLock()
+        self.metrics: Optional[Metrics] = None
+        self._publish_times: Dict[int, float] = {}
+        self._connected_once = False
+        # set while connected, see wait_for_connection()
+        self._ready = threading.Event()
+        self.startup_budget: Optional[float] = None
+        self.startup_policy: str = "buffer"
+        self.startup_buffer_size: int = 1000
+        # messages published before the first connect, None once connected
+        self._startup_buffer: Optional[Deque[Tuple[Any, ...]]] = None
+        self._startup_lock = threading.Lock()
+        # counts the failovers, a probe only applies to the one it was made for
+        self._failovers = 0
+        self._broker_lock = threading.Lock()
+        self.outbound: Optional[OutboundQueue] = None
+        self._high_water_handler: Optional[Callable] = None
+        self._low_water_handler: Optional[Callable] = None
+        self.spool: Optional[Spool] = None
+        # the configured path, forked processes spool to <path>.<pid>
+        self._spool_path: Optional[str] = None
+        self.spool_replay_rate = 0.0
+        self._spool_lock = threading.Lock()
+        # True until the spool has been replayed after a connect
+        self._spooling = True
+        self._spool_cursor = 0
+        self._spool_generation = 0
+        self._spool_thread: Optional[threading.Thread] = None
+        self._spool_futures: Dict[int, PublishFuture] = {}
+        self._spool_acked: List[int] = []
+        self.cache: Optional[LastValueCache] = None
+        self.response_topic: Optional[str] = None
+        self._response_topic_derived = False
+        self.request_timeout: float = 10.0
+        # correlation id -> future of the response
+        self._requests: Dict[bytes, ConcurrentFuture] = {}
+        self._request_lock = threading.Lock()
+        # random prefix, so ids of a previous run are never mistaken
+        self._request_ids = (
+            "{0}-{1:x}".format(os.urandom(4).hex(), n) for n in itertools.count()
+        )
+        # position in a MqttPool, used to derive a unique client id
+        self._pool_index: Optional[int] = None
+        # True in a forked child until the client is used, see _after_fork()
+        self._fork_pending = False
+        self._mqtt_logging = mqtt_logging
 
         self.app = app
-        # paho-mqtt >=2.0.0 requires selecting the callback API version.
-        # Opt into VERSION1 for backward-compatible callback signatures.
-        try:
-            from paho.mqtt.client import CallbackAPIVersion
-
-            self.client = Client(CallbackAPIVersion.VERSION1)
-        except ImportError:
-            # For paho-mqtt <2.0.0 where CallbackAPIVersion does not exist.
-            self.client = Client()
+        self.client = self._create_client()
         self.connected = False
         self.topics: Dict[str, TopicQos] = {}
 
         # configuration parameters
         self.client_id: str = ""
+        # client id as configured, before making it unique
+        self._client_id_base: str = ""
+        self.transport: str = "tcp"
         self.config_prefix = config_prefix
         self.clean_session: bool = True
         self.username: Optional[str] = None
         self.password: Optional[str] = None
         self.broker_url: str = "localhost"
         self.broker_port: int = 1883
+        self.brokers: List[Tuple[str, int]] = []
         self.tls_enabled: bool = False
         self.keepalive: int = 60
         self.connection_timeout: int = 5
@@ -113,6 +249,38 @@ class Mqtt:
         self.tls_version: int = ssl.PROTOCOL_TLSv1_2
         self.tls_ciphers: Optional[List[str]] = None
         self.tls_insecure: bool = False
+        self.dispatch_workers: int = 0
+        self.dispatch_queue_size: int = 1000
+        self.subscribe_batch_size: int = 100
+        self.shared_group: Optional[str] = None
+        self.protocol_version: int = MQTTv311
+        self.connect_properties: Optional[Properties] = None
+        self.topic_alias_maximum: int = 65535
+        # topic -> alias of outgoing messages, least recently used first
+        self._topic_aliases: "OrderedDict[str, int]" = OrderedDict()
+        self._topic_alias_limit = 0
+        self._alias_lock = threading.Lock()
+        self.client_id_unique: bool = False
+        self.compressor: Optional[Compressor] = None
+        self.compression_threshold: int = 1024
+        self.compression_marker: str = "property"
+        self._decompressors: Dict[str, Compressor] = {}
+        # topic filter -> minimum interval between messages of a topic
+        self._coalesce = TopicRouter()
+        self._coalescer = Coalescer(self._publish_coalesced)
+        self.coalesce_flush: bool = True
+        self._dispatcher: Optional[Dispatcher] = None
+        self.app_context: bool = False
+        self._teardown_handlers: List[Callable] = []
+        # listeners of listen() and stream(), created on first use
+        self._streams: Optional[StreamHub] = None
+        self._stream_lock = threading.Lock()
+        # QoS of the streamed filters and the filters subscribed for them,
+        # filters covered by a shared subscription are not subscribed again
+        self._stream_qos: Dict[str, int] = {}
+        self._stream_topics: Set[str] = set()
+        self.stream_queue_size: int = 100
+        self.stream_keepalive: float = 15.0
 
         if mqtt_logging:
             self.client.enable_logger(logger)
@@ -120,6 +288,18 @@ class Mqtt:
         if app is not None:
             self.init_app(app, self.config_prefix)
 
+    @staticmethod
+    def _create_client() -> Client:
+        # paho-mqtt >=2.0.0 requires selecting the callback API version.
+        # Opt into VERSION1 for backward-compatible callback signatures.
+        try:
+            from paho.mqtt.client import CallbackAPIVersion
+
+            return Client(CallbackAPIVersion.VERSION1)
+        except ImportError:
+            # For paho-mqtt <2.0.0 where CallbackAPIVersion does not exist.
+            return Client()
+
     def init_app(self, app: Flask, config_prefix: str = "MQTT") -> None:
         """Init the Flask-MQTT addon."""
 
@@ -129,29 +309,20 @@ class Mqtt:
         if config_prefix + "_CLIENT_ID" in app.config:
             self.client_id = app.config[config_prefix + "_CLIENT_ID"]
 
-        if isinstance(self.client_id, unicode):
-            self.client._client_id = self.client_id.encode("utf-8")
-        else:
-            self.client._client_id = self.client_id
+        if config_prefix + "_CLIENT_ID_UNIQUE" in app.config:
+            self.client_id_unique = app.config[config_prefix + "_CLIENT_ID_UNIQUE"]
+
+        self._client_id_base = self.client_id
+        self.client_id = self._derive_client_id(self.client_id_unique)
+
+        self.transport = app.config.get(config_prefix + "_TRANSPORT", "tcp").lower()
+        if self.transport == "loopback":
+            self._use_loopback()
 
         if config_prefix + "_CLEAN_SESSION" in app.config:
             self.clean_session = app.config[config_prefix + "_CLEAN_SESSION"]
 
-        # Set transport/protocol/clean_session with forward-compatibility for paho-mqtt 2.x
-        transport_value = app.config.get(config_prefix + "_TRANSPORT", "tcp").lower()
-        protocol_value = app.config.get(config_prefix + "_PROTOCOL_VERSION", MQTTv311)
-        try:
-            # paho-mqtt 2.x exposes properties
-            self.client.transport = transport_value
-            self.client.protocol = protocol_value
-            self.client.clean_session = self.clean_session
-        except AttributeError:
-            # fall back to older private attributes for 1.x
-            self.client._transport = transport_value
-            self.client._protocol = protocol_value
-            self.client._clean_session = self.clean_session
-        self.client.on_connect = self._handle_connect
-        self.client.on_disconnect = self._handle_disconnect
+        self.protocol_version = app.config.get(config_prefix + "_PROTOCOL_VERSION", MQTTv311)
 
         if config_prefix + "_USERNAME" in app.config:
             self.username = app.config[config_prefix + "_USERNAME"]
@@ -165,6 +336,15 @@ class Mqtt:
         if config_prefix + "_BROKER_PORT" in app.config:
             self.broker_port = app.config[config_prefix + "_BROKER_PORT"]
 
+        if app.config.get(config_prefix + "_BROKER_URLS"):
+            self.brokers = [
+                parse_broker(broker, self.broker_port)
+                for broker in app.config[config_prefix + "_BROKER_URLS"]
+            ]
+            self.broker_url, self.broker_port = self.brokers[0]
+        else:
+            self.brokers = [(self.broker_url, self.broker_port)]
+
         if config_prefix + "_TLS_ENABLED" in app.config:
             self.tls_enabled = app.config[config_prefix + "_TLS_ENABLED"]
 
@@ -209,6 +389,180 @@ class Mqtt:
                 config_prefix + "_TLS_VERSION", ssl.PROTOCOL_TLSv1_2
             )
 
+        if config_prefix + "_DISPATCH_WORKERS" in app.config:
+            self.dispatch_workers = app.config[config_prefix + "_DISPATCH_WORKERS"]
+
+        if config_prefix + "_DISPATCH_QUEUE_SIZE" in app.config:
+            self.dispatch_queue_size = app.config[config_prefix + "_DISPATCH_QUEUE_SIZE"]
+
+        if config_prefix + "_APP_CONTEXT" in app.config:
+            self.app_context = app.config[config_prefix + "_APP_CONTEXT"]
+
+        if config_prefix + "_SUBSCRIBE_BATCH_SIZE" in app.config:
+            self.subscribe_batch_size = app.config[config_prefix + "_SUBSCRIBE_BATCH_SIZE"]
+
+        if config_prefix + "_SHARED_GROUP" in app.config:
+            self.shared_group = app.config[config_prefix + "_SHARED_GROUP"]
+
+        if config_prefix + "_CONNECT_PROPERTIES" in app.config:
+            self.connect_properties = app.config[config_prefix + "_CONNECT_PROPERTIES"]
+
+        if config_prefix + "_TOPIC_ALIAS_MAXIMUM" in app.config:
+            self.topic_alias_maximum = app.config[config_prefix + "_TOPIC_ALIAS_MAXIMUM"]
+
+        for topic, interval in app.config.get(config_prefix + "_COALESCE", {}).items():
+            self.coalesce(topic, interval)
+
+        if config_prefix + "_COALESCE_FLUSH" in app.config:
+            self.coalesce_flush = app.config[config_prefix + "_COALESCE_FLUSH"]
+
+        if app.config.get(config_prefix + "_COMPRESSION") is not None:
+            self.compressor = get_compressor(app.config[config_prefix + "_COMPRESSION"])
+            self._decompressors[self.compressor.name] = self.compressor
+
+        if config_prefix + "_COMPRESSION_THRESHOLD" in app.config:
+            self.compression_threshold = app.config[config_prefix + "_COMPRESSION_THRESHOLD"]
+
+        # the topic marker changes the topic, it is never chosen implicitly
+        self.compression_marker = app.config.get(
+            config_prefix + "_COMPRESSION_MARKER", "property"
+        )
+        if self.compression_marker not in MARKERS:
+            raise ValueError(
+                "Unknown compression marker: {0}".format(self.compression_marker)
+            )
+        if (
+            self.compressor is not None
+            and self.compression_marker == "property"
+            and self.protocol_version != MQTTv5
+        ):
+            raise ValueError(
+                "Compression requires MQTTv5, set {0}_COMPRESSION_MARKER to "
+                '"topic" to mark compressed messages by their topic'.format(config_prefix)
+            )
+
+        max_messages = app.config.get(config_prefix + "_OUTBOUND_MAX_MESSAGES", 0)
+        max_bytes = app.config.get(config_prefix + "_OUTBOUND_MAX_BYTES", 0)
+        if (max_messages or max_bytes) and self.outbound is None:
+            self.outbound = OutboundQueue(
+                max_messages=max_messages,
+                max_bytes=max_bytes,
+                policy=app.config.get(config_prefix + "_OUTBOUND_POLICY", "block"),
+                high_water=app.config.get(config_prefix + "_OUTBOUND_HIGH_WATER", 0.8),
+                low_water=app.config.get(config_prefix + "_OUTBOUND_LOW_WATER", 0.5),
+                timeout=app.config.get(config_prefix + "_OUTBOUND_TIMEOUT"),
+            )
+            self.outbound.on_high_water = self._handle_high_water
+            self.outbound.on_low_water = self._handle_low_water
+
+        if config_prefix + "_SPOOL_REPLAY_RATE" in app.config:
+            self.spool_replay_rate = app.config[config_prefix + "_SPOOL_REPLAY_RATE"]
+
+        spool_path = app.config.get(config_prefix + "_SPOOL_PATH")
+        if spool_path is not None and self._pool_index is not None and spool_path != ":memory:":
+            # every connection of a pool replays its own messages
+            spool_path = "{0}.{1}".format(spool_path, self._pool_index)
+        if spool_path is not None and self.spool is None:
+            self.spool = Spool(
+                spool_path,
+                batch_size=app.config.get(config_prefix + "_SPOOL_BATCH_SIZE", 500),
+            )
+            self._spool_path = spool_path
+            # replayed after the connect like the own messages
+            self.spool.adopt_orphans(spool_path)
+
+        if config_prefix + "_RESPONSE_TOPIC" in app.config:
+            self.response_topic = app.config[config_prefix + "_RESPONSE_TOPIC"]
+
+        if config_prefix + "_REQUEST_TIMEOUT" in app.config:
+            self.request_timeout = app.config[config_prefix + "_REQUEST_TIMEOUT"]
+
+        if config_prefix + "_STREAM_QUEUE_SIZE" in app.config:
+            self.stream_queue_size = app.config[config_prefix + "_STREAM_QUEUE_SIZE"]
+
+        if config_prefix + "_STREAM_KEEPALIVE" in app.config:
+            self.stream_keepalive = app.config[config_prefix + "_STREAM_KEEPALIVE"]
+
+        if app.config.get(config_prefix + "_CACHE_ENABLED", False) and self.cache is None:
+            self.cache = LastValueCache(
+                max_entries=app.config.get(config_prefix + "_CACHE_MAX_ENTRIES", 10000),
+                max_bytes=app.config.get(config_prefix + "_CACHE_MAX_BYTES", 0),
+            )
+
+        if app.config.get(config_prefix + "_METRICS_ENABLED", False):
+            route = app.config.get(config_prefix + "_METRICS_ROUTE")
+            if self._pool_index:
+                # the route is served by the first connection of a pool
+                route = None
+            self._init_metrics(app, config_prefix, route)
+
+        self._setup_client()
+
+        # run message handlers in a worker pool instead of the network thread
+        if self.dispatch_workers and self._dispatcher is None:
+            self._dispatcher = Dispatcher(
+                self.dispatch_workers,
+                self.dispatch_queue_size,
+                name="flask-mqtt-{0}".format(config_prefix.lower()),
+            )
+            self._dispatcher.start()
+
+        if config_prefix + "_STARTUP_BUDGET" in app.config:
+            self.startup_budget = app.config[config_prefix + "_STARTUP_BUDGET"]
+
+        if config_prefix + "_STARTUP_POLICY" in app.config:
+            self.startup_policy = app.config[config_prefix + "_STARTUP_POLICY"]
+        if self.startup_policy not in ("buffer", "reject"):
+            raise ValueError("Unknown startup policy: {0}".format(self.startup_policy))
+
+        if config_prefix + "_STARTUP_BUFFER_SIZE" in app.config:
+            self.startup_buffer_size = app.config[config_prefix + "_STARTUP_BUFFER_SIZE"]
+
+        # drop the connection in forked children, e.g. gunicorn --preload
+        app.before_request(self._resume_after_fork)
+        _instances.add(self)
+
+        if self.startup_budget is None:
+            self._connect()
+        else:
+            self._connect_in_background(self.startup_budget)
+
+    def _derive_client_id(self, unique: bool) -> str:
+        client_id = self._client_id_base
+        if unique and client_id:
+            # e.g. one client per gunicorn worker
+            client_id = "{0}-{1}-{2}".format(client_id, socket.gethostname(), os.getpid())
+        if self._pool_index is not None and client_id:
+            client_id = "{0}-{1}".format(client_id, self._pool_index)
+        return client_id
+
+    def _setup_client(self) -> None:
+        if isinstance(self.client_id, unicode):
+            self.client._client_id = self.client_id.encode("utf-8")
+        else:
+            self.client._client_id = self.client_id
+
+        # Set transport/protocol/clean_session with forward-compatibility for paho-mqtt 2.x
+        transport: Any = self.transport
+        protocol: Any = self.protocol_version
+        try:
+            # paho-mqtt 2.x exposes properties
+            self.client.transport = transport
+            self.client.protocol = protocol
+            self.client.clean_session = self.clean_session
+        except AttributeError:
+            # fall back to older private attributes for 1.x
+            self.client._transport = transport
+            self.client._protocol = protocol
+            self.client._clean_session = self.clean_session
+        self.client.on_connect = self._handle_connect
+        self.client.on_disconnect = self._handle_disconnect
+        self.client.on_message = self._handle_message
+        self.client.on_publish = self._handle_publish
+        self.client.on_subscribe = self._handle_subscribe
+        self.client.on_unsubscribe = self._handle_unsubscribe
+        self.client.on_connect_fail = self._handle_connect_fail
+
         # set last will message
         if self.last_will_topic is not None:
             self.client.will_set(
@@ -218,138 +572,798 @@ class Mqtt:
                 self.last_will_retain,
             )
 
-        self._connect()
-
-    def _connect(self) -> None:
-        if self.username is not None:
-            self.client.username_pw_set(self.username, self.password)
+    def _connect_in_background(self, budget: float) -> None:
+        # paho connects and retries in its network thread, the application
+        # waits at most budget seconds for the first connect
+        if not self._connected_once and self._startup_buffer is None:
+            self._startup_buffer = deque()
+        self._connect_async = True
+        thread = threading.Thread(
+            target=self._connect_logged, name="flask-mqtt-{0}-connect".format(
+                self.config_prefix.lower()
+            )
+        )
+        thread.daemon = True
+        thread.start()
+        if budget and not self._ready.wait(budget):
+            logger.warning(
+                "Not connected to broker {0}:{1} within {2}s, connecting in the "
+                "background".format(self.broker_url, self.broker_port, budget)
+            )
 
-        # Set socket timeout for connection attempts (paho-mqtt uses this internally)
-        # This timeout applies during the socket connection phase
-        default_timeout = None
+    def _connect_logged(self) -> None:
         try:
-            default_timeout = socket.getdefaulttimeout()
-            socket.setdefaulttimeout(self.connection_timeout)
+            self._connect()
         except Exception:
-            pass  # Continue if socket timeout setting fails
-        
-        try:
-            # security
-            if self.tls_enabled:
-                try:
-                    self.client.tls_set(
-                        ca_certs=self.tls_ca_certs,
-                        certfile=self.tls_certfile,
-                        keyfile=self.tls_keyfile,
-                        cert_reqs=self.tls_cert_reqs,
-                        tls_version=self.tls_version,
-                        ciphers=self.tls_ciphers,
-                    )
+            # already logged by _connect()
+            pass
 
-                    if self.tls_insecure:
-                        self.client.tls_insecure_set(self.tls_insecure)
-                except Exception as e:
-                    logger.error(
-                        "TLS configuration failed for broker {0}:{1} - {2}: {3}".format(
-                            self.broker_url, self.broker_port, type(e).__name__, str(e)
-                        )
-                    )
-                    raise
+    def wait_for_connection(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the client is connected to the broker.
+
+        :param timeout: maximum time in seconds to wait, None waits forever
+
+        :returns: True if the client is connected, False on timeout
 
-            if self._connect_async:
-                # if connect_async is used
+        Useful with ``MQTT_STARTUP_BUDGET``, e.g. in a readiness check.
+
+        """
+        if self._fork_pending:
+            self._resume_after_fork()
+        return self._ready.wait(timeout)
+
+    def _after_fork(self) -> None:
+        # called in a forked child: the network and worker threads have not
+        # been copied, the socket is shared with the parent which may still
+        # use it. The connection is dropped without a DISCONNECT packet and
+        # a new client connects with its own client id on first use.
+        for name in ("_sock", "_sockpairR", "_sockpairW"):
+            sock = getattr(self.client, name, None)
+            if sock is not None:
                 try:
-                    self.client.connect_async(
-                        self.broker_url, self.broker_port, keepalive=self.keepalive
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Failed to initiate async connection to broker {0}:{1} - {2}: {3}".format(
-                            self.broker_url, self.broker_port, type(e).__name__, str(e)
-                        )
-                    )
-                    raise
+                    sock.close()
+                except OSError:
+                    pass
+        # locks may have been held by threads of the parent
+        self._ack_lock = threading.RLock()
+        self._startup_lock = threading.Lock()
+        self._broker_lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._request_lock = threading.Lock()
+        self._alias_lock = threading.Lock()
+        for router in (self._router, self._codecs, self._coalesce):
+            router._after_fork()
+        for component in (self.outbound, self.cache, self.metrics):
+            if component is not None:
+                component._after_fork()
+
+        self.connected = False
+        self._connected_once = False
+        self._ready = threading.Event()
+        self._startup_buffer = deque()
+        self._pending_acks = {}
+        self._early_acks = set()
+        self._tracking = 0
+        self._publish_times = {}
+        self._topic_aliases = OrderedDict()
+        self._topic_alias_limit = 0
+        self._requests = {}
+        self._request_ids = (
+            "{0}-{1:x}".format(os.urandom(4).hex(), n) for n in itertools.count()
+        )
+        self._stream_lock = threading.Lock()
+        self._subscribe_lock = threading.RLock()
+        self._restored = set()
+        self._restoring = None
+        if self._streams is not None:
+            self._streams._after_fork()
+            for topic in self._stream_topics:
+                count = self._subscribers.pop(topic, 1)
+                if count > 1:
+                    self._subscribers[topic] = count - 1
+                else:
+                    self.topics.pop(topic, None)
+            self._stream_qos = {}
+            self._stream_topics = set()
+        if self._response_topic_derived:
+            # derived from the client id of the parent
+            self.topics.pop(cast(str, self.response_topic), None)
+            self.response_topic = None
+            self._response_topic_derived = False
+
+        self._coalescer = Coalescer(self._publish_coalesced)
+        if self._dispatcher is not None:
+            dispatcher = self._dispatcher
+            self._dispatcher = Dispatcher(
+                dispatcher.workers, dispatcher.queue_size, name=dispatcher.name
+            )
+        if self.spool is not None:
+            # the parent replays the messages it has spooled
+            self._spooling = True
+            self._spool_cursor = 0
+            self._spool_thread = None
+            self._spool_futures = {}
+            self._spool_acked = []
+            if self.spool.path != ":memory:":
+                base = self._spool_path or self.spool.path
+                self.spool._after_fork("{0}.{1}".format(base, os.getpid()))
             else:
-                try:
-                    res = self.client.connect(
-                        self.broker_url, self.broker_port, keepalive=self.keepalive
+                self.spool._after_fork(self.spool.path)
+
+        self.client_id = self._derive_client_id(unique=True)
+        # set by the on_log() decorator
+        on_log = getattr(self.client, "on_log", None)
+        if isinstance(self.client, LoopbackClient):
+            self.client = cast(Client, LoopbackClient())
+        else:
+            self.client = self._create_client()
+        if on_log is not None:
+            self.client.on_log = on_log
+        if self._mqtt_logging:
+            self.client.enable_logger(logger)
+        self._setup_client()
+        self._fork_pending = True
+
+    def _resume_after_fork(self) -> None:
+        # connect the client of a forked child on first use, also called
+        # before every request, which mostly skips the lock
+        if not self._fork_pending:
+            return
+        with self._startup_lock:
+            if not self._fork_pending:
+                return
+            self._fork_pending = False
+        logger.debug(
+            "Connecting client '{0}' in forked process {1}".format(self.client_id, os.getpid())
+        )
+        if self._dispatcher is not None:
+            self._dispatcher.start()
+        if self.spool is not None and self._spool_path is not None:
+            # messages of workers that have exited meanwhile
+            self.spool.adopt_orphans(self._spool_path)
+        self._connect_in_background(0)
+
+    def _init_metrics(
+        self, app: Flask, config_prefix: str, route: Optional[str] = None
+    ) -> None:
+        if self.metrics is None:
+            metrics = Metrics(prefix=config_prefix.lower())
+            metrics.add_gauge(
+                "connected", "1 if connected to the broker.", lambda: int(self.connected)
+            )
+            metrics.add_gauge(
+                "outgoing_packets",
+                "Packets waiting to be written to the socket.",
+                lambda: len(getattr(self.client, "_out_packet", ())),
+            )
+            metrics.add_gauge(
+                "outgoing_messages",
+                "QoS > 0 messages waiting for an acknowledgement.",
+                lambda: len(getattr(self.client, "_out_messages", ())),
+            )
+            metrics.add_gauge(
+                "dispatch_queue_depth",
+                "Messages waiting for a dispatch worker.",
+                lambda: self.dispatch_stats().queue_depth,
+            )
+            metrics.add_gauge(
+                "dispatch_busy_workers",
+                "Dispatch workers executing a handler.",
+                lambda: self.dispatch_stats().busy_workers,
+            )
+            outbound = self.outbound
+            if outbound is not None:
+                metrics.add_gauge(
+                    "outbound_messages",
+                    "Messages occupying the outbound queue.",
+                    lambda: outbound.messages,
+                )
+                metrics.add_gauge(
+                    "outbound_bytes",
+                    "Payload bytes occupying the outbound queue.",
+                    lambda: outbound.bytes,
+                )
+            spool = self.spool
+            if spool is not None:
+                metrics.add_gauge(
+                    "spooled_messages",
+                    "Messages stored in the offline spool.",
+                    lambda: len(spool),
+                )
+            cache = self.cache
+            if cache is not None:
+                metrics.add_gauge(
+                    "cached_topics",
+                    "Topics in the last-value cache.",
+                    lambda: len(cache),
+                )
+            self.metrics = metrics
+
+        if route is not None:
+            app.add_url_rule(
+                route,
+                endpoint="{0}_metrics".format(config_prefix.lower()),
+                view_func=self.metrics_view,
+            )
+
+    def metrics_view(self) -> Response:
+        """Flask view returning the metrics in the Prometheus text format.
+
+        Registered automatically for ``MQTT_METRICS_ROUTE`` but may also be
+        added to an app or blueprint manually::
+
+            app.add_url_rule('/metrics', view_func=mqtt.metrics_view)
+
+        """
+        text = self.metrics.render() if self.metrics is not None else ""
+        return Response(text, mimetype="text/plain; version=0.0.4")
+
+    def _use_loopback(self) -> None:
+        # messages are routed within this process, no socket is opened
+        if not isinstance(self.client, LoopbackClient):
+            # has the parts of the paho client API used here
+            self.client = cast(Client, LoopbackClient())
+
+    def _select_broker(self) -> None:
+        # with several brokers connect to the one answering first
+        if len(self.brokers) < 2 or isinstance(self.client, LoopbackClient):
+            return
+        broker = fastest_broker(self.brokers, self.connection_timeout)
+        if broker is None:
+            logger.warning(
+                "None of the brokers is reachable, connecting to {0}:{1}".format(
+                    *self.brokers[0]
+                )
+            )
+            broker = self.brokers[0]
+        self.broker_url, self.broker_port = broker
+
+    def _fail_over(self) -> None:
+        # switch to another broker after the connection has been lost or a
+        # reconnect failed, paho reconnects to the new host afterwards. Called
+        # in the network thread, so the next broker is taken right away and
+        # the brokers are probed in a thread of their own.
+        if len(self.brokers) < 2 or isinstance(self.client, LoopbackClient):
+            return
+        with self._broker_lock:
+            current = (self.broker_url, self.broker_port)
+            self._switch_broker(next_broker(self.brokers, current))
+            self._failovers += 1
+            failover = self._failovers
+        thread = threading.Thread(
+            target=self._probe_brokers,
+            args=(current, failover),
+            name="flask-mqtt-failover",
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _probe_brokers(self, failed: Tuple[str, int], failover: int) -> None:
+        # reconnect to the fastest broker instead if it is found in time
+        broker = fastest_broker(
+            [b for b in self.brokers if b != failed], self.connection_timeout
+        )
+        with self._broker_lock:
+            if (
+                broker is None
+                or failover != self._failovers
+                or self.connected
+                or broker == (self.broker_url, self.broker_port)
+            ):
+                return
+            logger.debug("Broker {0}:{1} answered first".format(*broker))
+            self.broker_url, self.broker_port = broker
+            set_client_broker(self.client, broker)
+
+    def _switch_broker(self, broker: Tuple[str, int]) -> None:
+        logger.warning(
+            "Failing over from broker {0}:{1} to {2}:{3}".format(
+                self.broker_url, self.broker_port, broker[0], broker[1]
+            )
+        )
+        self.broker_url, self.broker_port = broker
+        set_client_broker(self.client, broker)
+        if self.metrics is not None:
+            self.metrics.failovers.inc()
+
+    def _configure_client(self) -> None:
+        # a timeout of the client socket, not the process wide default
+        if hasattr(self.client, "connect_timeout"):
+            self.client.connect_timeout = self.connection_timeout
+        else:
+            # paho-mqtt <2.0.0
+            self.client._connect_timeout = self.connection_timeout
+
+        if self.username is not None:
+            self.client.username_pw_set(self.username, self.password)
+
+        # security
+        if self.tls_enabled:
+            try:
+                self.client.tls_set(
+                    ca_certs=self.tls_ca_certs,
+                    certfile=self.tls_certfile,
+                    keyfile=self.tls_keyfile,
+                    cert_reqs=self.tls_cert_reqs,
+                    tls_version=self.tls_version,
+                    ciphers=self.tls_ciphers,
+                )
+
+                if self.tls_insecure:
+                    self.client.tls_insecure_set(self.tls_insecure)
+            except Exception as e:
+                logger.error(
+                    "TLS configuration failed for broker {0}:{1} - {2}: {3}".format(
+                        self.broker_url, self.broker_port, type(e).__name__, str(e)
                     )
+                )
+                raise
 
-                    if res == 0:
-                        logger.debug(
-                            "Connected client '{0}' to broker {1}:{2}".format(
-                                self.client_id, self.broker_url, self.broker_port
-                            )
-                        )
-                    else:
-                        error_messages = {
-                            MQTT_ERR_AGAIN: "Resource temporarily unavailable",
-                            MQTT_ERR_NOMEM: "Out of memory",
-                            MQTT_ERR_PROTOCOL: "Protocol error",
-                            MQTT_ERR_INVAL: "Invalid function arguments",
-                            MQTT_ERR_NO_CONN: "No connection to broker",
-                            MQTT_ERR_CONN_REFUSED: "Connection refused by broker",
-                            MQTT_ERR_NOT_FOUND: "Resource not found",
-                            MQTT_ERR_CONN_LOST: "Connection lost",
-                            MQTT_ERR_TLS: "TLS error",
-                            MQTT_ERR_PAYLOAD_SIZE: "Payload size error",
-                            MQTT_ERR_NOT_SUPPORTED: "Operation not supported",
-                            MQTT_ERR_AUTH: "Authentication failed",
-                            MQTT_ERR_ACL_DENIED: "ACL denied",
-                            MQTT_ERR_UNKNOWN: "Unknown error",
-                            MQTT_ERR_ERRNO: "System error",
-                            MQTT_ERR_QUEUE_SIZE: "Queue size exceeded",
-                        }
-                        error_msg = error_messages.get(res, "Unknown error")
-                        logger.error(
-                            "Failed to connect to MQTT broker {0}:{1} - Error {2}: {3}".format(
-                                self.broker_url, self.broker_port, res, error_msg
-                            )
-                        )
-                except OSError as e:
-                    logger.error(
-                        "Network error connecting to broker {0}:{1} (timeout: {2}s) - {3}".format(
-                            self.broker_url, self.broker_port, self.connection_timeout, str(e)
+    def _connect_kwargs(self) -> Dict[str, Any]:
+        kwargs: Dict[str, Any] = {"keepalive": self.keepalive}
+        if self.protocol_version == MQTTv5:
+            # MQTT 5 replaces clean session by clean start
+            kwargs["clean_start"] = self.clean_session
+            kwargs["properties"] = self.connect_properties
+        return kwargs
+
+    def _connect(self) -> None:
+        self._configure_client()
+        self._select_broker()
+
+        if self._connect_async:
+            # if connect_async is used
+            try:
+                self.client.connect_async(
+                    self.broker_url, self.broker_port, **self._connect_kwargs()
+                )
+            except Exception as e:
+                logger.error(
+                    "Failed to initiate async connection to broker {0}:{1} - {2}: {3}".format(
+                        self.broker_url, self.broker_port, type(e).__name__, str(e)
+                    )
+                )
+                raise
+        else:
+            try:
+                res = self.client.connect(
+                    self.broker_url, self.broker_port, **self._connect_kwargs()
+                )
+
+                if res == 0:
+                    logger.debug(
+                        "Connected client '{0}' to broker {1}:{2}".format(
+                            self.client_id, self.broker_url, self.broker_port
                         )
                     )
-                    raise
-                except Exception as e:
+                else:
+                    error_messages = {
+                        MQTT_ERR_AGAIN: "Resource temporarily unavailable",
+                        MQTT_ERR_NOMEM: "Out of memory",
+                        MQTT_ERR_PROTOCOL: "Protocol error",
+                        MQTT_ERR_INVAL: "Invalid function arguments",
+                        MQTT_ERR_NO_CONN: "No connection to broker",
+                        MQTT_ERR_CONN_REFUSED: "Connection refused by broker",
+                        MQTT_ERR_NOT_FOUND: "Resource not found",
+                        MQTT_ERR_CONN_LOST: "Connection lost",
+                        MQTT_ERR_TLS: "TLS error",
+                        MQTT_ERR_PAYLOAD_SIZE: "Payload size error",
+                        MQTT_ERR_NOT_SUPPORTED: "Operation not supported",
+                        MQTT_ERR_AUTH: "Authentication failed",
+                        MQTT_ERR_ACL_DENIED: "ACL denied",
+                        MQTT_ERR_UNKNOWN: "Unknown error",
+                        MQTT_ERR_ERRNO: "System error",
+                        MQTT_ERR_QUEUE_SIZE: "Queue size exceeded",
+                    }
+                    error_msg = error_messages.get(res, "Unknown error")
                     logger.error(
-                        "Unexpected error connecting to broker {0}:{1} - {2}: {3}".format(
-                            self.broker_url, self.broker_port, type(e).__name__, str(e)
+                        "Failed to connect to MQTT broker {0}:{1} - Error {2}: {3}".format(
+                            self.broker_url, self.broker_port, res, error_msg
                         )
                     )
-                    raise
-        finally:
-            # Restore original socket timeout
-            try:
-                socket.setdefaulttimeout(default_timeout)
-            except Exception:
-                pass
-        
+            except OSError as e:
+                logger.error(
+                    "Network error connecting to broker {0}:{1} (timeout: {2}s) - {3}".format(
+                        self.broker_url, self.broker_port, self.connection_timeout, str(e)
+                    )
+                )
+                raise
+            except Exception as e:
+                logger.error(
+                    "Unexpected error connecting to broker {0}:{1} - {2}: {3}".format(
+                        self.broker_url, self.broker_port, type(e).__name__, str(e)
+                    )
+                )
+                raise
+
         self.client.loop_start()
 
     def _disconnect(self) -> None:
+        _instances.discard(self)
+        if self._streams is not None:
+            # ends the streaming responses
+            self._streams.close()
         self.client.loop_stop()
+        # without the network thread paho writes the messages right away
+        self._coalescer.close(flush=self.coalesce_flush)
         self.client.disconnect()
+        if self.spool is not None:
+            self._flush_spool(self.spool)
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+            self._dispatcher = None
         logger.debug("Disconnected from Broker")
 
+    def _dispatch_wrapper(self, handler: Callable) -> Callable:
+        # hand the message over to the worker pool if one is configured,
+        # otherwise call the handler directly in the network thread
+        name = getattr(handler, "__name__", repr(handler))
+
+        def run(client: Client, userdata: Any, message: Any) -> None:
+            metrics = self.metrics
+            if metrics is None:
+                handler(client, userdata, message)
+                return
+            start = time.perf_counter()
+            try:
+                handler(client, userdata, message)
+            finally:
+                metrics.handler_seconds.observe(time.perf_counter() - start, name)
+
+        def run_in_context(client: Client, userdata: Any, message: Any) -> None:
+            self._push_app_context()
+            error: Optional[BaseException] = None
+            try:
+                run(client, userdata, message)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self._teardown_message(error)
+
+        @functools.wraps(handler)
+        def wrapper(client: Client, userdata: Any, message: Any) -> None:
+            target = run_in_context if self.app_context else run
+            if self._dispatcher is None:
+                target(client, userdata, message)
+            else:
+                self._dispatcher.submit(target, client, userdata, message)
+
+        return wrapper
+
+    def _push_app_context(self) -> None:
+        # pushed once per thread and kept, a push and pop per message is
+        # expensive at high message rates
+        app = current_app._get_current_object() if has_app_context() else None  # type: ignore
+        if app is self.app:
+            return
+        self.app.app_context().push()
+        logger.debug(
+            "Pushed application context in thread {0}".format(threading.current_thread().name)
+        )
+
+    def _teardown_message(self, error: Optional[BaseException]) -> None:
+        for teardown in self._teardown_handlers:
+            try:
+                teardown(error)
+            except Exception as e:
+                logger.error(
+                    "Exception in teardown handler {0}: {1}".format(
+                        getattr(teardown, "__name__", teardown), repr(e)
+                    )
+                )
+
+    def dispatch_stats(self) -> DispatchStats:
+        """Return queue depth and worker utilisation of the message dispatcher.
+
+        If no worker pool is configured via ``MQTT_DISPATCH_WORKERS`` all
+        values are 0 as handlers run directly in the network thread.
+
+        :rtype: DispatchStats
+        :result: (workers, busy_workers, queue_depth, queue_size)
+
+        """
+        if self._dispatcher is None:
+            return DispatchStats(workers=0, busy_workers=0, queue_depth=0, queue_size=0)
+        return self._dispatcher.stats()
+
     def _handle_connect(
-        self, client: Client, userdata: Any, flags: Dict[str, Any], rc: int
+        self, client: Client, userdata: Any, flags: Dict[str, Any], rc: int, *args: Any
     ) -> None:
+        # with MQTT 5 paho passes the CONNACK properties in args
         if rc == MQTT_ERR_SUCCESS:
+            with self._alias_lock:
+                self._topic_aliases.clear()
+                broker_maximum = getattr(args[0], "TopicAliasMaximum", 0) if args else 0
+                self._topic_alias_limit = min(self.topic_alias_maximum, broker_maximum)
             self.connected = True
-            for key, item in self.topics.items():
-                self.client.subscribe(topic=item.topic, qos=item.qos)
+            if self.metrics is not None:
+                self.metrics.connects.inc()
+                if self._connected_once:
+                    self.metrics.reconnects.inc()
+            self._connected_once = True
+            if self.outbound is not None:
+                for item in self.outbound.take_held():
+                    self._publish_message(
+                        item.topic,
+                        item.payload,
+                        item.qos,
+                        item.retain,
+                        item.future,
+                        item.size,
+                        item.properties,
+                    )
+            if self.spool is not None:
+                self._start_replay(self.spool)
+            # resubscribe with as few SUBSCRIBE packets as possible
+            if self.topics:
+                self._subscribe_batches(list(self.topics.values()))
+            if self._startup_buffer is not None:
+                self._flush_startup_buffer()
+            self._ready.set()
         if self._connect_handler is not None:
-            self._connect_handler(client, userdata, flags, rc)
-
-    def _handle_disconnect(self, client: Client, userdata: Any, rc: int) -> None:
+            if rc != MQTT_ERR_SUCCESS:
+                self._connect_handler(client, userdata, flags, rc, *args)
+                return
+            with self._subscribe_lock:
+                self._restored = set(self._subscribers)
+                self._restoring = threading.get_ident()
+            try:
+                self._connect_handler(client, userdata, flags, rc, *args)
+            finally:
+                with self._subscribe_lock:
+                    self._restored = set()
+                    self._restoring = None
+
+    def _handle_disconnect(self, client: Client, userdata: Any, rc: int, *args: Any) -> None:
+        with self._alias_lock:
+            self._topic_alias_limit = 0
+            self._topic_aliases.clear()
+        if self.spool is not None:
+            with self._spool_lock:
+                self._spooling = True
         self.connected = False
+        self._ready.clear()
+        if self.metrics is not None:
+            self.metrics.disconnects.inc()
+        # paho does not resend QoS 0 messages after a reconnect
+        with self._ack_lock:
+            lost = [mid for mid, entry in self._pending_acks.items() if entry[1] == 0]
+            entries = [self._pending_acks.pop(mid) for mid in lost]
+        for future, _, size in entries:
+            self._release(size)
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError("Connection to broker lost"))
         if self._disconnect_handler is not None:
-            self._disconnect_handler(client, userdata, rc)
+            self._disconnect_handler(client, userdata, rc, *args)
+        if rc != MQTT_ERR_SUCCESS:
+            self._fail_over()
+
+    def _handle_connect_fail(self, client: Client, userdata: Any) -> None:
+        # paho calls this if a reconnect could not open the connection
+        self._fail_over()
+
+    def _handle_message(self, client: Client, userdata: Any, message: Any) -> None:
+        # also without MQTT_COMPRESSION, the publisher decides
+        message = self._decompress(message)
+        if message is None:
+            return
+
+        try:
+            topic = message.topic
+            handlers = self._router.match(topic)
+            if self.metrics is not None:
+                self.metrics.messages_received.inc(topic)
+            codecs = self._codecs.match(topic) if len(self._codecs) else ()
+        except UnicodeDecodeError:
+            topic = None
+            handlers = codecs = ()
+
+        # decode the payload once for all handlers
+        if codecs:
+            try:
+                payload = codecs[0].decode(message.payload)
+                message = DecodedMessage(message, payload, codecs[0])
+            except Exception as e:
+                logger.error(
+                    "Error decoding message on topic {0} with codec {1}: {2}".format(
+                        message.topic, codecs[0].name, repr(e)
+                    )
+                )
+                return
+
+        if self.cache is not None and topic is not None:
+            self.cache.put(topic, message)
+
+        if self._streams is not None and topic is not None:
+            self._streams.publish(topic, message)
+            if self._stream_topics and self._streamed_only(topic):
+                return
+
+        if handlers:
+            for handler in handlers:
+                handler(client, userdata, message)
+        elif self._message_handler is not None:
+            self._message_handler(client, userdata, message)
+
+    def _decompress(self, message: Any) -> Any:
+        # returns the message, a DecompressedMessage or None on errors
+        try:
+            topic = message.topic
+        except UnicodeDecodeError:
+            return message
+        name = None
+        properties = getattr(message, "properties", None)
+        if properties is not None:
+            for key, value in getattr(properties, "UserProperty", ()):
+                if key == CONTENT_ENCODING:
+                    name = value
+                    break
+        if name is None:
+            head, marker, name = topic.rpartition("/$")
+            if not marker:
+                return message
+            topic = head
+        if name not in COMPRESSIONS and name not in self._decompressors:
+            # not compressed by Flask-MQTT
+            return message
+
+        try:
+            compressor = self._decompressors.get(name)
+            if compressor is None:
+                compressor = self._decompressors[name] = get_compressor(name)
+            payload = compressor.decompress(message.payload)
+        except Exception as e:
+            logger.error(
+                "Error decompressing message on topic {0} with {1}: {2}".format(
+                    message.topic, name, repr(e)
+                )
+            )
+            return None
+        return DecompressedMessage(message, topic, payload, compressor)
+
+    def _compress(
+        self,
+        compressor: Compressor,
+        topic: str,
+        payload: Any,
+        properties: Optional[Properties],
+    ) -> Tuple[str, Any, Optional[Properties]]:
+        if payload_size(payload) < self.compression_threshold:
+            return topic, payload, properties
+        data = to_bytes(payload)
+        compressed = compressor.compress(data)
+        if len(compressed) >= len(data):
+            return topic, payload, properties
+        if self.compression_marker == "property":
+            if properties is None:
+                properties = Properties(PacketTypes.PUBLISH)  # type: ignore[no-untyped-call]
+            else:
+                properties = copy.copy(properties)
+            properties.UserProperty = (CONTENT_ENCODING, compressor.name)
+        else:
+            topic = "{0}/${1}".format(topic, compressor.name)
+        return topic, compressed, properties
+
+    def _handle_publish(self, client: Client, userdata: Any, mid: int) -> None:
+        with self._ack_lock:
+            entry = self._pending_acks.pop(mid, None)
+            if entry is None and self._tracking:
+                # acknowledged before publish() could register the future
+                self._early_acks.add(mid)
+        if entry is not None:
+            future, _, size = entry
+            self._release(size)
+            if future is not None and not future.done():
+                future.set_result(mid)
+        if self.metrics is not None:
+            sent = self._publish_times.pop(mid, None)
+            if sent is not None:
+                self.metrics.publish_ack_seconds.observe(time.perf_counter() - sent)
+        if self._publish_handler is not None:
+            self._publish_handler(client, userdata, mid)
+
+    def _handle_subscribe(
+        self,
+        client: Client,
+        userdata: Any,
+        mid: int,
+        granted_qos: Tuple[int, ...],
+        *args: Any,
+    ) -> None:
+        # with MQTT 5 granted_qos holds reason codes and args the properties
+        if self._subscribe_handler is not None:
+            self._subscribe_handler(client, userdata, mid, granted_qos, *args)
+
+    def _handle_unsubscribe(self, client: Client, userdata: Any, mid: int, *args: Any) -> None:
+        if self._unsubscribe_handler is not None:
+            self._unsubscribe_handler(client, userdata, mid, *args)
+
+    def register_codec(self, topic: str, codec: Union[str, Codec]) -> Codec:
+        """
+        Register a payload codec for a topic filter.
+
+        :param topic: the topic filter the codec applies to, wildcards are
+                      allowed
+        :param codec: ``"raw"``, ``"json"``, ``"msgpack"``, ``"cbor"`` or a
+                      :class:`flask_mqtt.codecs.Codec` instance
+
+        The payload of received messages matching the filter is decoded once
+        and all handlers receive a :class:`flask_mqtt.codecs.DecodedMessage`
+        whose ``payload`` is the decoded object. Objects published to a
+        matching topic with :meth:`publish` are encoded with the codec unless
+        they are already ``bytes``. If several filters match, the codec
+        registered first is used. The ``$share/<group>/`` prefix of a shared
+        subscription is ignored.
+
+        **Example usage:**::
+
+            mqtt.register_codec('sensors/#', 'json')
+
+            @mqtt.on_topic('sensors/+/temperature')
+            def handle_temperature(client, userdata, message):
+                print(message.payload['value'])
+
+            mqtt.publish('sensors/kitchen/temperature', {'value': 21.5})
+
+        """
+        instance = get_codec(codec)
+        self._codecs.add(strip_share(topic), instance)
+        return instance
+
+    def coalesce(self, topic: str, interval: float) -> None:
+        """
+        Limit the publish rate of the topics matching a topic filter.
+
+        :param topic: the topic filter, wildcards are allowed
+        :param interval: minimum time in seconds between two messages of a
+                         topic
 
-    def on_topic(self, topic: str) -> Callable:
+        A message published with :meth:`publish` is sent right away if no
+        message of its topic has been sent within *interval*. Otherwise it is
+        held back and replaced by newer messages of the topic, and only the
+        newest one is sent when the interval has passed. Rates apply to each
+        topic separately. If several filters match, the filter registered
+        first is used. Messages published with ``track=True`` are not
+        coalesced.
+
+        **Example usage:**::
+
+            mqtt.coalesce('sensors/#', 0.1)
+
+            for value in readings:
+                # sends at most 10 messages per second and sensor
+                mqtt.publish('sensors/kitchen/temperature', value)
+
+        """
+        if interval <= 0:
+            raise ValueError("interval must be greater than 0")
+        self._coalesce.add(topic, interval)
+
+    def flush_coalesced(self) -> None:
+        """Send all messages held back by :meth:`coalesce` now."""
+        self._coalescer.flush()
+
+    def _publish_coalesced(
+        self,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        properties: Optional[Properties],
+    ) -> None:
+        self._publish(topic, payload, qos, retain, False, properties)
+
+    def _encode(self, topic: str, payload: Any) -> Any:
+        if isinstance(payload, (bytes, bytearray)):
+            return payload
+        codecs = self._codecs.match(topic)
+        if codecs:
+            return codecs[0].encode(payload)
+        return payload
+
+    def on_topic(self, topic: str, codec: Optional[Union[str, Codec]] = None) -> Callable:
         """Decorator.
 
         Decorator to add a callback function that is called when a certain
@@ -358,11 +1372,24 @@ class Mqtt:
 
         :parameter topic: a string specifying the subscription topic to
             subscribe to
+        :parameter codec: if given the codec is registered for the topic with
+            :meth:`register_codec`
 
         The topic still needs to be subscribed via mqtt.subscribe() before the
         callback function can be used to handle a certain topic. This way it is
         possible to subscribe and unsubscribe during runtime.
 
+        Incoming messages are matched against the topic filters in a topic
+        tree, so the matching cost does not grow with the number of handlers.
+        Registering a handler for the same topic again replaces the previous
+        one. For shared subscriptions the handler matches the topic without
+        the ``$share/<group>/`` prefix, which is the topic of the received
+        messages.
+
+        If ``MQTT_DISPATCH_WORKERS`` is set the callback is executed by a
+        worker thread instead of the network thread. Messages may then be
+        handled concurrently and out of order.
+
         **Example usage:**::
 
             app = Flask(__name__)
@@ -376,7 +1403,9 @@ class Mqtt:
         """
 
         def decorator(handler: Callable[[str], None]) -> Callable[[str], None]:
-            self.client.message_callback_add(topic, handler)
+            if codec is not None:
+                self.register_codec(topic, codec)
+            self._router.add(strip_share(topic), self._dispatch_wrapper(handler))
             return handler
 
         return decorator
@@ -407,62 +1436,201 @@ class Mqtt:
 
         **Topic example:** `myhome/groundfloor/livingroom/temperature`
 
-        """
-        # TODO: add support for list of topics
+        If ``MQTT_SHARED_GROUP`` is set the topic is subscribed as the shared
+        subscription ``$share/<group>/<topic>``.
 
-        # don't subscribe if already subscribed
-        # try to subscribe
-        result, mid = self.client.subscribe(topic=topic, qos=qos)
+        Subscriptions are counted per topic. Subscribing to a topic that is
+        already subscribed with the same or a higher QoS sends no SUBSCRIBE
+        packet and returns (MQTT_ERR_SUCCESS, 0). The topic stays subscribed
+        until :meth:`unsubscribe` has been called as often as
+        :meth:`subscribe`.
 
-        # if successful add to topics
-        if result == MQTT_ERR_SUCCESS:
-            if isinstance(topic, tuple):
-                topic, qos = topic
-                self.topics[topic] = TopicQos(topic=topic, qos=qos)
+        """
+        if self._fork_pending:
+            self._resume_after_fork()
+        if isinstance(topic, tuple):
+            topic = (self._shared(topic[0]), topic[1])
+        elif isinstance(topic, list):
+            topic = [(self._shared(t), q) for t, q in topic]
+        else:
+            topic = self._shared(topic)
+        ret = self._subscribe(topic, qos)
+        self._sync_streams()
+        return ret
+
+    def _subscribe(self, topic: Any, qos: int) -> Tuple[int, int]:
+        if isinstance(topic, tuple):
+            requested = [TopicQos(*topic)]
+        elif isinstance(topic, list):
+            requested = [TopicQos(t, q) for t, q in topic]
+        else:
+            requested = [TopicQos(topic=topic, qos=qos)]
+
+        mid: Optional[int] = 0
+        # the lock makes only the first subscriber of a topic send a SUBSCRIBE
+        with self._subscribe_lock:
+            pending = self._pending_subscriptions(requested)
+            if not pending:
+                result = MQTT_ERR_SUCCESS
             elif isinstance(topic, list):
-                for t, q in topic:
-                    self.topics[t] = TopicQos(topic=t, qos=q)
+                result, mid = self.client.subscribe(
+                    topic=[(t, q) for t, q in pending], qos=qos
+                )
+            elif isinstance(topic, tuple):
+                result, mid = self.client.subscribe(topic=topic, qos=qos)
             else:
-                self.topics[topic] = TopicQos(topic=topic, qos=qos)
-            logger.debug("Subscribed to topic: {0}, qos: {1}".format(topic, qos))
-        else:
-            logger.error("Error {0} subscribing to topic: {1}".format(result, topic))
+                result, mid = self.client.subscribe(topic=topic, qos=qos)
+
+            # if successful add to topics
+            if result == MQTT_ERR_SUCCESS:
+                for item in pending:
+                    self.topics[item.topic] = item
+                if pending:
+                    logger.debug("Subscribed to topic: {0}, qos: {1}".format(topic, qos))
+            else:
+                logger.error("Error {0} subscribing to topic: {1}".format(result, topic))
+            self._count_subscribers(requested)
 
         return result, mid
 
-    def unsubscribe(self, topic: str) -> Optional[Tuple[int, int]]:
+    def _pending_subscriptions(self, subscriptions: List[TopicQos]) -> List[TopicQos]:
+        # a subscribed topic is only sent again to raise its QoS
+        pending = []
+        for item in subscriptions:
+            current = self.topics.get(item.topic)
+            if current is None or item.qos > current.qos:
+                pending.append(item)
+        return pending
+
+    def _count_subscribers(self, subscriptions: List[TopicQos]) -> None:
+        # failed subscriptions of new topics are not counted
+        restoring = self._restoring == threading.get_ident()
+        for item in subscriptions:
+            if restoring and item.topic in self._restored:
+                # the subscription of the last connection is made again
+                self._restored.discard(item.topic)
+            elif item.topic in self.topics:
+                self._subscribers[item.topic] = self._subscribers.get(item.topic, 0) + 1
+
+    def subscribe_many(
+        self, topics: Iterable[Union[str, Tuple[str, int]]], qos: int = 0
+    ) -> Tuple[int, List[Optional[int]]]:
         """
-        Unsubscribe from a single topic.
+        Subscribe to many topics with multi-topic SUBSCRIBE packets.
 
-        :param topic: a single string that is the subscription topic to
-                      unsubscribe from
+        :param topics: an iterable of topic strings or (topic, qos) tuples
+        :param qos: the quality of service level for topics given as plain
+                    strings. Defaults to 0.
 
-        :rtype: (int, int)
-        :result: (result, mid)
+        :rtype: (int, list)
+        :result: (result, mids)
 
-        Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS
+        The topics are split into packets of at most
+        ``MQTT_SUBSCRIBE_BATCH_SIZE`` topics. result is MQTT_ERR_SUCCESS if
+        all packets have been sent, otherwise the error code of the first
+        failed packet. mids holds the message ID of each SUBSCRIBE packet.
+        Topics that are already subscribed are counted like in
+        :meth:`subscribe` but not sent again.
+
+        """
+        if self._fork_pending:
+            self._resume_after_fork()
+        subscriptions = [
+            TopicQos(topic=self._shared(t), qos=qos)
+            if isinstance(t, str)
+            else TopicQos(self._shared(t[0]), t[1])
+            for t in topics
+        ]
+        with self._subscribe_lock:
+            result, mids = self._subscribe_batches(self._pending_subscriptions(subscriptions))
+            self._count_subscribers(subscriptions)
+        self._sync_streams()
+        return result, mids
+
+    def _shared(self, topic: str) -> str:
+        # topics starting with "$" are already shared or system topics
+        if self.shared_group is None or topic.startswith("$"):
+            return topic
+        return "$share/{0}/{1}".format(self.shared_group, topic)
+
+    def _subscribe_batches(self, subscriptions: List[TopicQos]) -> Tuple[int, List[Optional[int]]]:
+        result = MQTT_ERR_SUCCESS
+        mids: List[Optional[int]] = []
+        size = max(1, self.subscribe_batch_size)
+        for i in range(0, len(subscriptions), size):
+            batch = subscriptions[i : i + size]
+            # TopicQos is a (topic, qos) tuple
+            rc, mid = self.client.subscribe(cast(List[Tuple[str, int]], batch))
+            mids.append(mid)
+            if rc == MQTT_ERR_SUCCESS:
+                for item in batch:
+                    self.topics[item.topic] = item
+                logger.debug("Subscribed to {0} topics".format(len(batch)))
+            else:
+                logger.error(
+                    "Error {0} subscribing to {1} topics".format(rc, len(batch))
+                )
+                if result == MQTT_ERR_SUCCESS:
+                    result = rc
+        return result, mids
+
+    def unsubscribe(self, topic: str) -> Optional[Tuple[int, int]]:
+        """
+        Unsubscribe from a single topic.
+
+        :param topic: a single string that is the subscription topic to
+                      unsubscribe from
+
+        :rtype: (int, int)
+        :result: (result, mid)
+
+        Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS
         to indicate success or (MQTT_ERR_NO_CONN, None) if the client is not
         currently connected.
         mid is the message ID for the unsubscribe request. The mid value can be
         used to track the unsubscribe request by checking against the mid
         argument in the on_unsubscribe() callback if it is defined.
 
+        If :meth:`subscribe` has been called more often for the topic, only
+        the count is decreased and (MQTT_ERR_SUCCESS, 0) is returned without
+        sending an UNSUBSCRIBE packet.
+
         """
-        # don't unsubscribe if not in topics
-        if topic in self.topics:
+        ret = self._unsubscribe(self._shared(topic))
+        self._sync_streams()
+        return ret
+
+    def _unsubscribe(self, topic: str) -> Optional[Tuple[int, int]]:
+        with self._subscribe_lock:
+            # don't unsubscribe if not in topics
+            if topic not in self.topics:
+                return None
+            # topics subscribed on connect or by request() are not counted
+            count = self._subscribers.get(topic, 1)
+            if count > 1:
+                self._subscribers[topic] = count - 1
+                logger.debug(
+                    "Topic {0} has {1} more subscribers".format(topic, count - 1)
+                )
+                return MQTT_ERR_SUCCESS, 0
+
             result, mid = self.client.unsubscribe(topic)
 
+            # if successful remove from topics
             if result == MQTT_ERR_SUCCESS:
                 self.topics.pop(topic)
+                self._subscribers.pop(topic, None)
+                if self.cache is not None:
+                    # topics of other subscribed filters stay cached
+                    self.cache.discard(
+                        strip_share(topic), keep=[strip_share(t) for t in self.topics]
+                    )
                 logger.debug("Unsubscribed from topic: {0}".format(topic))
             else:
                 logger.debug(
                     "Error {0} unsubscribing from topic: {1}".format(result, topic)
                 )
-
-            # if successful remove from topics
             return result, mid
-        return None
 
     def unsubscribe_all(self) -> None:
         """
@@ -471,9 +1639,13 @@ class Mqtt:
         Returns True if all topics are unsubscribed from self.topics, otherwise False
 
         """
-        topics = list(self.topics.keys())
+        with self._subscribe_lock:
+            # regardless of the number of subscribers
+            self._subscribers.clear()
+            topics = list(self.topics.keys())
         for topic in topics:
-            self.unsubscribe(topic)
+            self._unsubscribe(topic)
+        self._sync_streams()
 
         if not len(self.topics):
             return True
@@ -485,7 +1657,9 @@ class Mqtt:
         payload: Optional[bytes] = None,
         qos: int = 0,
         retain: bool = False,
-    ) -> Tuple[int, int]:
+        track: bool = False,
+        properties: Optional[Properties] = None,
+    ) -> Union[Tuple[int, int], PublishFuture]:
         """
         Send a message to the broker.
 
@@ -495,31 +1669,1099 @@ class Mqtt:
                         int or float will result in the payload being
                         converted to a string representing that number.
                         If you wish to send a true int/float, use struct.pack()
-                        to create the payload you require.
+                        to create the payload you require. If a codec is
+                        registered for the topic any object accepted by the
+                        codec may be passed.
         :param qos: the quality of service level to use
         :param retain: if set to True, the message will be set as the
                        "last known good"/retained message for the topic
+        :param track: if set to True a :class:`PublishFuture` is returned
+                      that resolves when the broker acknowledged the message
+        :param properties: MQTT 5 PUBLISH properties, e.g. ``MessageExpiryInterval``
+                           or ``UserProperty``
 
         :returns: Returns a tuple (result, mid), where result is
                   MQTT_ERR_SUCCESS to indicate success or MQTT_ERR_NO_CONN
                   if the client is not currently connected. mid is the message
-                  ID for the publish request.
+                  ID for the publish request, 0 if the message is held back
+                  by :meth:`coalesce` or buffered until the first connect
+                  (``MQTT_STARTUP_BUDGET``).
+
+        **Example usage:**::
+
+            future = mqtt.publish('home/mytopic', 'on', qos=1, track=True)
+            future.result(timeout=5)  # raises TimeoutError if not acknowledged
 
         """
-        result, mid = self.client.publish(topic, payload, qos, retain)
+        if len(self._coalesce) and not track:
+            # encoded when it is sent, replaced messages are never encoded
+            intervals = self._coalesce.match(topic)
+            if intervals and self._coalescer.put(
+                topic, intervals[0], payload, qos, retain, properties
+            ):
+                return MQTT_ERR_SUCCESS, 0
+        return self._publish(topic, payload, qos, retain, track, properties)
+
+    def _publish(
+        self,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        track: bool,
+        properties: Optional[Properties],
+    ) -> Union[Tuple[int, int], PublishFuture]:
+        if self._startup_buffer is not None:
+            held = self._hold_until_connected(topic, payload, qos, retain, properties, track)
+            if held is not None:
+                return held
+        if len(self._codecs):
+            payload = self._encode(topic, payload)
+        if self.compressor is not None:
+            topic, payload, properties = self._compress(
+                self.compressor, topic, payload, properties
+            )
+        metrics = self.metrics
+        if metrics is not None:
+            sent = time.perf_counter()
+        info = self._send(topic, payload, qos, retain, properties, track)
+        result, mid = info
+        if metrics is not None:
+            self._count_publish(metrics, topic, result, mid, sent)
+
         if result == MQTT_ERR_SUCCESS:
             logger.debug("Published topic {0}: {1}".format(topic, payload))
+        elif result == MQTT_ERR_NO_CONN and qos > 0:
+            logger.debug("Queued topic {0} until the client is connected".format(topic))
         else:
             logger.error("Error {0} publishing topic {1}".format(result, topic))
 
+        if track:
+            return info
         return result, mid
 
+    def _hold_until_connected(
+        self,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        properties: Optional[Properties],
+        track: bool,
+    ) -> Any:
+        # buffer or reject a message published before the first connect,
+        # returns None if the client has connected meanwhile
+        if self._fork_pending:
+            self._resume_after_fork()
+        with self._startup_lock:
+            buffer = self._startup_buffer
+            if buffer is None:
+                return None
+            if self.startup_policy == "reject":
+                logger.debug("Rejected topic {0}, not connected yet".format(topic))
+                if track:
+                    rejected = PublishFuture(MQTT_ERR_NO_CONN, 0)
+                    rejected.set_exception(ConnectionError("Not connected to the broker yet"))
+                    return rejected
+                return MQTT_ERR_NO_CONN, 0
+            if self.startup_buffer_size and len(buffer) >= self.startup_buffer_size:
+                dropped = buffer.popleft()
+                logger.warning(
+                    "Startup buffer full, dropped message on topic {0}".format(dropped[0])
+                )
+                if dropped[5] is not None:
+                    dropped[5].set_exception(ConnectionError("Message dropped"))
+            future = PublishFuture(MQTT_ERR_SUCCESS, 0) if track else None
+            buffer.append((topic, payload, qos, retain, properties, future))
+        logger.debug("Buffered topic {0} until the first connect".format(topic))
+        return future if future is not None else (MQTT_ERR_SUCCESS, 0)
+
+    def _flush_startup_buffer(self) -> None:
+        # the lock keeps messages published meanwhile behind the buffered ones
+        with self._startup_lock:
+            buffer, self._startup_buffer = self._startup_buffer, None
+            for topic, payload, qos, retain, properties, future in buffer or ():
+                info = self._publish(topic, payload, qos, retain, future is not None, properties)
+                if future is not None:
+                    self._chain_future(cast(PublishFuture, info), future)
+
+    @staticmethod
+    def _chain_future(source: PublishFuture, target: PublishFuture) -> None:
+        target.rc, target.mid = source.rc, source.mid
+
+        def copy_result(future: ConcurrentFuture) -> None:
+            if future.cancelled():
+                target.cancel()
+            elif future.exception() is not None:
+                target.set_exception(future.exception())
+            else:
+                target.set_result(future.result())
+
+        source.add_done_callback(copy_result)
+
+    def _count_publish(
+        self, metrics: Metrics, topic: str, result: int, mid: int, sent: float
+    ) -> None:
+        if result == MQTT_ERR_SUCCESS:
+            metrics.messages_published.inc(topic)
+            # entries of messages that are never acknowledged are replaced
+            # when paho reuses the mid
+            self._publish_times[mid] = sent
+        else:
+            metrics.publish_errors.inc()
+
+    def _send(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Optional[Properties] = None,
+        track: bool = False,
+    ) -> Any:
+        # returns a PublishFuture if track is set, otherwise (result, mid)
+        if self.spool is not None and qos > 0:
+            info = self._spool_message(
+                self.spool, topic, payload, qos, retain, properties, track
+            )
+            if info is not None:
+                return info
+        return self._send_now(topic, payload, qos, retain, properties, track)
+
+    def _send_now(
+        self,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        properties: Optional[Properties],
+        track: bool,
+    ) -> Any:
+        if self.outbound is not None:
+            return self._send_outbound(
+                self.outbound, topic, payload, qos, retain, properties, track
+            )
+        if track:
+            future = PublishFuture(MQTT_ERR_SUCCESS, 0)
+            self._publish_message(topic, payload, qos, retain, future, None, properties)
+            return future
+        return self._client_publish(topic, payload, qos, retain, properties)
+
+    def _client_publish(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Optional[Properties] = None,
+    ) -> Any:
+        if not self._topic_alias_limit or qos > 0:
+            # paho resends QoS > 0 messages after a reconnect, when the
+            # aliases of the previous connection are no longer valid
+            if properties is None:
+                return self.client.publish(topic, payload, qos, retain)
+            return self.client.publish(topic, payload, qos, retain, properties)
+
+        # replace the topic by an alias, the lock keeps the PUBLISH packet
+        # defining an alias in front of the packets using it
+        with self._alias_lock:
+            aliases = self._topic_aliases
+            alias = aliases.get(topic)
+            if alias is not None:
+                aliases.move_to_end(topic)
+                wire_topic = ""
+            elif self._topic_alias_limit:
+                if len(aliases) < self._topic_alias_limit:
+                    alias = len(aliases) + 1
+                else:
+                    _, alias = aliases.popitem(last=False)
+                aliases[topic] = alias
+                wire_topic = topic
+            else:
+                # disconnected since the first check
+                return self.client.publish(topic, payload, qos, retain, properties)
+
+            if properties is None:
+                properties = Properties(PacketTypes.PUBLISH)  # type: ignore[no-untyped-call]
+            else:
+                properties = copy.copy(properties)
+            properties.TopicAlias = alias
+            rc, mid = self.client.publish(wire_topic, payload, qos, retain, properties)
+            if rc != MQTT_ERR_SUCCESS and wire_topic:
+                # the alias has not been defined at the broker
+                del aliases[topic]
+        return rc, mid
+
+    def _send_outbound(
+        self,
+        outbound: OutboundQueue,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        properties: Optional[Properties],
+        track: bool,
+    ) -> Any:
+        size = payload_size(payload)
+        future = PublishFuture(MQTT_ERR_SUCCESS, 0) if track else None
+        # never block the network thread, it is needed to free the queue
+        block = not self._in_network_thread()
+        admitted, dropped = outbound.acquire(size, block=block)
+        rc: int
+        mid: int
+        for item in dropped:
+            logger.warning("Outbound queue full, dropped message on topic {0}".format(item.topic))
+            if item.future is not None:
+                item.future.set_exception(OutboundQueueFull("Message dropped"))
+
+        if not admitted:
+            if not block and outbound.policy == "block":
+                logger.warning(
+                    "Outbound queue full, rejected message on topic {0} instead of "
+                    "blocking the network thread".format(topic)
+                )
+            rc, mid = MQTT_ERR_QUEUE_SIZE, 0
+            if future is not None:
+                future.rc = rc
+                future.set_exception(OutboundQueueFull("Outbound queue full"))
+        elif qos > 0 and outbound.hold(
+            OutboundMessage(topic, payload, qos, retain, size, future, properties),
+            lambda: not self.connected,
+        ):
+            # held back until the next connect
+            rc, mid = MQTT_ERR_NO_CONN, 0
+            if future is not None:
+                future.rc = rc
+        else:
+            rc, mid = self._publish_message(
+                topic, payload, qos, retain, future, size, properties
+            )
+        return future if future is not None else (rc, mid)
+
+    def _spool_message(
+        self,
+        spool: Spool,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        properties: Optional[Properties],
+        track: bool,
+    ) -> Any:
+        # store the message on disk while disconnected or while older
+        # messages are replayed, returns None if it can be sent right away
+        future = None
+        with self._spool_lock:
+            if not self._spooling and self.connected:
+                return None
+            packed = None
+            if properties is not None:
+                packed = properties.pack()  # type: ignore[no-untyped-call]
+            id = spool.append(topic, payload, qos, retain, packed)
+            if track:
+                future = PublishFuture(MQTT_ERR_NO_CONN, 0)
+                self._spool_futures[id] = future
+        return future if future is not None else (MQTT_ERR_NO_CONN, 0)
+
+    def _start_replay(self, spool: Spool) -> None:
+        with self._spool_lock:
+            self._spool_generation += 1
+            generation = self._spool_generation
+        thread = threading.Thread(
+            target=self._replay_spool,
+            args=(spool, generation, self._spool_thread),
+            name="flask-mqtt-spool-replay",
+            daemon=True,
+        )
+        self._spool_thread = thread
+        thread.start()
+
+    def _replay_spool(
+        self, spool: Spool, generation: int, previous: Optional[threading.Thread] = None
+    ) -> None:
+        # runs in its own thread so the network thread is free to process
+        # the acknowledgements and the outbound queue may block
+        if previous is not None:
+            previous.join()
+        interval = 1.0 / self.spool_replay_rate if self.spool_replay_rate > 0 else 0.0
+        next_send = time.monotonic()
+        replayed = 0
+        while True:
+            with self._spool_lock:
+                if generation != self._spool_generation or not self.connected:
+                    return
+                batch = spool.read(self._spool_cursor)
+                if not batch:
+                    self._spooling = False
+                    break
+                self._spool_cursor = batch[-1].id
+            for message in batch:
+                if generation != self._spool_generation or not self.connected:
+                    # continue with this message after the next connect
+                    with self._spool_lock:
+                        self._spool_cursor = min(self._spool_cursor, message.id - 1)
+                    return
+                if interval:
+                    now = time.monotonic()
+                    if now < next_send:
+                        time.sleep(next_send - now)
+                    else:
+                        next_send = now
+                    next_send += interval
+                properties = None
+                if message.properties is not None:
+                    properties = Properties(PacketTypes.PUBLISH)  # type: ignore[no-untyped-call]
+                    properties.unpack(message.properties)  # type: ignore[no-untyped-call]
+                future = self._send_now(
+                    message.topic,
+                    message.payload,
+                    message.qos,
+                    message.retain,
+                    properties,
+                    True,
+                )
+                future.add_done_callback(
+                    functools.partial(self._handle_replayed, spool, message.id)
+                )
+                replayed += 1
+            self._flush_spool(spool)
+        if replayed:
+            logger.debug("Replayed {0} spooled messages".format(replayed))
+
+    def _handle_replayed(self, spool: Spool, id: int, future: ConcurrentFuture) -> None:
+        future = cast(PublishFuture, future)
+        failed = future.cancelled() or future.exception() is not None
+        with self._spool_lock:
+            tracked = self._spool_futures.pop(id, None)
+            if not failed:
+                self._spool_acked.append(id)
+            flush = len(self._spool_acked) >= spool.batch_size or not self._spooling
+        if failed:
+            logger.warning(
+                "Spooled message {0} could not be published and stays in the spool".format(id)
+            )
+        elif flush:
+            self._flush_spool(spool)
+        if tracked is not None and not tracked.done():
+            tracked.rc, tracked.mid = future.rc, future.mid
+            if failed:
+                tracked.set_exception(RuntimeError("Message publish failed"))
+            else:
+                tracked.set_result(future.mid)
+
+    def _flush_spool(self, spool: Spool) -> None:
+        # delete acknowledged messages in one transaction
+        with self._spool_lock:
+            ids, self._spool_acked = self._spool_acked, []
+        spool.delete(ids)
+
+    def _in_network_thread(self) -> bool:
+        return threading.current_thread() is getattr(self.client, "_thread", None)
+
+    def _release(self, size: Optional[int]) -> None:
+        if size is not None and self.outbound is not None:
+            self.outbound.release(size)
+
+    def _publish_message(
+        self,
+        topic: str,
+        payload: Any,
+        qos: int,
+        retain: bool,
+        future: Optional[PublishFuture] = None,
+        size: Optional[int] = None,
+        properties: Optional[Properties] = None,
+    ) -> Tuple[int, int]:
+        # publish and register the message so its acknowledgement resolves
+        # the future and frees its space in the outbound queue. paho may
+        # acknowledge the message in the network thread before
+        # client.publish() returns, so acks are recorded while this runs.
+        with self._ack_lock:
+            self._tracking += 1
+        try:
+            rc, mid = self._client_publish(topic, payload, qos, retain, properties)
+        except Exception:
+            with self._ack_lock:
+                self._tracking -= 1
+            self._release(size)
+            raise
+
+        if future is not None:
+            future.rc, future.mid = rc, mid
+        queued = rc == MQTT_ERR_SUCCESS or (rc == MQTT_ERR_NO_CONN and qos > 0)
+        acked = False
+        with self._ack_lock:
+            if queued:
+                if mid in self._early_acks:
+                    self._early_acks.discard(mid)
+                    acked = True
+                else:
+                    self._pending_acks[mid] = (future, qos, size)
+            self._tracking -= 1
+            if not self._tracking:
+                self._early_acks.clear()
+
+        if not queued:
+            self._release(size)
+            if future is not None:
+                future.set_exception(
+                    RuntimeError("Message publish failed: {0}".format(error_string(rc)))
+                )
+        elif acked:
+            self._release(size)
+            if future is not None:
+                future.set_result(mid)
+        elif future is not None:
+            future.add_done_callback(self._discard_ack)
+        return rc, mid
+
+    def _discard_ack(self, future: ConcurrentFuture) -> None:
+        # forget cancelled futures, e.g. after an asyncio timeout
+        future = cast(PublishFuture, future)
+        if future.cancelled():
+            with self._ack_lock:
+                entry = self._pending_acks.get(future.mid)
+                if entry is not None and entry[0] is future:
+                    if entry[2] is None:
+                        del self._pending_acks[future.mid]
+                    else:
+                        # keep the entry to free the outbound queue on the ack
+                        self._pending_acks[future.mid] = (None, entry[1], entry[2])
+
+    def last(self, topic: str, default: Any = None) -> Any:
+        """
+        Return the last message received on a topic.
+
+        :param topic: the topic, wildcards are not allowed
+        :param default: returned if no message has been received
+
+        Requires ``MQTT_CACHE_ENABLED``. The message is the one passed to the
+        handlers, i.e. a :class:`flask_mqtt.codecs.DecodedMessage` if a codec
+        is registered for the topic. Reading does not block the network
+        thread, so it is cheap enough to be called from every request.
+
+        **Example usage:**::
+
+            @app.route('/temperature')
+            def temperature():
+                message = mqtt.last('home/kitchen/temperature')
+                return message.payload if message is not None else ('', 404)
+
+        """
+        return self._cache().get(topic, default)
+
+    def last_matching(self, topic_filter: str) -> Dict[str, Any]:
+        """
+        Return the last messages of all cached topics matching a topic filter.
+
+        :param topic_filter: the topic filter, wildcards are allowed
+
+        :returns: a dictionary mapping the topics to their last message
+
+        """
+        return self._cache().match(topic_filter)
+
+    def cache_stats(self) -> Optional[CacheStats]:
+        """Return the occupancy of the last-value cache.
+
+        Returns None if ``MQTT_CACHE_ENABLED`` is not set.
+
+        :rtype: CacheStats
+        :result: (entries, bytes, max_entries, max_bytes)
+
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def _cache(self) -> LastValueCache:
+        if self.cache is None:
+            raise RuntimeError("The last-value cache requires MQTT_CACHE_ENABLED")
+        return self.cache
+
+    def listen(
+        self, topic_filter: str, qos: int = 0, queue_size: Optional[int] = None
+    ) -> Listener:
+        """
+        Return a listener receiving the messages of a topic filter.
+
+        :param topic_filter: the topic filter, wildcards are allowed
+        :param qos: the QoS of the subscription
+        :param queue_size: maximum number of messages waiting to be read,
+                           defaults to ``MQTT_STREAM_QUEUE_SIZE``
+
+        :rtype: Listener
+
+        All listeners of a topic filter share one subscription, which is
+        made for the first listener and removed when the last one is
+        closed. The subscription counts like a call of :meth:`subscribe`,
+        so a filter that is also subscribed by the application is neither
+        subscribed again nor removed. Messages that arrive only for
+        listeners are not passed to the message handlers. If a listener does
+        not keep up the oldest messages in its queue are dropped. The
+        listener must be closed when it is not used anymore.
+
+        With ``MQTT_SHARED_GROUP`` the filter is not shared, so the listeners
+        receive every message. If a shared subscription of the application
+        covers the filter it is used instead, then the listeners receive
+        only the messages delivered to this process, but the handlers of
+        the other processes are not bypassed. A filter that overlaps a
+        shared subscription only in part gets its own subscription, the
+        messages of the overlap are handled in every process listening to
+        it.
+
+        **Example usage:**::
+
+            with mqtt.listen('home/+/temperature') as listener:
+                message = listener.get(timeout=10)
+
+        """
+        if queue_size is None:
+            queue_size = self.stream_queue_size
+        listener = Listener(topic_filter, queue_size)
+        listener.on_close = self._close_listener
+        with self._stream_lock:
+            if self._streams is None:
+                self._streams = StreamHub()
+            if self._streams.add(listener):
+                self._stream_qos[topic_filter] = qos
+                self._subscribe_stream(topic_filter)
+        return listener
+
+    def _close_listener(self, listener: Listener) -> None:
+        with self._stream_lock:
+            if self._streams is None or not self._streams.remove(listener):
+                return
+            topic = listener.topic_filter
+            self._stream_qos.pop(topic, None)
+            if topic in self._stream_topics:
+                self._unsubscribe_stream(topic)
+
+    def _subscribe_stream(self, topic_filter: str) -> None:
+        # called with the stream lock held
+        with self._subscribe_lock:
+            if self._covering_subscription(topic_filter) is not None:
+                # the messages arrive with the shared subscription
+                return
+            qos = self._stream_qos[topic_filter]
+            # not shared, every process needs all messages
+            result, _ = self._subscribe(topic_filter, qos)
+            if result == MQTT_ERR_NO_CONN:
+                # subscribed on the next connect
+                subscription = TopicQos(topic=topic_filter, qos=qos)
+                self.topics[topic_filter] = subscription
+                self._count_subscribers([subscription])
+            self._stream_topics.add(topic_filter)
+
+    def _unsubscribe_stream(self, topic_filter: str) -> None:
+        # called with the stream lock held
+        self._stream_topics.discard(topic_filter)
+        with self._subscribe_lock:
+            ret = self._unsubscribe(topic_filter)
+            if ret is not None and ret[0] == MQTT_ERR_NO_CONN:
+                # not subscribed again on the next connect
+                self.topics.pop(topic_filter, None)
+                self._subscribers.pop(topic_filter, None)
+
+    def _covering_subscription(self, topic_filter: str) -> Optional[str]:
+        # a shared subscription of the application receiving all messages of the filter
+        if self.shared_group is None:
+            return None
+        prefix = "$share/{0}/".format(self.shared_group)
+        for topic in self.topics:
+            if topic.startswith(prefix) and filter_covers(topic[len(prefix):], topic_filter):
+                return topic
+        return None
+
+    def _sync_streams(self) -> None:
+        # hands streamed filters over to shared subscriptions made or removed later
+        if self._streams is None or self.shared_group is None:
+            return
+        with self._stream_lock:
+            for topic_filter in list(self._stream_qos):
+                with self._subscribe_lock:
+                    covered = self._covering_subscription(topic_filter) is not None
+                if covered and topic_filter in self._stream_topics:
+                    self._unsubscribe_stream(topic_filter)
+                elif not covered and topic_filter not in self._stream_topics:
+                    self._subscribe_stream(topic_filter)
+
+    def _streamed_only(self, topic: str) -> bool:
+        # True if the topic matches only filters subscribed for listeners
+        stream_topics = [
+            t for t in list(self._stream_topics) if self._subscribers.get(t, 1) <= 1
+        ]
+        if not any(topic_matches(t, topic) for t in stream_topics):
+            return False
+        return not any(
+            topic_matches(strip_share(t), topic)
+            for t in list(self.topics)
+            if t not in stream_topics
+        )
+
+    def stream(
+        self,
+        topic_filter: str,
+        qos: int = 0,
+        queue_size: Optional[int] = None,
+        keepalive: Optional[float] = None,
+        formatter: Optional[Callable[[Any], str]] = None,
+    ) -> Response:
+        """
+        Return a response streaming the messages of a topic filter as
+        server-sent events.
+
+        :param topic_filter: the topic filter, wildcards are allowed
+        :param qos: the QoS of the subscription
+        :param queue_size: maximum number of messages waiting to be sent to
+                           the client, defaults to ``MQTT_STREAM_QUEUE_SIZE``
+        :param keepalive: seconds without a message after which a comment is
+                          sent, defaults to ``MQTT_STREAM_KEEPALIVE``
+        :param formatter: function returning the data of the event of a
+                          message, by default a JSON object with the topic
+                          and the payload
+
+        Uses a :meth:`listen` listener, which is closed when the client
+        disconnects. Each response occupies a thread of the server while it
+        is open.
+
+        **Example usage:**::
+
+            @app.route('/events')
+            def events():
+                return mqtt.stream('home/+/temperature')
+
+        """
+        listener = self.listen(topic_filter, qos, queue_size)
+        events = server_sent_events(
+            listener,
+            formatter or format_event,
+            self.stream_keepalive if keepalive is None else keepalive,
+        )
+        response = Response(
+            events,
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # also if the response is never iterated
+        response.call_on_close(listener.close)
+        return response
+
+    def stream_stats(self) -> StreamStats:
+        """Return the number of streamed topic filters, listeners and messages
+        dropped for slow listeners.
+
+        :rtype: StreamStats
+        :result: (filters, listeners, dropped)
+
+        """
+        if self._streams is None:
+            return StreamStats(filters=0, listeners=0, dropped=0)
+        return self._streams.stats()
+
+    def outbound_stats(self) -> Optional[OutboundStats]:
+        """Return the occupancy of the outbound queue.
+
+        Returns None if no limit is configured via ``MQTT_OUTBOUND_MAX_MESSAGES``
+        or ``MQTT_OUTBOUND_MAX_BYTES``.
+
+        :rtype: OutboundStats
+        :result: (messages, bytes, held, max_messages, max_bytes)
+
+        """
+        if self.outbound is None:
+            return None
+        return self.outbound.stats()
+
+    def _handle_high_water(self, stats: OutboundStats) -> None:
+        if self._high_water_handler is not None:
+            self._high_water_handler(stats)
+
+    def _handle_low_water(self, stats: OutboundStats) -> None:
+        if self._low_water_handler is not None:
+            self._low_water_handler(stats)
+
+    def on_high_water(self) -> Callable:
+        """Decorator.
+
+        Decorator to handle the event when the outbound queue reaches
+        ``MQTT_OUTBOUND_HIGH_WATER``. Producers may use it to slow down until
+        the low water mark is reached. Only the last decorated function will
+        be called.
+
+        **Example Usage:**::
+
+            @mqtt.on_high_water()
+            def handle_high_water(stats):
+                throttle.set()
+
+            @mqtt.on_low_water()
+            def handle_low_water(stats):
+                throttle.clear()
+
+        """
+
+        def decorator(handler: Callable) -> Callable:
+            self._high_water_handler = handler
+            return handler
+
+        return decorator
+
+    def on_low_water(self) -> Callable:
+        """Decorator.
+
+        Decorator to handle the event when the outbound queue falls to
+        ``MQTT_OUTBOUND_LOW_WATER`` after the high water mark has been
+        reached. Only the last decorated function will be called.
+
+        """
+
+        def decorator(handler: Callable) -> Callable:
+            self._low_water_handler = handler
+            return handler
+
+        return decorator
+
+    def wait_for_all(
+        self, futures: Iterable[ConcurrentFuture], timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Wait until all tracked messages have been acknowledged.
+
+        :param futures: the futures returned by ``publish(..., track=True)``
+                        or ``publish_many(..., track=True)``
+        :param timeout: maximum time in seconds to wait, None waits forever
+
+        :returns: True if all messages have been acknowledged, False if the
+                  timeout expired or a message failed. The futures can be
+                  inspected to find out which messages are missing.
+
+        """
+        done, not_done = concurrent.futures.wait(list(futures), timeout)
+        return not not_done and all(
+            not f.cancelled() and f.exception() is None for f in done
+        )
+
+    def publish_many(
+        self, messages: Iterable[Tuple], track: bool = False
+    ) -> Tuple[int, List[Any]]:
+        """
+        Send a batch of messages to the broker.
+
+        :param messages: an iterable of (topic, payload, qos, retain,
+                         properties) tuples. qos, retain and properties may
+                         be omitted and default to 0, False and None.
+        :param track: if set to True a :class:`PublishFuture` is returned for
+                      each message instead of the message ID
+
+        :rtype: (int, list)
+        :result: (result, mids)
+
+        All messages are queued in one pass: the enabled features (codecs,
+        compression, outbound queue, metrics) are looked up once for the
+        batch instead of for every message and only one log entry is written
+        for the whole batch. Each message is still sent as a PUBLISH packet
+        of its own, paho writes the packets to the socket one by one.
+
+        result is MQTT_ERR_SUCCESS if all messages have been queued, otherwise
+        the error code of the first failed message. mids holds the message ID
+        of each message in the order of *messages*.
+
+        **Example usage:**::
+
+            mqtt.publish_many(
+                ('sensors/{}'.format(s.id), s.value, 1, False) for s in sensors
+            )
+
+        """
+        if self._startup_buffer is not None:
+            # not connected yet, every message is buffered or rejected
+            return self._publish_each(messages, track)
+        if self.outbound is None and self.spool is None and not track:
+            publish = self._client_publish
+        else:
+            publish = functools.partial(self._send, track=track)
+        result: int = MQTT_ERR_SUCCESS
+        mids: List[Any] = []
+        failed = 0
+        metrics = self.metrics
+        encode = len(self._codecs) > 0
+        compressor = self.compressor
+        coalesce = len(self._coalesce) > 0 and not track
+        for message in messages:
+            if coalesce:
+                intervals = self._coalesce.match(message[0])
+                if intervals and self._coalescer.put(
+                    message[0], intervals[0], *message[1:]
+                ):
+                    mids.append(0)
+                    continue
+            if encode:
+                message = (message[0], self._encode(message[0], message[1])) + tuple(
+                    message[2:]
+                )
+            if compressor is not None:
+                # fill in the defaults of omitted qos, retain and properties
+                message = tuple(message) + (0, False, None)[len(message) - 2 :]
+                topic, payload, properties = self._compress(
+                    compressor, message[0], message[1], message[4]
+                )
+                message = (topic, payload, message[2], message[3], properties)
+            if metrics is not None:
+                sent = time.perf_counter()
+            info = publish(*message)
+            rc, mid = info
+            mids.append(info if track else mid)
+            if metrics is not None:
+                self._count_publish(metrics, message[0], rc, mid, sent)
+            if rc != MQTT_ERR_SUCCESS:
+                failed += 1
+                if failed == 1:
+                    result = rc
+
+        if failed:
+            logger.error(
+                "Error {0} publishing {1} of {2} messages".format(
+                    result, failed, len(mids)
+                )
+            )
+        else:
+            logger.debug("Published {0} messages".format(len(mids)))
+
+        return result, mids
+
+    def _publish_each(self, messages: Iterable[Tuple], track: bool) -> Tuple[int, List[Any]]:
+        result: int = MQTT_ERR_SUCCESS
+        mids: List[Any] = []
+        for message in messages:
+            # fill in the defaults of omitted qos, retain and properties
+            topic, payload, qos, retain, properties = (
+                tuple(message) + (0, False, None)[len(message) - 2 :]
+            )
+            info = self.publish(topic, payload, qos, retain, track, properties)
+            rc, mid = info
+            mids.append(info if track else mid)
+            if rc != MQTT_ERR_SUCCESS and result == MQTT_ERR_SUCCESS:
+                result = rc
+        return result, mids
+
+    def request(
+        self,
+        topic: str,
+        payload: Any = None,
+        timeout: Optional[float] = None,
+        qos: int = 1,
+        properties: Optional[Properties] = None,
+    ) -> Any:
+        """
+        Send a request and wait for the response.
+
+        :param topic: the topic the request is published on
+        :param payload: the payload of the request
+        :param timeout: maximum time in seconds to wait for the response,
+                        defaults to ``MQTT_REQUEST_TIMEOUT``
+        :param qos: the quality of service level of the request
+        :param properties: MQTT 5 PUBLISH properties of the request
+
+        :returns: the response message
+
+        :raises TimeoutError: if no response has been received in time
+
+        All responses are received on one subscription of the topic
+        ``MQTT_RESPONSE_TOPIC`` and matched to their request by a
+        correlation id, so any number of requests may wait at the same time.
+        With MQTT 5 the response topic and correlation id are sent as
+        properties of the request. With MQTT 3.1.1 the request is a JSON
+        envelope ``{"correlation_id": ..., "response_topic": ...,
+        "payload": ...}`` and the payload of the returned message is the
+        ``payload`` of the response envelope. The responder answers with
+        :meth:`respond`.
+
+        **Example usage:**::
+
+            response = mqtt.request('devices/42/commands', 'reboot', timeout=5)
+            print(response.payload)
+
+        """
+        future = self.send_request(topic, payload, qos, properties)
+        try:
+            return future.result(self.request_timeout if timeout is None else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(
+                "No response to request on topic {0}".format(topic)
+            ) from None
+
+    def send_request(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 1,
+        properties: Optional[Properties] = None,
+    ) -> ConcurrentFuture:
+        """
+        Send a request without waiting for the response, see :meth:`request`.
+
+        :returns: a :class:`concurrent.futures.Future` resolving to the
+                  response message. Cancel it to stop waiting.
+
+        """
+        response_topic = self._subscribe_responses()
+        correlation_id = next(self._request_ids)
+        key = correlation_id.encode("utf-8")
+        future: ConcurrentFuture = ConcurrentFuture()
+        with self._request_lock:
+            self._requests[key] = future
+        future.add_done_callback(lambda _: self._requests.pop(key, None))
+
+        if self.protocol_version == MQTTv5:
+            if properties is None:
+                properties = Properties(PacketTypes.PUBLISH)  # type: ignore[no-untyped-call]
+            else:
+                properties = copy.copy(properties)
+            properties.ResponseTopic = response_topic
+            properties.CorrelationData = key
+        else:
+            envelope = {"correlation_id": correlation_id, "response_topic": response_topic}
+            # bytes pass the codec of the topic unchanged
+            payload = json.dumps(
+                self._wrap(envelope, payload), separators=(",", ":")
+            ).encode("utf-8")
+        # requests are never coalesced
+        result, _ = cast(
+            Tuple[int, int], self._publish(topic, payload, qos, False, False, properties)
+        )
+        if result != MQTT_ERR_SUCCESS and not (result == MQTT_ERR_NO_CONN and qos > 0):
+            future.set_exception(
+                RuntimeError("Error {0} publishing request on topic {1}".format(result, topic))
+            )
+        return future
+
+    def _subscribe_responses(self) -> str:
+        # one subscription for the responses to all requests, the lock keeps
+        # concurrent first requests from subscribing twice
+        with self._subscribe_lock:
+            if self.response_topic is None:
+                self.response_topic = "responses/{0}".format(
+                    self.client_id or os.urandom(8).hex()
+                )
+                self._response_topic_derived = True
+            topic = self.response_topic
+            if topic not in self.topics:
+                self._router.add(topic, self._handle_response)
+                # not shared, responses are for this client only
+                result, _ = self.client.subscribe(topic=topic, qos=1)
+                if result != MQTT_ERR_SUCCESS and result != MQTT_ERR_NO_CONN:
+                    logger.error("Error {0} subscribing to topic: {1}".format(result, topic))
+                # subscribed on the next connect if not connected
+                self.topics[topic] = TopicQos(topic=topic, qos=1)
+        return topic
+
+    def _handle_response(self, client: Client, userdata: Any, message: Any) -> None:
+        try:
+            if self.protocol_version == MQTTv5:
+                key = getattr(message.properties, "CorrelationData", None)
+            else:
+                envelope = self._envelope(message)
+                key = str(envelope["correlation_id"]).encode("utf-8")
+                message = DecodedMessage(message, self._unwrap(envelope), JsonCodec())
+        except Exception as e:
+            logger.error(
+                "Invalid response on topic {0}: {1}".format(message.topic, repr(e))
+            )
+            return
+        with self._request_lock:
+            future = self._requests.pop(key, None) if key is not None else None
+        if future is None:
+            logger.debug("Response without request on topic {0}".format(message.topic))
+        elif future.set_running_or_notify_cancel():
+            future.set_result(message)
+
+    @staticmethod
+    def _envelope(message: Any) -> Dict[str, Any]:
+        # a JSON codec registered for the topic has already decoded it
+        payload = message.payload
+        return payload if isinstance(payload, dict) else json.loads(payload)
+
+    @staticmethod
+    def _wrap(envelope: Dict[str, Any], payload: Any) -> Dict[str, Any]:
+        # JSON has no bytes, binary payloads are sent base64 encoded
+        if isinstance(payload, (bytes, bytearray)):
+            try:
+                payload = payload.decode("utf-8")
+            except UnicodeDecodeError:
+                payload = base64.b64encode(payload).decode("ascii")
+                envelope["encoding"] = "base64"
+        envelope["payload"] = payload
+        return envelope
+
+    @staticmethod
+    def _unwrap(envelope: Dict[str, Any]) -> Any:
+        payload = envelope.get("payload")
+        if envelope.get("encoding") == "base64":
+            return base64.b64decode(payload)  # type: ignore[arg-type]
+        return payload
+
+    def respond(
+        self,
+        request: Any,
+        payload: Any = None,
+        qos: int = 1,
+        properties: Optional[Properties] = None,
+    ) -> Tuple[int, int]:
+        """
+        Send the response to a request made with :meth:`request`.
+
+        :param request: the received request message
+        :param payload: the payload of the response
+        :param qos: the quality of service level of the response
+        :param properties: MQTT 5 PUBLISH properties of the response
+
+        :returns: the (result, mid) tuple of :meth:`publish`
+
+        With MQTT 3.1.1 the request is a JSON envelope, its payload is
+        ``json.loads(message.payload)['payload']``, or
+        ``message.payload['payload']`` if a JSON codec is registered for the
+        request topic. Binary payloads that are not UTF-8 text are base64
+        encoded and the envelope has the field ``"encoding": "base64"``.
+
+        **Example usage:**::
+
+            @mqtt.on_topic('devices/42/commands')
+            def handle_command(client, userdata, message):
+                mqtt.respond(message, run(message.payload))
+
+        """
+        if self.protocol_version == MQTTv5:
+            topic = request.properties.ResponseTopic
+            if properties is None:
+                properties = Properties(PacketTypes.PUBLISH)  # type: ignore[no-untyped-call]
+            else:
+                properties = copy.copy(properties)
+            correlation_data = getattr(request.properties, "CorrelationData", None)
+            if correlation_data is not None:
+                properties.CorrelationData = correlation_data
+        else:
+            envelope = self._envelope(request)
+            topic = envelope["response_topic"]
+            response = {"correlation_id": envelope["correlation_id"]}
+            payload = json.dumps(
+                self._wrap(response, payload), separators=(",", ":")
+            ).encode("utf-8")
+        return cast(
+            Tuple[int, int], self._publish(topic, payload, qos, False, False, properties)
+        )
+
     def on_connect(self) -> Callable:
         """Decorator.
 
         Decorator to handle the event when the broker responds to a connection
         request. Only the last decorated function will be called.
 
+        The handler is called as ``handler(client, userdata, flags, rc)``. With
+        ``MQTT_PROTOCOL_VERSION`` set to ``MQTTv5`` rc is a reason code and
+        the CONNACK properties are passed as fifth argument.
+
         """
 
         def decorator(handler: Callable) -> Callable:
@@ -534,6 +2776,9 @@ class Mqtt:
         Decorator to handle the event when client disconnects from broker. Only
         the last decorated function will be called.
 
+        The handler is called as ``handler(client, userdata, rc)``. With MQTT 5
+        the DISCONNECT properties are passed as fourth argument.
+
         """
 
         def decorator(handler: Callable) -> Callable:
@@ -561,7 +2806,7 @@ class Mqtt:
         """
 
         def decorator(handler: Callable) -> Callable:
-            self.client.on_message = handler
+            self._message_handler = self._dispatch_wrapper(handler)
             return handler
 
         return decorator
@@ -581,7 +2826,7 @@ class Mqtt:
         """
 
         def decorator(handler: Callable) -> Callable:
-            self.client.on_publish = handler
+            self._publish_handler = handler
             return handler
 
         return decorator
@@ -598,7 +2843,7 @@ class Mqtt:
         """
 
         def decorator(handler: Callable) -> Callable:
-            self.client.on_subscribe = handler
+            self._subscribe_handler = handler
             return handler
 
         return decorator
@@ -615,7 +2860,7 @@ class Mqtt:
         """
 
         def decorator(handler: Callable) -> Callable:
-            self.client.on_unsubscribe = handler
+            self._unsubscribe_handler = handler
             return handler
 
         return decorator
@@ -637,3 +2882,837 @@ class Mqtt:
             return handler
 
         return decorator
+
+    def teardown_message(self) -> Callable:
+        """Decorate a function to be called after each message handler.
+
+        Only used with ``MQTT_APP_CONTEXT``. The application context is kept
+        between messages, so state stored per message, e.g. a database
+        session, has to be reset here. The function gets the exception
+        raised by the handler or None.
+
+        **Example Usage:**
+
+        ::
+
+            @mqtt.teardown_message()
+            def remove_session(error):
+                db.session.remove()
+        """
+
+        def decorator(handler: Callable) -> Callable:
+            self._teardown_handlers.append(handler)
+            return handler
+
+        return decorator
+
+
+class MqttPool:
+    """Pool of :class:`Mqtt` connections sharing one configuration.
+
+    A single connection is limited by one socket and one network thread. The
+    pool opens ``MQTT_POOL_SIZE`` connections configured from the same
+    ``config_prefix`` and spreads published messages across them. The client
+    id of each connection is ``MQTT_CLIENT_ID`` with the index of the
+    connection appended, e.g. ``myapp-0``, ``myapp-1``.
+
+    With the ``topic`` strategy all messages of a topic are published on the
+    same connection, so their order is kept. ``round-robin`` spreads messages
+    evenly but messages of one topic may overtake each other.
+
+    Subscriptions are made on the first connection only, so every message is
+    delivered once even if topic filters overlap. Handlers registered with
+    the decorators of the pool are added to all connections.
+
+    :param app: flask application object
+    :param size: number of connections, overrides ``MQTT_POOL_SIZE``
+    :param strategy: ``topic`` or ``round-robin``, overrides
+        ``MQTT_POOL_STRATEGY``
+    :param mqtt_logging: if True then messages from MQTT client will be logged
+    :param config_prefix: prefix of the configuration keys
+
+    **Example usage:**::
+
+        app = Flask(__name__)
+        pool = MqttPool(app, size=4)
+
+        @pool.on_topic('home/mytopic')
+        def handle_mytopic(client, userdata, message):
+            print(message.payload)
+
+        pool.subscribe('home/mytopic')
+        pool.publish('home/sensor/1', '21.5')
+
+    """
+
+    STRATEGIES = ("topic", "round-robin")
+
+    def __init__(
+        self,
+        app: Optional[Flask] = None,
+        size: Optional[int] = None,
+        strategy: Optional[str] = None,
+        mqtt_logging: bool = False,
+        config_prefix: str = "MQTT",
+    ) -> None:
+        self.app = app
+        self.size = size
+        self.strategy = strategy
+        self.config_prefix = config_prefix
+        self.members: List[Mqtt] = []
+        self._mqtt_logging = mqtt_logging
+        # decorator registrations, applied to connections created later
+        self._registrations: List[Tuple[str, Tuple[Any, ...], Callable]] = []
+        self._codecs: List[Tuple[str, Codec]] = []
+        self._coalesce: List[Tuple[str, float]] = []
+        self._next = itertools.count()
+
+        if app is not None:
+            self.init_app(app, config_prefix)
+
+    def init_app(self, app: Flask, config_prefix: str = "MQTT") -> None:
+        """Create and connect the connections of the pool."""
+        if self.app is None:
+            self.app = app
+        self.config_prefix = config_prefix
+        if self.size is None:
+            self.size = app.config.get(config_prefix + "_POOL_SIZE", 4)
+        if self.strategy is None:
+            self.strategy = app.config.get(config_prefix + "_POOL_STRATEGY", "topic")
+        if self.strategy not in self.STRATEGIES:
+            raise ValueError("Unknown pool strategy: {0}".format(self.strategy))
+        if self.size < 1:
+            raise ValueError("MqttPool needs at least one connection")
+
+        for index in range(self.size):
+            member = Mqtt(mqtt_logging=self._mqtt_logging, config_prefix=config_prefix)
+            member._pool_index = index
+            for topic, codec in self._codecs:
+                member.register_codec(topic, codec)
+            for topic, interval in self._coalesce:
+                member.coalesce(topic, interval)
+            for name, args, handler in self._registrations:
+                getattr(member, name)(*args)(handler)
+            self.members.append(member)
+            member.init_app(app, config_prefix)
+
+    @property
+    def connected(self) -> bool:
+        """Return True if all connections are connected."""
+        return bool(self.members) and all(m.connected for m in self.members)
+
+    def wait_for_connection(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all connections are connected, see :meth:`Mqtt.wait_for_connection`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for member in self.members:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not member.wait_for_connection(remaining):
+                return False
+        return bool(self.members)
+
+    @property
+    def topics(self) -> Dict[str, TopicQos]:
+        """Return the subscribed topics."""
+        return self.members[0].topics
+
+    def member_for(self, topic: str) -> Mqtt:
+        """Return the connection a message on *topic* is published on."""
+        return self.members[self._index_for(topic)]
+
+    def _index_for(self, topic: str) -> int:
+        if self.strategy == "round-robin":
+            return next(self._next) % len(self.members)
+        return hash(topic) % len(self.members)
+
+    def publish(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 0,
+        retain: bool = False,
+        track: bool = False,
+        properties: Optional[Properties] = None,
+    ) -> Any:
+        """Send a message to the broker on one of the connections.
+
+        Takes the same arguments and returns the same values as
+        :meth:`Mqtt.publish`.
+
+        """
+        return self.member_for(topic).publish(
+            topic, payload, qos, retain, track, properties
+        )
+
+    def publish_many(
+        self, messages: Iterable[Tuple[Any, ...]], track: bool = False
+    ) -> Tuple[int, List[Any]]:
+        """Publish a batch of messages spread across the connections.
+
+        Takes the same arguments and returns the same values as
+        :meth:`Mqtt.publish_many`, the message IDs are in the order of
+        *messages* but belong to different connections.
+
+        """
+        batches: Dict[int, List[Tuple[int, Tuple[Any, ...]]]] = {}
+        count = 0
+        for message in messages:
+            batches.setdefault(self._index_for(message[0]), []).append((count, message))
+            count += 1
+
+        result: int = MQTT_ERR_SUCCESS
+        mids: List[Any] = [None] * count
+        for index, batch in batches.items():
+            rc, batch_mids = self.members[index].publish_many(
+                (message for _, message in batch), track
+            )
+            if result == MQTT_ERR_SUCCESS:
+                result = rc
+            for (position, _), mid in zip(batch, batch_mids):
+                mids[position] = mid
+        return result, mids
+
+    def wait_for_all(
+        self, futures: Iterable[ConcurrentFuture], timeout: Optional[float] = None
+    ) -> bool:
+        """Wait for tracked messages, see :meth:`Mqtt.wait_for_all`."""
+        return self.members[0].wait_for_all(futures, timeout)
+
+    def subscribe(self, topic: Any, qos: int = 0) -> Tuple[int, int]:
+        """Subscribe on the first connection, see :meth:`Mqtt.subscribe`."""
+        return self.members[0].subscribe(topic, qos)
+
+    def subscribe_many(
+        self, topics: Iterable[Union[str, Tuple[str, int]]], qos: int = 0
+    ) -> Tuple[int, List[Optional[int]]]:
+        """Subscribe on the first connection, see :meth:`Mqtt.subscribe_many`."""
+        return self.members[0].subscribe_many(topics, qos)
+
+    def unsubscribe(self, topic: str) -> Optional[Tuple[int, int]]:
+        """Unsubscribe a topic, see :meth:`Mqtt.unsubscribe`."""
+        return self.members[0].unsubscribe(topic)
+
+    def unsubscribe_all(self) -> None:
+        """Unsubscribe all topics, see :meth:`Mqtt.unsubscribe_all`."""
+        self.members[0].unsubscribe_all()
+
+    def request(self, topic: str, payload: Any = None, **kwargs: Any) -> Any:
+        """Send a request and wait for the response, see :meth:`Mqtt.request`."""
+        return self.members[0].request(topic, payload, **kwargs)
+
+    def send_request(self, topic: str, payload: Any = None, **kwargs: Any) -> ConcurrentFuture:
+        """Send a request, see :meth:`Mqtt.send_request`."""
+        return self.members[0].send_request(topic, payload, **kwargs)
+
+    def respond(self, request: Any, payload: Any = None, **kwargs: Any) -> Tuple[int, int]:
+        """Send the response to a request, see :meth:`Mqtt.respond`."""
+        return self.members[0].respond(request, payload, **kwargs)
+
+    def last(self, topic: str, default: Any = None) -> Any:
+        """Return the last message received on a topic, see :meth:`Mqtt.last`."""
+        return self.members[0].last(topic, default)
+
+    def last_matching(self, topic_filter: str) -> Dict[str, Any]:
+        """Return the last messages of matching topics, see :meth:`Mqtt.last_matching`."""
+        return self.members[0].last_matching(topic_filter)
+
+    def listen(self, topic_filter: str, **kwargs: Any) -> Listener:
+        """Listen on the first connection, see :meth:`Mqtt.listen`."""
+        return self.members[0].listen(topic_filter, **kwargs)
+
+    def stream(self, topic_filter: str, **kwargs: Any) -> Response:
+        """Stream from the first connection, see :meth:`Mqtt.stream`."""
+        return self.members[0].stream(topic_filter, **kwargs)
+
+    def register_codec(self, topic: str, codec: Union[str, Codec]) -> Codec:
+        """Register a codec on all connections, see :meth:`Mqtt.register_codec`."""
+        instance = get_codec(codec)
+        self._codecs.append((topic, instance))
+        for member in self.members:
+            member.register_codec(topic, instance)
+        return instance
+
+    def coalesce(self, topic: str, interval: float) -> None:
+        """Limit the publish rate on all connections, see :meth:`Mqtt.coalesce`.
+
+        With the ``round-robin`` strategy a topic is published on several
+        connections, each limiting the rate separately.
+
+        """
+        self._coalesce.append((topic, interval))
+        for member in self.members:
+            member.coalesce(topic, interval)
+
+    def flush_coalesced(self) -> None:
+        """Send the messages held back on all connections now."""
+        for member in self.members:
+            member.flush_coalesced()
+
+    def _register(self, name: str, *args: Any) -> Callable:
+        def decorator(handler: Callable) -> Callable:
+            self._registrations.append((name, args, handler))
+            for member in self.members:
+                getattr(member, name)(*args)(handler)
+            return handler
+
+        return decorator
+
+    def on_connect(self) -> Callable:
+        """Decorator, called for every connection, see :meth:`Mqtt.on_connect`."""
+        return self._register("on_connect")
+
+    def on_disconnect(self) -> Callable:
+        """Decorator, called for every connection, see :meth:`Mqtt.on_disconnect`."""
+        return self._register("on_disconnect")
+
+    def on_message(self) -> Callable:
+        """Decorator, see :meth:`Mqtt.on_message`."""
+        return self._register("on_message")
+
+    def on_topic(self, topic: str, codec: Optional[Union[str, Codec]] = None) -> Callable:
+        """Decorator, see :meth:`Mqtt.on_topic`."""
+        if codec is not None:
+            self.register_codec(topic, codec)
+        return self._register("on_topic", topic)
+
+    def on_publish(self) -> Callable:
+        """Decorator, see :meth:`Mqtt.on_publish`."""
+        return self._register("on_publish")
+
+    def on_subscribe(self) -> Callable:
+        """Decorator, see :meth:`Mqtt.on_subscribe`."""
+        return self._register("on_subscribe")
+
+    def on_unsubscribe(self) -> Callable:
+        """Decorator, see :meth:`Mqtt.on_unsubscribe`."""
+        return self._register("on_unsubscribe")
+
+    def on_log(self) -> Callable:
+        """Decorator, see :meth:`Mqtt.on_log`."""
+        return self._register("on_log")
+
+    def teardown_message(self) -> Callable:
+        """Decorator, see :meth:`Mqtt.teardown_message`."""
+        return self._register("teardown_message")
+
+    def _disconnect(self) -> None:
+        for member in self.members:
+            member._disconnect()
+
+
+#: instances connected by init_app, their connection is dropped in forked children
+_instances: "weakref.WeakSet[Mqtt]" = weakref.WeakSet()
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_loop_lock = threading.Lock()
+
+
+def _after_fork_in_child() -> None:
+    global _background_loop, _background_loop_lock
+    # the thread running the loop has not been copied
+    _background_loop = None
+    _background_loop_lock = threading.Lock()
+    for mqtt in list(_instances):
+        try:
+            mqtt._after_fork()
+        except Exception as e:
+            logger.error(
+                "Failed to reset client '{0}' after fork - {1}: {2}".format(
+                    mqtt.client_id, type(e).__name__, str(e)
+                )
+            )
+
+
+if hasattr(os, "register_at_fork"):
+    # not available on Windows. The child gets fresh locks because a lock may
+    # have been held by a thread that does not exist in the child.
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop shared by all AsyncMqtt instances.
+
+    The loop runs in a single daemon thread that is started on first use.
+
+    """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="flask-mqtt-asyncio", daemon=True
+            )
+            thread.start()
+            _background_loop = loop
+        return _background_loop
+
+
+class AsyncMqtt(Mqtt):
+    """Asyncio based Mqtt class.
+
+    Reads the same configuration keys as :class:`Mqtt` but drives the paho
+    client from an asyncio event loop instead of a dedicated network thread.
+    :meth:`publish`, :meth:`subscribe` and :meth:`unsubscribe` are coroutines
+    that return when the broker acknowledged the request. Handlers registered
+    with :meth:`on_topic` and :meth:`on_message` may be ``async def``
+    functions.
+
+    :param app:  flask application object
+    :param loop: the event loop to run the client on. If not given all
+        AsyncMqtt instances share one loop running in a background thread.
+    :param mqtt_logging: if True then messages from MQTT client will be logged
+
+    The coroutines may be awaited from any event loop, e.g. from the per
+    request loop of Flask async views.
+
+    **Example usage:**::
+
+        app = Flask(__name__)
+        mqtt = AsyncMqtt(app)
+
+        @mqtt.on_topic('home/mytopic')
+        async def handle_mytopic(client, userdata, message):
+            await store(message.payload)
+
+        @app.route('/switch')
+        async def switch():
+            await mqtt.subscribe('home/mytopic', qos=1)
+            await mqtt.publish('home/switch', 'on', qos=1)
+            return 'ok'
+
+    """
+
+    def __init__(
+        self,
+        app: Flask = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        mqtt_logging: bool = False,
+        config_prefix: str = "MQTT",
+    ) -> None:
+        self.loop: asyncio.AbstractEventLoop = loop or _get_background_loop()
+        self._shared_loop = loop is None
+        self._pending_subscribe: Dict[int, asyncio.Future] = {}
+        self._pending_unsubscribe: Dict[int, asyncio.Future] = {}
+        self._tasks: Set[ConcurrentFuture] = set()
+        self._misc_task: Optional[asyncio.Future] = None
+        self._connecting = False
+        self._should_connect = False
+        self._reconnect_delay = 1
+        self._fail_over_pending = False
+        super().__init__(
+            app,
+            connect_async=True,
+            mqtt_logging=mqtt_logging,
+            config_prefix=config_prefix,
+        )
+
+    def _use_loopback(self) -> None:
+        # the event loop integration relies on the socket callbacks of paho
+        raise ValueError("The loopback transport is not supported by AsyncMqtt")
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        if self._shared_loop:
+            # the copied loop shares its selector with the parent
+            self.loop = _get_background_loop()
+        self._pending_subscribe = {}
+        self._pending_unsubscribe = {}
+        self._tasks = set()
+        self._misc_task = None
+        self._connecting = False
+        self._should_connect = False
+        self._reconnect_delay = 1
+        self._fail_over_pending = False
+
+    def _connect(self) -> None:
+        future = asyncio.run_coroutine_threadsafe(self.connect(), self.loop)
+        future.add_done_callback(self._log_connect_result)
+
+    def _log_connect_result(self, future: ConcurrentFuture) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            logger.error(
+                "Failed to connect to broker {0}:{1} - {2}: {3}".format(
+                    self.broker_url, self.broker_port, type(e).__name__, str(e)
+                )
+            )
+
+    def _disconnect(self) -> None:
+        _instances.discard(self)
+        if self._streams is not None:
+            self._streams.close()
+        future = asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # not called from a coroutine, wait for the disconnect
+            future.result(self.connection_timeout)
+
+    async def connect(self) -> None:
+        """Connect to the broker and start processing network events.
+
+        Is called by :meth:`init_app`. Lost connections are re-established
+        automatically until :meth:`disconnect` is called.
+
+        """
+        await self._run(self._connect_on_loop())
+
+    async def _connect_on_loop(self) -> None:
+        self._configure_client()
+        self.client.on_socket_open = self._handle_socket_open
+        self.client.on_socket_close = self._handle_socket_close
+        self.client.on_socket_register_write = self._handle_socket_register_write
+        self.client.on_socket_unregister_write = self._handle_socket_unregister_write
+        # probing the brokers blocks, keep the event loop running
+        await self.loop.run_in_executor(None, self._select_broker)
+        self._should_connect = True
+        if self._misc_task is None:
+            self._misc_task = self.loop.create_task(self._misc_loop())
+        self._connecting = True
+        try:
+            # the blocking socket connect is moved to the default executor so
+            # the event loop keeps running
+            await self.loop.run_in_executor(
+                None,
+                functools.partial(
+                    self.client.connect,
+                    self.broker_url,
+                    self.broker_port,
+                    **self._connect_kwargs(),
+                ),
+            )
+        finally:
+            self._connecting = False
+        logger.debug(
+            "Connecting client '{0}' to broker {1}:{2}".format(
+                self.client_id, self.broker_url, self.broker_port
+            )
+        )
+
+    async def disconnect(self) -> None:
+        """Disconnect from the broker and stop processing network events."""
+        await self._run(self._disconnect_on_loop())
+
+    async def _disconnect_on_loop(self) -> None:
+        self._should_connect = False
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        # joins the coalescer thread, which may wait for the event loop
+        await self.loop.run_in_executor(
+            None, functools.partial(self._coalescer.close, flush=self.coalesce_flush)
+        )
+        self.client.disconnect()
+        if self.spool is not None:
+            self._flush_spool(self.spool)
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+            self._dispatcher = None
+        logger.debug("Disconnected from Broker")
+
+    async def _misc_loop(self) -> None:
+        # keepalive handling and reconnects, replaces paho's loop_start()
+        while True:
+            await asyncio.sleep(1)
+            if self._connecting:
+                continue
+            if self.client.loop_misc() == MQTT_ERR_NO_CONN and self._should_connect:
+                await asyncio.sleep(self._reconnect_delay)
+                self._connecting = True
+                try:
+                    if self._fail_over_pending:
+                        self._fail_over_pending = False
+                        await self.loop.run_in_executor(None, self._fail_over_to_fastest)
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    self._reconnect_delay = 1
+                except OSError as e:
+                    logger.debug("Reconnect failed: {0}".format(str(e)))
+                    self._reconnect_delay = min(self._reconnect_delay * 2, 120)
+                    self._fail_over_pending = True
+                finally:
+                    self._connecting = False
+
+    def _fail_over(self) -> None:
+        # probing the brokers blocks, _misc_loop does it in the executor
+        self._fail_over_pending = True
+
+    def _fail_over_to_fastest(self) -> None:
+        # runs in the executor before the reconnect, which waits for it
+        if len(self.brokers) < 2:
+            return
+        current = (self.broker_url, self.broker_port)
+        broker = fastest_broker(
+            [b for b in self.brokers if b != current], self.connection_timeout
+        )
+        self._switch_broker(broker or next_broker(self.brokers, current))
+
+    def _in_network_thread(self) -> bool:
+        # blocking on a full outbound queue would stall the calling event loop
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    def _call_in_loop(self, callback: Callable, *args: Any) -> None:
+        # socket callbacks may come from the executor thread running connect()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _handle_socket_open(self, client: Client, userdata: Any, sock: Any) -> None:
+        self._call_in_loop(self.loop.add_reader, sock, self._loop_read)
+
+    def _handle_socket_close(self, client: Client, userdata: Any, sock: Any) -> None:
+        self._call_in_loop(self.loop.remove_reader, sock)
+        self._call_in_loop(self.loop.remove_writer, sock)
+
+    def _handle_socket_register_write(
+        self, client: Client, userdata: Any, sock: Any
+    ) -> None:
+        self._call_in_loop(self.loop.add_writer, sock, self.client.loop_write)
+
+    def _handle_socket_unregister_write(
+        self, client: Client, userdata: Any, sock: Any
+    ) -> None:
+        self._call_in_loop(self.loop.remove_writer, sock)
+
+    def _loop_read(self) -> None:
+        self.client.loop_read()
+        # TLS sockets may hold decrypted data the selector does not see
+        sock = self.client.socket()
+        if sock is not None and hasattr(sock, "pending") and sock.pending():
+            self.loop.call_soon(self._loop_read)
+
+    async def _run(
+        self, coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None
+    ) -> Any:
+        # run coro on the client loop and wait for it from the calling loop
+        if timeout is not None:
+            coro = asyncio.wait_for(coro, timeout)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            return await coro
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+        )
+
+    def _handle_disconnect(self, client: Client, userdata: Any, rc: int, *args: Any) -> None:
+        # pending (un)subscriptions are not resent by paho
+        error = ConnectionError("Connection to broker lost")
+        for pending in (self._pending_subscribe, self._pending_unsubscribe):
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            pending.clear()
+        super()._handle_disconnect(client, userdata, rc, *args)
+
+    def _handle_subscribe(
+        self,
+        client: Client,
+        userdata: Any,
+        mid: int,
+        granted_qos: Tuple[int, ...],
+        *args: Any,
+    ) -> None:
+        future = self._pending_subscribe.pop(mid, None)
+        if future is not None and not future.done():
+            # MQTT 5 reason codes carry the granted QoS as value
+            future.set_result(tuple(getattr(q, "value", q) for q in granted_qos))
+        super()._handle_subscribe(client, userdata, mid, granted_qos, *args)
+
+    def _handle_unsubscribe(self, client: Client, userdata: Any, mid: int, *args: Any) -> None:
+        future = self._pending_unsubscribe.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(mid)
+        super()._handle_unsubscribe(client, userdata, mid, *args)
+
+    def _dispatch_wrapper(self, handler: Callable) -> Callable:
+        if not inspect.iscoroutinefunction(handler):
+            return super()._dispatch_wrapper(handler)
+
+        # coroutine handlers run as tasks on the client loop
+        @functools.wraps(handler)
+        def wrapper(client: Client, userdata: Any, message: Any) -> None:
+            task = asyncio.run_coroutine_threadsafe(
+                handler(client, userdata, message), self.loop
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._handle_task_done)
+
+        return wrapper
+
+    def _handle_task_done(self, task: ConcurrentFuture) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Exception in message handler: {0}".format(repr(task.exception()))
+            )
+
+    async def publish(  # type: ignore[override]
+        self,
+        topic: str,
+        payload: Optional[bytes] = None,
+        qos: int = 0,
+        retain: bool = False,
+        timeout: Optional[float] = None,
+        properties: Optional[Properties] = None,
+    ) -> int:
+        """
+        Send a message to the broker and wait for the acknowledgement.
+
+        :param topic: the topic that the message should be published on
+        :param payload: the actual message to send
+        :param qos: the quality of service level to use
+        :param retain: if set to True, the message will be set as the
+                       "last known good"/retained message for the topic
+        :param timeout: maximum time in seconds to wait, None waits forever
+        :param properties: MQTT 5 PUBLISH properties
+
+        :returns: the message ID of the published message
+
+        Returns when the message has been written to the socket (QoS 0), on
+        PUBACK (QoS 1) or on PUBCOMP (QoS 2). Messages with QoS > 0 that are
+        published while the client is not connected are sent after the next
+        reconnect.
+
+        :raises RuntimeError: if the message could not be queued
+        :raises asyncio.TimeoutError: if the timeout expired
+
+        """
+        return await self._run(
+            self._publish_on_loop(topic, payload, qos, retain, properties), timeout
+        )
+
+    async def _publish_on_loop(
+        self,
+        topic: str,
+        payload: Optional[bytes],
+        qos: int,
+        retain: bool,
+        properties: Optional[Properties],
+    ) -> int:
+        future = Mqtt.publish(
+            self, topic, payload, qos, retain, track=True, properties=properties
+        )
+        return await asyncio.wrap_future(cast(PublishFuture, future))
+
+    async def subscribe(  # type: ignore[override]
+        self,
+        topic: Union[str, Tuple[str, int], List[Tuple[str, int]]],
+        qos: int = 0,
+        timeout: Optional[float] = None,
+    ) -> Tuple[int, ...]:
+        """
+        Subscribe to a topic and wait for the SUBACK of the broker.
+
+        :param topic: a string specifying the subscription topic, a
+            (topic, qos) tuple or a list of (topic, qos) tuples
+        :param qos: the desired quality of service level for the subscription.
+                    Defaults to 0.
+        :param timeout: maximum time in seconds to wait, None waits forever
+
+        :returns: the QoS levels granted by the broker for each topic
+
+        :raises RuntimeError: if the subscription could not be sent
+
+        """
+        return await self._run(self._subscribe_on_loop(topic, qos), timeout)
+
+    async def _subscribe_on_loop(self, topic: Any, qos: int) -> Tuple[int, ...]:
+        result, mid = Mqtt.subscribe(self, topic, qos)
+        if result != MQTT_ERR_SUCCESS:
+            raise RuntimeError("Subscribe failed: {0}".format(error_string(result)))
+        if mid == 0:
+            # already subscribed, nothing has been sent
+            if isinstance(topic, list):
+                topics = [t for t, _ in topic]
+            else:
+                topics = [topic[0] if isinstance(topic, tuple) else topic]
+            return tuple(self.topics[self._shared(t)].qos for t in topics)
+        future = self.loop.create_future()
+        self._pending_subscribe[mid] = future
+        try:
+            return await future
+        finally:
+            self._pending_subscribe.pop(mid, None)
+
+    async def unsubscribe(  # type: ignore[override]
+        self, topic: str, timeout: Optional[float] = None
+    ) -> Optional[int]:
+        """
+        Unsubscribe from a single topic and wait for the UNSUBACK.
+
+        :param topic: a single string that is the subscription topic to
+                      unsubscribe from
+        :param timeout: maximum time in seconds to wait, None waits forever
+
+        :returns: the message ID of the unsubscribe request, 0 if other
+                  subscribers of the topic are left or None if the topic
+                  has not been subscribed
+
+        """
+        return await self._run(self._unsubscribe_on_loop(topic), timeout)
+
+    async def _unsubscribe_on_loop(self, topic: str) -> Optional[int]:
+        ret = Mqtt.unsubscribe(self, topic)
+        if ret is None:
+            return None
+        result, mid = ret
+        if result != MQTT_ERR_SUCCESS:
+            raise RuntimeError("Unsubscribe failed: {0}".format(error_string(result)))
+        if mid == 0:
+            # other subscribers are left, nothing has been sent
+            return mid
+        future = self.loop.create_future()
+        self._pending_unsubscribe[mid] = future
+        try:
+            return await future
+        finally:
+            self._pending_unsubscribe.pop(mid, None)
+
+    async def unsubscribe_all(self) -> bool:  # type: ignore[override]
+        """
+        Unsubscribe from all topics.
+
+        Returns True if all topics are unsubscribed from self.topics, otherwise False
+
+        """
+        with self._subscribe_lock:
+            # regardless of the number of subscribers
+            self._subscribers.clear()
+            topics = list(self.topics.keys())
+        await asyncio.gather(*(self.unsubscribe(topic) for topic in topics))
+        return not len(self.topics)
+
+    async def request(
+        self,
+        topic: str,
+        payload: Any = None,
+        timeout: Optional[float] = None,
+        qos: int = 1,
+        properties: Optional[Properties] = None,
+    ) -> Any:
+        """
+        Send a request and wait for the response, see :meth:`Mqtt.request`.
+
+        :raises TimeoutError: if no response has been received in time
+
+        """
+        future = self.send_request(topic, payload, qos, properties)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                self.request_timeout if timeout is None else timeout,
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                "No response to request on topic {0}".format(topic)
+            ) from None
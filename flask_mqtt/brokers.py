@@ -0,0 +1,115 @@
+"""Selection of the broker to connect to from a list of brokers.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import logging
+import queue
+import socket
+import threading
+import time
+from typing import Any, List, Optional, Sequence, Tuple
+
+#: (host, port) of a broker
+Broker = Tuple[str, int]
+
+logger = logging.getLogger(__name__)
+
+
+def parse_broker(value: Any, default_port: int = 1883) -> Broker:
+    """Return (host, port) of a broker.
+
+    :param value: a (host, port) tuple or a string ``"host"``,
+        ``"host:port"`` or ``"[ipv6-address]:port"``
+    :param default_port: the port of a string without port
+
+    """
+    if isinstance(value, (tuple, list)):
+        host, port = value
+        return str(host), int(port)
+    value = str(value).strip()
+    if value.startswith("["):
+        host, _, rest = value[1:].partition("]")
+        return host, int(rest[1:]) if rest.startswith(":") else default_port
+    if value.count(":") == 1:
+        host, port = value.split(":")
+        return host, int(port)
+    return value, default_port
+
+
+def _probe(broker: Broker, timeout: float, results: "queue.Queue[Tuple[Broker, Any]]") -> None:
+    start = time.perf_counter()
+    try:
+        sock = socket.create_connection(broker, timeout=timeout)
+    except OSError as e:
+        results.put((broker, e))
+        return
+    sock.close()
+    results.put((broker, time.perf_counter() - start))
+
+
+def fastest_broker(brokers: Sequence[Broker], timeout: float) -> Optional[Broker]:
+    """Return the broker accepting a TCP connection first.
+
+    The brokers are tried at the same time, each with its own socket
+    timeout. Only reachability is tested, the MQTT connect is made by the
+    client afterwards.
+
+    :param brokers: the (host, port) tuples of the brokers
+    :param timeout: maximum time in seconds to wait for a broker
+
+    :returns: the fastest broker or None if none could be reached
+
+    """
+    results: "queue.Queue[Tuple[Broker, Any]]" = queue.Queue()
+    for broker in brokers:
+        thread = threading.Thread(
+            target=_probe,
+            args=(broker, timeout, results),
+            name="flask-mqtt-probe-{0}:{1}".format(*broker),
+        )
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.monotonic() + timeout
+    for _ in brokers:
+        try:
+            broker, result = results.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if isinstance(result, float):
+            logger.debug(
+                "Broker {0}:{1} answered in {2:.1f} ms".format(
+                    broker[0], broker[1], result * 1000
+                )
+            )
+            return broker
+        logger.debug("Broker {0}:{1} not reachable: {2}".format(broker[0], broker[1], result))
+    return None
+
+
+def next_broker(brokers: List[Broker], current: Broker) -> Broker:
+    """Return the broker following *current* in *brokers*."""
+    try:
+        index = brokers.index(current)
+    except ValueError:
+        return brokers[0]
+    return brokers[(index + 1) % len(brokers)]
+
+
+def set_client_broker(client: Any, broker: Broker) -> None:
+    """Make the next reconnect of a paho client go to *broker*.
+
+    paho has no public API for this: ``reconnect()``, also when called by
+    the network thread of ``loop_start()``, connects to the host and port of
+    the last ``connect()``, which paho keeps in the private attributes
+    ``_host`` and ``_port``. ``connect_async()`` would set them as well, but
+    it must not be called while the network thread reconnects.
+
+    :param client: the paho client
+    :param broker: the (host, port) tuple of the broker
+
+    """
+    client._host, client._port = broker
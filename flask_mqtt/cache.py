@@ -0,0 +1,140 @@
+"""Cache of the last message received on each topic.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Any, Dict, Iterable, Tuple
+
+from .outbound import payload_size
+from .router import topic_matches
+
+#: Snapshot of the cache occupancy
+CacheStats = namedtuple("CacheStats", ["entries", "bytes", "max_entries", "max_bytes"])
+
+
+class LastValueCache:
+    """Keep the last message of each topic, bounded by count and size.
+
+    Messages are written by the network thread and read by request threads.
+    Writes are serialized by a lock, reads only look up a dictionary and do
+    not take it. If a limit is exceeded the topic that has not been updated
+    for the longest time is removed.
+
+    :param max_entries: maximum number of topics, 0 means unlimited
+    :param max_bytes: maximum sum of the payload sizes, 0 means unlimited
+
+    """
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # topic -> (message, size), read without the lock
+        self._entries: Dict[str, Tuple[Any, int]] = {}
+        # topics, least recently updated first
+        self._order: "OrderedDict[str, None]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._entries
+
+    @property
+    def bytes(self) -> int:
+        """Return the sum of the payload sizes in the cache."""
+        return self._bytes
+
+    def stats(self) -> CacheStats:
+        """Return a snapshot of the cache occupancy."""
+        return CacheStats(
+            entries=len(self._entries),
+            bytes=self._bytes,
+            max_entries=self.max_entries,
+            max_bytes=self.max_bytes,
+        )
+
+    def put(self, topic: str, message: Any) -> None:
+        """Store *message* as the last message of *topic*.
+
+        A message with an empty payload removes the topic, as it clears a
+        retained message.
+
+        """
+        size = payload_size(getattr(message, "raw_payload", message.payload))
+        with self._lock:
+            entries = self._entries
+            previous = entries.get(topic)
+            if previous is not None:
+                self._bytes -= previous[1]
+            if size == 0:
+                if previous is not None:
+                    del entries[topic]
+                    del self._order[topic]
+                return
+            # replace in place, so readers never miss a cached topic
+            entries[topic] = (message, size)
+            self._order[topic] = None
+            self._order.move_to_end(topic)
+            self._bytes += size
+            # always keep the new message, even if it exceeds max_bytes
+            while len(entries) > 1 and (
+                (self.max_entries > 0 and len(entries) > self.max_entries)
+                or (self.max_bytes > 0 and self._bytes > self.max_bytes)
+            ):
+                oldest, _ = self._order.popitem(last=False)
+                self._bytes -= entries.pop(oldest)[1]
+
+    def get(self, topic: str, default: Any = None) -> Any:
+        """Return the last message of *topic* or *default*."""
+        entry = self._entries.get(topic)
+        return default if entry is None else entry[0]
+
+    def match(self, topic_filter: str) -> Dict[str, Any]:
+        """Return the last messages of the topics matching *topic_filter*.
+
+        :returns: a dictionary mapping topics to messages
+
+        """
+        # copying the items is a single step for the interpreter, no lock needed
+        items = list(self._entries.items())
+        return {
+            topic: message
+            for topic, (message, _) in items
+            if topic_matches(topic_filter, topic)
+        }
+
+    def discard(self, topic_filter: str, keep: Iterable[str] = ()) -> int:
+        """Remove the topics matching *topic_filter* and return their number.
+
+        :param keep: topic filters whose matching topics are not removed,
+                     e.g. the filters that are still subscribed
+
+        """
+        keep = list(keep)
+        with self._lock:
+            topics = [
+                t
+                for t in self._entries
+                if topic_matches(topic_filter, t)
+                and not any(topic_matches(f, t) for f in keep)
+            ]
+            for topic in topics:
+                self._bytes -= self._entries.pop(topic)[1]
+                del self._order[topic]
+        return len(topics)
+
+    def clear(self) -> None:
+        """Remove all topics."""
+        with self._lock:
+            self._entries = {}
+            self._order.clear()
+            self._bytes = 0
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
@@ -0,0 +1,161 @@
+"""Coalescing of messages published faster than consumers need them.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import heapq
+import logging
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+#: Message waiting for the next send slot of its topic
+PendingMessage = namedtuple(
+    "PendingMessage", ["payload", "qos", "retain", "properties", "interval"]
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """Limit the publish rate per topic, keeping only the newest message.
+
+    The first message of a topic is sent right away. Messages published
+    within *interval* seconds after that are not sent but replace each
+    other, and the newest one is sent by a background thread when the
+    interval has passed. So each topic is sent at most once per interval
+    and its latest value is delayed by at most one interval.
+
+    :param send: called as ``send(topic, payload, qos, retain, properties)``
+        to send a message
+    :param name: name of the background thread
+
+    """
+
+    def __init__(
+        self, send: Callable[..., Any], name: str = "flask-mqtt-coalesce"
+    ) -> None:
+        self.send = send
+        self.name = name
+        #: number of messages that have been replaced by a newer message
+        self.coalesced = 0
+        self._pending: Dict[str, PendingMessage] = {}
+        # topic -> earliest time the next message may be sent
+        self._next: Dict[str, float] = {}
+        self._prune_at = 1024
+        self._due: List[Tuple[float, str]] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(
+        self,
+        topic: str,
+        interval: float,
+        payload: Any,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Any = None,
+    ) -> bool:
+        """Hold back a message if its topic has been sent within *interval*.
+
+        :returns: False if the message is to be sent right away by the
+            caller, True if it has been held back
+
+        """
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                return False
+            message = PendingMessage(payload, qos, retain, properties, interval)
+            if topic in self._pending:
+                self._pending[topic] = message
+                self.coalesced += 1
+                return True
+            next_send = self._next.get(topic, 0.0)
+            if now >= next_send:
+                self._next[topic] = now + interval
+                if len(self._next) >= self._prune_at:
+                    self._prune(now)
+                return False
+            self._pending[topic] = message
+            heapq.heappush(self._due, (next_send, topic))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._due[0][1] == topic:
+                self._cond.notify()
+            return True
+
+    def _prune(self, now: float) -> None:
+        # forget topics whose interval has passed, they may be sent right away
+        self._next = {
+            topic: next_send
+            for topic, next_send in self._next.items()
+            if next_send > now or topic in self._pending
+        }
+        self._prune_at = max(1024, 2 * len(self._next))
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._cond.wait(self._due[0][0] - now if self._due else None)
+                _, topic = heapq.heappop(self._due)
+                message = self._pending.pop(topic)
+                self._next[topic] = now + message.interval
+            self._send(topic, message)
+
+    def _send(self, topic: str, message: PendingMessage) -> None:
+        try:
+            self.send(topic, message.payload, message.qos, message.retain, message.properties)
+        except Exception:
+            logger.exception("Error publishing coalesced message on topic {0}".format(topic))
+
+    def flush(self) -> None:
+        """Send all held back messages now."""
+        with self._cond:
+            pending = self._pending
+            self._pending = {}
+            self._due = []
+            now = time.monotonic()
+            for topic, message in pending.items():
+                self._next[topic] = now + message.interval
+        for topic, message in pending.items():
+            self._send(topic, message)
+
+    def close(self, flush: bool = True) -> None:
+        """Stop the background thread.
+
+        Messages published during the close are sent right away.
+
+        :param flush: send the held back messages, otherwise they are
+            discarded
+
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if flush:
+            self.flush()
+        with self._cond:
+            self._pending = {}
+            self._due = []
+            # the coalescer may be used again, e.g. after a new connect
+            self._thread = None
+            self._closed = False
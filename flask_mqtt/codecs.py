@@ -0,0 +1,148 @@
+"""Payload codecs used to encode and decode message payloads.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import json
+from typing import Any, Dict, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class Codec:
+    """Base class of all payload codecs.
+
+    Subclasses implement :meth:`encode` and :meth:`decode` and may be
+    registered for a topic filter with :meth:`flask_mqtt.Mqtt.register_codec`.
+
+    """
+
+    #: name used to look up the codec with :func:`get_codec`
+    name = ""
+
+    def encode(self, obj: Any) -> bytes:
+        """Encode *obj* to a message payload."""
+        raise NotImplementedError
+
+    def decode(self, payload: bytes) -> Any:
+        """Decode a message payload."""
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """Pass bytes through unchanged, encode strings as UTF-8."""
+
+    name = "raw"
+
+    def encode(self, obj: Any) -> bytes:
+        if isinstance(obj, str):
+            return obj.encode("utf-8")
+        return bytes(obj)
+
+    def decode(self, payload: bytes) -> Any:
+        return payload
+
+
+class JsonCodec(Codec):
+    """Encode and decode payloads as UTF-8 JSON."""
+
+    name = "json"
+
+    def encode(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, payload: bytes) -> Any:
+        return json.loads(payload)
+
+
+class MsgpackCodec(Codec):
+    """Encode and decode payloads with MessagePack (requires msgpack)."""
+
+    name = "msgpack"
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise ImportError("The msgpack codec requires the msgpack package")
+
+    def encode(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, payload: bytes) -> Any:
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CborCodec(Codec):
+    """Encode and decode payloads with CBOR (requires cbor2)."""
+
+    name = "cbor"
+
+    def __init__(self) -> None:
+        if cbor2 is None:
+            raise ImportError("The cbor codec requires the cbor2 package")
+
+    def encode(self, obj: Any) -> bytes:
+        return cbor2.dumps(obj)
+
+    def decode(self, payload: bytes) -> Any:
+        return cbor2.loads(payload)
+
+
+_codecs: Dict[str, type] = {
+    codec.name: codec for codec in (RawCodec, JsonCodec, MsgpackCodec, CborCodec)
+}
+
+
+def get_codec(codec: Union[str, Codec]) -> Codec:
+    """Return a codec instance for a codec name or instance.
+
+    :param codec: one of ``"raw"``, ``"json"``, ``"msgpack"``, ``"cbor"``
+        or a :class:`Codec` instance
+
+    """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return _codecs[codec]()
+    except KeyError:
+        raise ValueError("Unknown codec: {0}".format(codec))
+
+
+class DecodedMessage:
+    """Received message whose payload has been decoded by a codec.
+
+    Handlers of topics with a registered codec receive this object instead
+    of the paho message. :attr:`payload` holds the decoded object and
+    :attr:`raw_payload` the original bytes. All other attributes, e.g.
+    ``topic``, ``qos`` and ``retain``, are those of the paho message.
+
+    """
+
+    __slots__ = ("_message", "payload", "codec")
+
+    def __init__(self, message: Any, payload: Any, codec: Codec) -> None:
+        self._message = message
+        self.payload = payload
+        self.codec = codec
+
+    @property
+    def raw_payload(self) -> bytes:
+        """Return the payload as received from the broker."""
+        return self._message.payload
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._message, name)
+
+    def __repr__(self) -> str:
+        return "DecodedMessage(topic={0!r}, payload={1!r})".format(
+            self._message.topic, self.payload
+        )
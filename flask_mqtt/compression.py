@@ -0,0 +1,158 @@
+"""Compression of message payloads.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import zlib
+from typing import Any, Dict, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+#: key of the MQTT 5 user property naming the compression of a payload
+CONTENT_ENCODING = "content-encoding"
+
+#: ways to mark a compressed message
+MARKERS = ("property", "topic")
+
+
+class Compressor:
+    """Base class of all payload compressors.
+
+    Subclasses implement :meth:`compress` and :meth:`decompress`.
+
+    """
+
+    #: name used to look up the compressor and to mark compressed messages
+    name = ""
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress *data*."""
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress *data*."""
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    """Compress payloads with zlib.
+
+    :param level: compression level from 1 (fastest) to 9 (smallest)
+
+    """
+
+    name = "zlib"
+
+    def __init__(self, level: int = 6) -> None:
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    """Compress payloads with Zstandard (requires zstandard).
+
+    :param level: compression level from 1 (fastest) to 22 (smallest)
+
+    """
+
+    name = "zstd"
+
+    def __init__(self, level: int = 3) -> None:
+        if zstandard is None:
+            raise ImportError("The zstd compression requires the zstandard package")
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        # compressor objects are not thread-safe, creating one is cheap
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Compressor(Compressor):
+    """Compress payloads with LZ4 frames (requires lz4)."""
+
+    name = "lz4"
+
+    def __init__(self) -> None:
+        if lz4_frame is None:
+            raise ImportError("The lz4 compression requires the lz4 package")
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4_frame.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4_frame.decompress(data)
+
+
+_compressors: Dict[str, type] = {
+    compressor.name: compressor
+    for compressor in (ZlibCompressor, ZstdCompressor, Lz4Compressor)
+}
+
+#: names of the supported compressions
+COMPRESSIONS = tuple(_compressors)
+
+
+def get_compressor(compressor: Union[str, Compressor]) -> Compressor:
+    """Return a compressor instance for a compressor name or instance.
+
+    :param compressor: one of ``"zlib"``, ``"zstd"``, ``"lz4"`` or a
+        :class:`Compressor` instance
+
+    """
+    if isinstance(compressor, Compressor):
+        return compressor
+    try:
+        return _compressors[compressor]()
+    except KeyError:
+        raise ValueError("Unknown compression: {0}".format(compressor))
+
+
+class DecompressedMessage:
+    """Received message whose payload has been decompressed.
+
+    :attr:`payload` holds the decompressed bytes and :attr:`topic` the topic
+    without a compression marker. All other attributes are those of the paho
+    message.
+
+    """
+
+    __slots__ = ("_message", "topic", "payload", "compressor")
+
+    def __init__(
+        self, message: Any, topic: str, payload: bytes, compressor: Compressor
+    ) -> None:
+        self._message = message
+        self.topic = topic
+        self.payload = payload
+        self.compressor = compressor
+
+    @property
+    def raw_payload(self) -> bytes:
+        """Return the payload as received from the broker."""
+        return self._message.payload
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._message, name)
+
+    def __repr__(self) -> str:
+        return "DecompressedMessage(topic={0!r}, compressor={1!r})".format(
+            self.topic, self.compressor.name
+        )
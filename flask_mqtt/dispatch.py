@@ -0,0 +1,121 @@
+"""Worker pool used to run message handlers off the network thread.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import logging
+import queue
+import threading
+from collections import namedtuple
+from typing import Any, Callable, List, Optional
+
+#: Snapshot of the dispatcher state
+DispatchStats = namedtuple(
+    "DispatchStats", ["workers", "busy_workers", "queue_depth", "queue_size"]
+)
+
+logger = logging.getLogger(__name__)
+
+# marker put on the queue to stop a worker thread
+_STOP = object()
+
+
+class Dispatcher:
+    """Bounded thread pool for MQTT message handlers.
+
+    Handlers are put on a queue by the paho network thread and executed by
+    a fixed number of worker threads. If the queue is full :meth:`submit`
+    blocks, which throttles the network thread instead of growing memory.
+
+    :param workers: number of worker threads
+    :param queue_size: maximum number of pending handler calls, 0 means
+        unbounded
+    :param name: prefix for the worker thread names
+
+    """
+
+    def __init__(
+        self, workers: int, queue_size: int = 0, name: str = "flask-mqtt-dispatch"
+    ) -> None:
+        if workers < 1:
+            raise ValueError("Dispatcher needs at least one worker")
+        self.workers = workers
+        self.queue_size = queue_size
+        self.name = name
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self._threads: List[threading.Thread] = []
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        """Return True if the worker threads have been started."""
+        return bool(self._threads)
+
+    @property
+    def queue_depth(self) -> int:
+        """Return the number of handler calls waiting for a worker."""
+        return self._queue.qsize()
+
+    @property
+    def busy_workers(self) -> int:
+        """Return the number of workers currently executing a handler."""
+        return self._busy
+
+    def stats(self) -> DispatchStats:
+        """Return a snapshot of the current queue and worker utilisation."""
+        return DispatchStats(
+            workers=self.workers,
+            busy_workers=self._busy,
+            queue_depth=self._queue.qsize(),
+            queue_size=self.queue_size,
+        )
+
+    def start(self) -> None:
+        """Start the worker threads."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name="{0}-{1}".format(self.name, i), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the worker threads after the pending handlers have run.
+
+        :param timeout: maximum time in seconds to wait for each worker
+
+        """
+        threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def submit(self, handler: Callable[..., Any], *args: Any) -> None:
+        """Queue a handler call, blocking while the queue is full."""
+        self._queue.put((handler, args))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            handler, args = item
+            with self._busy_lock:
+                self._busy += 1
+            try:
+                handler(*args)
+            except Exception:
+                logger.exception(
+                    "Exception in message handler {0}".format(
+                        getattr(handler, "__name__", handler)
+                    )
+                )
+            finally:
+                with self._busy_lock:
+                    self._busy -= 1
@@ -0,0 +1,557 @@
+"""In-memory transport routing messages between clients of the same process.
+
+The :class:`LoopbackClient` has the parts of the paho client API used by
+Flask-MQTT and is selected with ``MQTT_TRANSPORT = "loopback"``. Clients
+connecting to the same broker URL and port share a :class:`LoopbackBroker`,
+which routes published messages to the matching subscriptions right away
+in the publishing thread. No socket is opened, which makes tests and
+benchmarks independent of a real broker.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .router import TopicRouter, topic_matches
+
+# values of the paho constants, paho.mqtt.client is not imported so the
+# loopback transport keeps working when it is replaced by a mock in tests
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+MQTT_ERR_CONN_LOST = 7
+MQTTv311 = 4
+MQTTv5 = 5
+
+#: Result of :meth:`LoopbackClient.publish`, unpacks like paho's MQTTMessageInfo
+PublishInfo = namedtuple("PublishInfo", ["rc", "mid"])
+
+logger = logging.getLogger(__name__)
+
+
+def _to_bytes(payload: Any) -> bytes:
+    # the same conversion paho applies to published payloads
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    if isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    raise TypeError("payload must be a string, bytearray, int, float or None.")
+
+
+def _check_topic(topic: str) -> None:
+    if not topic:
+        raise ValueError("Invalid topic.")
+    if "+" in topic or "#" in topic:
+        raise ValueError("Publish topic cannot contain wildcards.")
+
+
+def _check_qos(qos: int) -> None:
+    if qos < 0 or qos > 2:
+        raise ValueError("Invalid QoS level.")
+
+
+class LoopbackMessage:
+    """Message delivered by the loopback transport.
+
+    Has the attributes of paho's MQTTMessage used by message handlers.
+
+    """
+
+    __slots__ = ("topic", "payload", "qos", "retain", "mid", "properties", "timestamp", "dup")
+
+    def __init__(
+        self,
+        topic: str,
+        payload: bytes,
+        qos: int = 0,
+        retain: bool = False,
+        mid: int = 0,
+        properties: Any = None,
+    ) -> None:
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.properties = properties
+        self.timestamp = time.monotonic()
+        self.dup = False
+
+    def __repr__(self) -> str:
+        return "LoopbackMessage(topic={0!r}, qos={1}, retain={2})".format(
+            self.topic, self.qos, self.retain
+        )
+
+
+class LoopbackBroker:
+    """Broker routing messages between the loopback clients connected to it.
+
+    Messages are delivered one at a time: a publish calls the message
+    callbacks of all matching subscriptions before it returns, and a lock
+    keeps publishes of other threads waiting meanwhile. Messages published
+    by a callback are delivered before the outer publish returns.
+
+    The broker supports the ``+`` and ``#`` wildcards, retained messages,
+    shared subscriptions, which are served round-robin, and last will
+    messages. Sessions are not persistent: all subscriptions of a client
+    are removed when it disconnects.
+
+    :param host: broker URL the clients connect to
+    :param port: broker port the clients connect to
+
+    **Example usage:**::
+
+        broker = get_broker('localhost', 1883)
+        broker.publish('home/mytopic', 'hello', retain=True)
+
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 1883) -> None:
+        self.host = host
+        self.port = port
+        self._clients: List["LoopbackClient"] = []
+        # topic filter -> (topic filter, {(share group, client): qos})
+        self._subscriptions = TopicRouter()
+        self._retained: Dict[str, LoopbackMessage] = {}
+        # (share group, topic filter) -> number of delivered messages
+        self._shared_counts: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def publish(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Any = None,
+    ) -> None:
+        """Send a message to all matching subscriptions, e.g. from a test."""
+        _check_topic(topic)
+        _check_qos(qos)
+        self._route(topic, _to_bytes(payload), qos, retain, properties)
+
+    def retained(self, topic: str) -> Optional[bytes]:
+        """Return the payload of the retained message of *topic* or None."""
+        message = self._retained.get(topic)
+        return None if message is None else message.payload
+
+    def drop_connections(self) -> None:
+        """Disconnect all clients as if the network failed.
+
+        The last will messages of the clients are published. Clients whose
+        network loop is running reconnect right away.
+
+        """
+        with self._lock:
+            clients = list(self._clients)
+            for client in clients:
+                self._remove(client)
+            for client in clients:
+                client._lost()
+            for client in clients:
+                if client._loop_started:
+                    client.reconnect()
+
+    def _add(self, client: "LoopbackClient") -> None:
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+
+    def _remove(self, client: "LoopbackClient") -> None:
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+            for topic_filter, (_, subscribers) in list(self._subscriptions.items()):
+                for key in [key for key in subscribers if key[1] is client]:
+                    del subscribers[key]
+                if not subscribers:
+                    self._subscriptions.remove(topic_filter)
+
+    def _subscribe(
+        self, client: "LoopbackClient", subscriptions: List[Tuple[str, int]]
+    ) -> List[int]:
+        with self._lock:
+            for topic, qos in subscriptions:
+                group, topic_filter = self._split_share(topic)
+                entry = self._subscriptions.get(topic_filter)
+                if entry is None:
+                    entry = (topic_filter, {})
+                    self._subscriptions.add(topic_filter, entry)
+                entry[1][(group, client)] = qos
+            return [qos for _, qos in subscriptions]
+
+    def _send_retained(
+        self, client: "LoopbackClient", subscriptions: List[Tuple[str, int]]
+    ) -> None:
+        with self._lock:
+            for topic, message in list(self._retained.items()):
+                # shared subscriptions do not receive retained messages
+                granted = [
+                    qos
+                    for topic_filter, qos in subscriptions
+                    if not topic_filter.startswith("$share/")
+                    and topic_matches(topic_filter, topic)
+                ]
+                if granted:
+                    client._deliver(
+                        topic,
+                        message.payload,
+                        min(message.qos, max(granted)),
+                        True,
+                        message.properties,
+                    )
+
+    def _unsubscribe(self, client: "LoopbackClient", topics: List[str]) -> None:
+        with self._lock:
+            for topic in topics:
+                group, topic_filter = self._split_share(topic)
+                entry = self._subscriptions.get(topic_filter)
+                if entry is None:
+                    continue
+                entry[1].pop((group, client), None)
+                if not entry[1]:
+                    self._subscriptions.remove(topic_filter)
+
+    @staticmethod
+    def _split_share(topic: str) -> Tuple[Optional[str], str]:
+        if topic.startswith("$share/"):
+            parts = topic.split("/", 2)
+            if len(parts) == 3:
+                return parts[1], parts[2]
+        return None, topic
+
+    def _route(
+        self, topic: str, payload: bytes, qos: int, retain: bool, properties: Any
+    ) -> None:
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = LoopbackMessage(
+                        topic, payload, qos, True, properties=properties
+                    )
+                else:
+                    self._retained.pop(topic, None)
+
+            # a client receives a message once, with the highest granted QoS
+            granted: Dict[LoopbackClient, int] = {}
+            for topic_filter, subscribers in self._subscriptions.match(topic):
+                groups: Dict[str, List[Tuple[LoopbackClient, int]]] = {}
+                for (group, client), subscription_qos in subscribers.items():
+                    if group is None:
+                        granted[client] = max(granted.get(client, 0), subscription_qos)
+                    else:
+                        groups.setdefault(group, []).append((client, subscription_qos))
+                for share, members in groups.items():
+                    # one member of each share group, in turn
+                    key = (share, topic_filter)
+                    count = self._shared_counts.get(key, 0)
+                    self._shared_counts[key] = count + 1
+                    client, subscription_qos = members[count % len(members)]
+                    granted[client] = max(granted.get(client, 0), subscription_qos)
+
+            for client, subscription_qos in granted.items():
+                client._deliver(topic, payload, min(qos, subscription_qos), False, properties)
+
+
+_brokers: Dict[Tuple[str, int], LoopbackBroker] = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(host: str = "localhost", port: int = 1883) -> LoopbackBroker:
+    """Return the loopback broker for *host* and *port*, creating it if needed."""
+    with _brokers_lock:
+        broker = _brokers.get((host, port))
+        if broker is None:
+            broker = _brokers[(host, port)] = LoopbackBroker(host, port)
+        return broker
+
+
+def reset() -> None:
+    """Forget all loopback brokers and their retained messages.
+
+    Meant to be called between tests. Clients that are connected keep the
+    broker they are connected to, clients connecting afterwards get a new
+    one.
+
+    """
+    with _brokers_lock:
+        _brokers.clear()
+
+
+def _after_fork_in_child() -> None:
+    global _brokers_lock
+    # a forked child routes its messages in its own brokers
+    _brokers_lock = threading.Lock()
+    _brokers.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class LoopbackClient:
+    """Replacement of paho's Client for the loopback transport.
+
+    Callbacks are called with the arguments of paho's callback API version
+    1, including the MQTT 5 arguments if :attr:`protocol` is MQTTv5. Reason
+    codes are passed as integers. The callbacks run in the thread that
+    caused them, e.g. :attr:`on_message` in the thread of the publisher.
+
+    :param client_id: the client id
+    :param broker: the broker to connect to, by default the one returned by
+        :func:`get_broker` for the host and port passed to :meth:`connect`
+
+    """
+
+    def __init__(
+        self, client_id: str = "", broker: Optional[LoopbackBroker] = None
+    ) -> None:
+        self._client_id = client_id
+        self.transport = "loopback"
+        self.protocol = MQTTv311
+        self.clean_session = True
+        self.on_connect: Optional[Callable[..., Any]] = None
+        self.on_disconnect: Optional[Callable[..., Any]] = None
+        self.on_message: Optional[Callable[..., Any]] = None
+        self.on_publish: Optional[Callable[..., Any]] = None
+        self.on_subscribe: Optional[Callable[..., Any]] = None
+        self.on_unsubscribe: Optional[Callable[..., Any]] = None
+        self._userdata: Any = None
+        self._broker = broker
+        self._host = "localhost"
+        self._port = 1883
+        self._connected = False
+        self._connect_pending = False
+        self._loop_started = False
+        self._will: Optional[Tuple[str, bytes, int, bool, Any]] = None
+        # QoS > 0 messages published while disconnected
+        self._queued: List[Tuple[int, str, bytes, int, bool, Any]] = []
+        self._mids = itertools.count()
+
+    def __repr__(self) -> str:
+        return "LoopbackClient(client_id={0!r})".format(self._client_id)
+
+    def _next_mid(self) -> int:
+        return next(self._mids) % 65535 + 1
+
+    def _call(self, name: str, *args: Any) -> None:
+        callback = getattr(self, name)
+        if callback is None:
+            return
+        try:
+            callback(self, self._userdata, *args)
+        except Exception:
+            # like a broker, never let a subscriber break the publisher
+            logger.exception("Error in {0} of {1!r}".format(name, self))
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def user_data_set(self, userdata: Any) -> None:
+        self._userdata = userdata
+
+    def enable_logger(self, logger: Any = None) -> None:
+        pass
+
+    def disable_logger(self) -> None:
+        pass
+
+    def username_pw_set(self, username: Optional[str], password: Optional[str] = None) -> None:
+        pass
+
+    def tls_set(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def tls_insecure_set(self, value: bool) -> None:
+        pass
+
+    def reconnect_delay_set(self, min_delay: int = 1, max_delay: int = 120) -> None:
+        pass
+
+    def will_set(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Any = None,
+    ) -> None:
+        _check_topic(topic)
+        _check_qos(qos)
+        self._will = (topic, _to_bytes(payload), qos, retain, properties)
+
+    def will_clear(self) -> None:
+        self._will = None
+
+    def connect(
+        self, host: str = "localhost", port: int = 1883, keepalive: int = 60, **kwargs: Any
+    ) -> int:
+        """Connect to the broker of *host* and *port* and call on_connect."""
+        self._host, self._port = host, port
+        return self.reconnect()
+
+    def connect_async(
+        self, host: str = "localhost", port: int = 1883, keepalive: int = 60, **kwargs: Any
+    ) -> None:
+        """Connect when the network loop is started."""
+        self._host, self._port = host, port
+        self._connect_pending = True
+        if self._loop_started:
+            self.loop_start()
+
+    def reconnect(self) -> int:
+        self._connect_pending = False
+        if self._broker is None:
+            self._broker = get_broker(self._host, self._port)
+        broker = self._broker
+        with broker._lock:
+            broker._add(self)
+            self._connected = True
+            if self.protocol == MQTTv5:
+                self._call("on_connect", {"session present": 0}, 0, None)
+            else:
+                self._call("on_connect", {"session present": 0}, 0)
+            queued, self._queued = self._queued, []
+            for mid, topic, payload, qos, retain, properties in queued:
+                broker._route(topic, payload, qos, retain, properties)
+                self._call("on_publish", mid)
+        return MQTT_ERR_SUCCESS
+
+    def disconnect(self, reasoncode: Any = None, properties: Any = None) -> int:
+        """Disconnect from the broker without sending the last will."""
+        if not self._connected or self._broker is None:
+            return MQTT_ERR_NO_CONN
+        self._broker._remove(self)
+        self._connected = False
+        self._disconnected(MQTT_ERR_SUCCESS)
+        return MQTT_ERR_SUCCESS
+
+    def _lost(self) -> None:
+        # called by the broker with the client already removed
+        self._connected = False
+        if self._will is not None and self._broker is not None:
+            self._broker._route(*self._will)
+        self._disconnected(MQTT_ERR_CONN_LOST)
+
+    def _disconnected(self, rc: int) -> None:
+        if self.protocol == MQTTv5:
+            self._call("on_disconnect", rc, None)
+        else:
+            self._call("on_disconnect", rc)
+
+    def loop_start(self) -> int:
+        self._loop_started = True
+        if self._connect_pending:
+            self.reconnect()
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self) -> int:
+        self._loop_started = False
+        return MQTT_ERR_SUCCESS
+
+    def loop(self, timeout: float = 1.0) -> int:
+        # messages are delivered by publish(), there is nothing to process
+        return MQTT_ERR_SUCCESS if self._connected else MQTT_ERR_NO_CONN
+
+    def publish(
+        self,
+        topic: str,
+        payload: Any = None,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Any = None,
+    ) -> PublishInfo:
+        """Deliver a message to the matching subscriptions and call on_publish.
+
+        If the client is not connected, messages with QoS > 0 are sent on
+        the next connect and messages with QoS 0 are dropped.
+
+        """
+        _check_topic(topic)
+        _check_qos(qos)
+        payload = _to_bytes(payload)
+        mid = self._next_mid()
+        broker = self._broker
+        if not self._connected or broker is None:
+            if qos > 0:
+                self._queued.append((mid, topic, payload, qos, retain, properties))
+            return PublishInfo(MQTT_ERR_NO_CONN, mid)
+        with broker._lock:
+            broker._route(topic, payload, qos, retain, properties)
+            self._call("on_publish", mid)
+        return PublishInfo(MQTT_ERR_SUCCESS, mid)
+
+    def subscribe(
+        self, topic: Any, qos: int = 0, options: Any = None, properties: Any = None
+    ) -> Tuple[int, Optional[int]]:
+        """Subscribe to a topic, a (topic, qos) tuple or a list of them.
+
+        on_subscribe is called before the retained messages are delivered.
+
+        """
+        if isinstance(topic, str):
+            subscriptions = [(topic, qos)]
+        elif isinstance(topic, tuple):
+            subscriptions = [(topic[0], topic[1])]
+        else:
+            subscriptions = [(t, q) for t, q in topic]
+        if not subscriptions:
+            raise ValueError("No topic specified, or incorrect topic type.")
+        for _, q in subscriptions:
+            _check_qos(q)
+        broker = self._broker
+        if not self._connected or broker is None:
+            return MQTT_ERR_NO_CONN, None
+        mid = self._next_mid()
+        with broker._lock:
+            granted = broker._subscribe(self, subscriptions)
+            if self.protocol == MQTTv5:
+                self._call("on_subscribe", mid, granted, None)
+            else:
+                self._call("on_subscribe", mid, tuple(granted))
+            broker._send_retained(self, subscriptions)
+        return MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic: Any, properties: Any = None) -> Tuple[int, Optional[int]]:
+        """Unsubscribe from a topic or a list of topics."""
+        topics = [topic] if isinstance(topic, str) else list(topic)
+        broker = self._broker
+        if not self._connected or broker is None:
+            return MQTT_ERR_NO_CONN, None
+        mid = self._next_mid()
+        with broker._lock:
+            broker._unsubscribe(self, topics)
+            if self.protocol == MQTTv5:
+                self._call("on_unsubscribe", mid, None, [0] * len(topics))
+            else:
+                self._call("on_unsubscribe", mid)
+        return MQTT_ERR_SUCCESS, mid
+
+    def _deliver(
+        self, topic: str, payload: bytes, qos: int, retain: bool, properties: Any
+    ) -> None:
+        if not self._connected:
+            return
+        message = LoopbackMessage(
+            topic,
+            payload,
+            qos,
+            retain,
+            self._next_mid() if qos else 0,
+            properties if self.protocol == MQTTv5 else None,
+        )
+        self._call("on_message", message)
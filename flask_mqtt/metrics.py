@@ -0,0 +1,239 @@
+"""Counters and histograms describing the state of a Mqtt client.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import bisect
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+#: default histogram buckets in seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+#: label value used when a metric exceeds its maximum number of label values
+OTHER = "__other__"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type = ""
+
+    def __init__(
+        self, name: str, help: str, label: Optional[str] = None, max_labels: int = 1000
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label = label
+        self.max_labels = max_labels
+        self._lock = threading.Lock()
+
+    def _key(self, label: str, existing: Dict) -> str:
+        # limit the cardinality of e.g. per topic metrics
+        if label in existing or len(existing) < self.max_labels:
+            return label
+        return OTHER
+
+    def _labels(self, label: str, extra: str = "") -> str:
+        parts = []
+        if self.label is not None:
+            parts.append('{0}="{1}"'.format(self.label, _escape(label)))
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> List[str]:
+        """Return the metric in the Prometheus text format."""
+        return [
+            "# HELP {0} {1}".format(self.name, self.help),
+            "# TYPE {0} {1}".format(self.name, self.type),
+        ]
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter, optionally with one label."""
+
+    type = "counter"
+
+    def __init__(
+        self, name: str, help: str, label: Optional[str] = None, max_labels: int = 1000
+    ) -> None:
+        super().__init__(name, help, label, max_labels)
+        self._values: Dict[str, float] = {}
+
+    def inc(self, label: str = "", amount: float = 1) -> None:
+        """Increase the counter for *label* by *amount*."""
+        with self._lock:
+            key = self._key(label, self._values)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, label: str = "") -> float:
+        """Return the counter value for *label*."""
+        return self._values.get(label, 0)
+
+    def total(self) -> float:
+        """Return the sum over all labels."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and self.label is None:
+            items = [("", 0)]
+        for label, value in items:
+            lines.append("{0}{1} {2}".format(self.name, self._labels(label), value))
+        return lines
+
+
+class Gauge(_Metric):
+    """Value that is read from a callback when rendered."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, func: Callable[[], float]) -> None:
+        super().__init__(name, help)
+        self.func = func
+
+    def value(self) -> float:
+        """Return the current value."""
+        return self.func()
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines.append("{0} {1}".format(self.name, self.func()))
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, optionally with one label."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label: Optional[str] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        max_labels: int = 1000,
+    ) -> None:
+        super().__init__(name, help, label, max_labels)
+        self.buckets = tuple(sorted(buckets))
+        # label -> (bucket counts, count, sum)
+        self._values: Dict[str, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, label: str = "") -> None:
+        """Add an observed *value* for *label*."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(label, self._values)
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0, 0.0])
+            entry[0][index] += 1
+            entry[1][0] += 1
+            entry[1][1] += value
+
+    def count(self, label: str = "") -> int:
+        """Return the number of observations for *label*."""
+        entry = self._values.get(label)
+        return int(entry[1][0]) if entry is not None else 0
+
+    def sum(self, label: str = "") -> float:
+        """Return the sum of all observations for *label*."""
+        entry = self._values.get(label)
+        return entry[1][1] if entry is not None else 0.0
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = sorted((k, (list(b), list(s))) for k, (b, s) in self._values.items())
+        for label, (buckets, (count, total)) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), buckets):
+                cumulative += n
+                le = 'le="{0}"'.format("+Inf" if bound == float("inf") else bound)
+                lines.append(
+                    "{0}_bucket{1} {2}".format(
+                        self.name, self._labels(label, le), cumulative
+                    )
+                )
+            lines.append("{0}_count{1} {2}".format(self.name, self._labels(label), count))
+            lines.append("{0}_sum{1} {2}".format(self.name, self._labels(label), total))
+        return lines
+
+
+class Metrics:
+    """Metrics collected by a :class:`flask_mqtt.Mqtt` instance.
+
+    Available as ``mqtt.metrics`` if ``MQTT_METRICS_ENABLED`` is set.
+
+    :param prefix: prefix of all metric names
+
+    """
+
+    def __init__(self, prefix: str = "mqtt") -> None:
+        self.prefix = prefix
+        self.messages_received = Counter(
+            prefix + "_messages_received_total", "Messages received.", "topic"
+        )
+        self.messages_published = Counter(
+            prefix + "_messages_published_total", "Messages published.", "topic"
+        )
+        self.publish_errors = Counter(
+            prefix + "_publish_errors_total", "Messages that could not be queued."
+        )
+        self.publish_ack_seconds = Histogram(
+            prefix + "_publish_ack_seconds",
+            "Time from publish() to the acknowledgement of the message.",
+        )
+        self.handler_seconds = Histogram(
+            prefix + "_handler_seconds", "Execution time of message handlers.", "handler"
+        )
+        self.connects = Counter(prefix + "_connects_total", "Successful connects.")
+        self.reconnects = Counter(
+            prefix + "_reconnects_total", "Successful connects after a disconnect."
+        )
+        self.disconnects = Counter(prefix + "_disconnects_total", "Disconnects.")
+        self.failovers = Counter(
+            prefix + "_failovers_total", "Switches to another broker after a disconnect."
+        )
+        self._metrics: List[_Metric] = [
+            self.messages_received,
+            self.messages_published,
+            self.publish_errors,
+            self.publish_ack_seconds,
+            self.handler_seconds,
+            self.connects,
+            self.reconnects,
+            self.disconnects,
+            self.failovers,
+        ]
+
+    def __iter__(self) -> Iterator[_Metric]:
+        return iter(list(self._metrics))
+
+    def add_gauge(self, name: str, help: str, func: Callable[[], float]) -> Gauge:
+        """Add a gauge whose value is read from *func* when rendered."""
+        gauge = Gauge(self.prefix + "_" + name, help, func)
+        self._metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _after_fork(self) -> None:
+        for metric in self._metrics:
+            metric._lock = threading.Lock()
@@ -0,0 +1,216 @@
+"""Bounded accounting of outgoing messages.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import collections
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+#: Snapshot of the outbound queue occupancy
+OutboundStats = namedtuple(
+    "OutboundStats", ["messages", "bytes", "held", "max_messages", "max_bytes"]
+)
+
+#: Message held back while the client is not connected
+OutboundMessage = namedtuple(
+    "OutboundMessage",
+    ["topic", "payload", "qos", "retain", "size", "future", "properties"],
+    defaults=(None,),
+)
+
+#: Policies applied if a message does not fit into the queue
+POLICIES = ("block", "drop-oldest", "drop-newest", "raise")
+
+
+class OutboundQueueFull(Exception):
+    """Raised if a message does not fit into the outbound queue."""
+
+
+def payload_size(payload: Any) -> int:
+    """Return the size in bytes *payload* has on the wire."""
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode("utf-8"))
+    return len(str(payload))
+
+
+class OutboundQueue:
+    """Limit the number and size of messages that have not been sent yet.
+
+    A message occupies the queue from :meth:`acquire` until :meth:`release`
+    is called, i.e. while it is held back during a disconnect or waits in
+    paho for its acknowledgement.
+
+    :param max_messages: maximum number of messages, 0 means unlimited
+    :param max_bytes: maximum sum of the payload sizes, 0 means unlimited
+    :param policy: what to do if a message does not fit, one of ``block``,
+        ``drop-oldest``, ``drop-newest`` or ``raise``
+    :param high_water: fill level between 0 and 1 at which
+        :attr:`on_high_water` is called
+    :param low_water: fill level between 0 and 1 at which :attr:`on_low_water`
+        is called after the high water mark has been reached
+    :param timeout: maximum time in seconds :meth:`acquire` blocks, None
+        blocks until there is space
+
+    """
+
+    def __init__(
+        self,
+        max_messages: int = 0,
+        max_bytes: int = 0,
+        policy: str = "block",
+        high_water: float = 0.8,
+        low_water: float = 0.5,
+        timeout: Optional[float] = None,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError("Unknown outbound queue policy: {0}".format(policy))
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.high_water = high_water
+        self.low_water = low_water
+        self.timeout = timeout
+        #: called with an :data:`OutboundStats` when the high water mark is reached
+        self.on_high_water: Optional[Callable[[OutboundStats], None]] = None
+        #: called with an :data:`OutboundStats` when the low water mark is reached
+        self.on_low_water: Optional[Callable[[OutboundStats], None]] = None
+        self._messages = 0
+        self._bytes = 0
+        self._held: Deque[OutboundMessage] = collections.deque()
+        self._above_high_water = False
+        self._cond = threading.Condition()
+
+    @property
+    def messages(self) -> int:
+        """Return the number of messages in the queue."""
+        return self._messages
+
+    @property
+    def bytes(self) -> int:
+        """Return the sum of the payload sizes in the queue."""
+        return self._bytes
+
+    def stats(self) -> OutboundStats:
+        """Return a snapshot of the queue occupancy."""
+        return OutboundStats(
+            messages=self._messages,
+            bytes=self._bytes,
+            held=len(self._held),
+            max_messages=self.max_messages,
+            max_bytes=self.max_bytes,
+        )
+
+    def _fits(self, size: int) -> bool:
+        if self.max_messages > 0 and self._messages + 1 > self.max_messages:
+            return False
+        # a single message larger than max_bytes is accepted by an empty queue
+        if self.max_bytes > 0 and self._bytes + size > self.max_bytes:
+            return self._messages == 0
+        return True
+
+    def _level(self) -> float:
+        level = 0.0
+        if self.max_messages > 0:
+            level = self._messages / self.max_messages
+        if self.max_bytes > 0:
+            level = max(level, self._bytes / self.max_bytes)
+        return level
+
+    def acquire(self, size: int, block: bool = True) -> Tuple[bool, List[OutboundMessage]]:
+        """Reserve space for a message of *size* bytes.
+
+        :param size: the payload size of the message
+        :param block: if False the ``block`` policy behaves like ``drop-newest``
+
+        :returns: a tuple (admitted, dropped) where dropped holds the messages
+            removed by the ``drop-oldest`` policy
+
+        :raises OutboundQueueFull: if the message does not fit and the policy
+            is ``raise``
+
+        """
+        dropped: List[OutboundMessage] = []
+        with self._cond:
+            if not self._fits(size):
+                if self.policy == "block" and block:
+                    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+                    while not self._fits(size):
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                elif self.policy == "drop-oldest":
+                    # only messages that have not been handed to paho can be dropped
+                    while self._held and not self._fits(size):
+                        item = self._held.popleft()
+                        self._messages -= 1
+                        self._bytes -= item.size
+                        dropped.append(item)
+                if not self._fits(size):
+                    if self.policy == "raise":
+                        raise OutboundQueueFull(
+                            "Outbound queue full ({0} messages, {1} bytes)".format(
+                                self._messages, self._bytes
+                            )
+                        )
+                    return False, dropped
+            self._messages += 1
+            self._bytes += size
+            crossed = not self._above_high_water and self._level() >= self.high_water
+            if crossed:
+                self._above_high_water = True
+                stats = self.stats()
+        if crossed and self.on_high_water is not None:
+            self.on_high_water(stats)
+        return True, dropped
+
+    def release(self, size: int) -> None:
+        """Free the space of a sent or discarded message of *size* bytes."""
+        with self._cond:
+            self._messages -= 1
+            self._bytes -= size
+            self._cond.notify_all()
+            crossed = self._above_high_water and self._level() <= self.low_water
+            if crossed:
+                self._above_high_water = False
+                stats = self.stats()
+        if crossed and self.on_low_water is not None:
+            self.on_low_water(stats)
+
+    def hold(self, message: OutboundMessage, condition: Callable[[], bool]) -> bool:
+        """Hold back an acquired *message* if *condition* returns True.
+
+        The condition is evaluated under the same lock as :meth:`take_held`,
+        so a message is never held back after the held messages have been
+        taken.
+
+        """
+        with self._cond:
+            if not condition():
+                return False
+            self._held.append(message)
+            return True
+
+    def take_held(self) -> List[OutboundMessage]:
+        """Remove and return all held messages, they stay acquired."""
+        with self._cond:
+            held = list(self._held)
+            self._held.clear()
+            return held
+
+    def _after_fork(self) -> None:
+        # the messages in the queue are sent by the parent process
+        self._messages = 0
+        self._bytes = 0
+        self._held = collections.deque()
+        self._above_high_water = False
+        self._cond = threading.Condition()
@@ -0,0 +1,225 @@
+"""Topic tree used to match incoming messages against topic filters.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+def strip_share(topic_filter: str) -> str:
+    """Return the topic filter of a shared subscription.
+
+    ``$share/<group>/<filter>`` is returned as ``<filter>``, other topic
+    filters are returned unchanged.
+
+    """
+    if topic_filter.startswith("$share/"):
+        parts = topic_filter.split("/", 2)
+        if len(parts) == 3:
+            return parts[2]
+    return topic_filter
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Return True if *topic* matches *topic_filter*.
+
+    The ``+`` and ``#`` wildcards do not match topics starting with ``$``
+    on the first level.
+
+    """
+    if topic_filter == topic:
+        return True
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index == len(levels) or (level != "+" and level != levels[index]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+def filter_covers(topic_filter: str, other: str) -> bool:
+    """Return True if every topic matching *other* matches *topic_filter*.
+
+    *other* may contain wildcards, e.g. ``home/#`` covers ``home/+/temp``
+    but not ``+/temp``.
+
+    """
+    if topic_filter == other:
+        return True
+    filter_levels = topic_filter.split("/")
+    other_levels = other.split("/")
+    if other.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index == len(other_levels) or other_levels[index] == "#":
+            return False
+        if level != "+" and level != other_levels[index]:
+            return False
+    return len(filter_levels) == len(other_levels)
+
+
+class _Node:
+    __slots__ = ("children", "value", "order")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        self.value: Any = None
+        self.order: int = -1
+
+
+class TopicRouter:
+    """Map MQTT topic filters to values, e.g. message handlers.
+
+    The filters are stored in a tree with one level per topic level, so
+    the cost of :meth:`match` depends on the depth of the topic and not on
+    the number of registered filters. The ``+`` and ``#`` wildcards are
+    supported. Results are cached per topic until the next change of the
+    tree.
+
+    As with paho's ``message_callback_add()`` each filter holds a single
+    value; adding a filter again replaces the previous value.
+
+    :param cache_size: maximum number of cached topics
+
+    **Example usage:**::
+
+        router = TopicRouter()
+        router.add('home/+/temperature', handle_temperature)
+        router.match('home/kitchen/temperature')  # (handle_temperature,)
+
+    """
+
+    def __init__(self, cache_size: int = 4096) -> None:
+        self.cache_size = cache_size
+        self._root = _Node()
+        self._cache: Dict[str, Tuple[Any, ...]] = {}
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, topic_filter: str) -> bool:
+        return self.get(topic_filter) is not None
+
+    def add(self, topic_filter: str, value: Any) -> None:
+        """Add *value* for *topic_filter*, replacing a previous value."""
+        if value is None:
+            raise ValueError("value must not be None")
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _Node())
+            if node.value is None:
+                self._len += 1
+            node.value = value
+            node.order = self._counter
+            self._counter += 1
+            self._cache = {}
+
+    def remove(self, topic_filter: str) -> Any:
+        """Remove *topic_filter* and return its value or None."""
+        with self._lock:
+            path = []
+            node = self._root
+            for level in topic_filter.split("/"):
+                child = node.children.get(level)
+                if child is None:
+                    return None
+                path.append((node, level))
+                node = child
+            value = node.value
+            if value is None:
+                return None
+            node.value = None
+            self._len -= 1
+            # prune empty branches
+            for parent, level in reversed(path):
+                child = parent.children[level]
+                if child.value is not None or child.children:
+                    break
+                del parent.children[level]
+            self._cache = {}
+            return value
+
+    def get(self, topic_filter: str) -> Any:
+        """Return the value stored for *topic_filter* or None."""
+        node = self._root
+        for level in topic_filter.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                return None
+            node = child
+        return node.value
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """Iterate over all (topic_filter, value) pairs."""
+        stack: List[Tuple[Optional[str], _Node]] = [(None, self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            for level, child in node.children.items():
+                path = level if prefix is None else prefix + "/" + level
+                if child.value is not None:
+                    yield path, child.value
+                stack.append((path, child))
+
+    def match(self, topic: str) -> Tuple[Any, ...]:
+        """Return the values of all filters matching *topic*.
+
+        The values are returned in the order their filters were added.
+
+        """
+        cache = self._cache
+        try:
+            return cache[topic]
+        except KeyError:
+            pass
+
+        with self._lock:
+            found: List[Tuple[int, Any]] = []
+            self._match(self._root, topic.split("/"), 0, topic.startswith("$"), found)
+            found.sort(key=lambda item: item[0])
+            result = tuple(value for _, value in found)
+            if len(self._cache) >= self.cache_size:
+                self._cache = {}
+            self._cache[topic] = result
+        return result
+
+    def _match(
+        self,
+        node: _Node,
+        levels: List[str],
+        index: int,
+        system: bool,
+        found: List[Tuple[int, Any]],
+    ) -> None:
+        # wildcards do not match topics starting with "$" on the first level
+        wildcards = not (system and index == 0)
+        if wildcards:
+            child = node.children.get("#")
+            if child is not None and child.value is not None:
+                found.append((child.order, child.value))
+        if index == len(levels):
+            if node.value is not None:
+                found.append((node.order, node.value))
+            return
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, system, found)
+        if wildcards:
+            child = node.children.get("+")
+            if child is not None:
+                self._match(child, levels, index + 1, system, found)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
@@ -0,0 +1,241 @@
+"""Persistent store for messages published while the client is offline.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import glob
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from typing import Any, Iterable, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, which has no fork() either
+    fcntl = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+#: Message read from the spool, ``id`` increases in publish order
+SpooledMessage = namedtuple(
+    "SpooledMessage", ["id", "topic", "payload", "qos", "retain", "properties"]
+)
+
+
+def to_bytes(payload: Any) -> bytes:
+    """Convert a payload to bytes the way paho does when publishing."""
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    if isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    raise TypeError("payload must be a string, bytes, int, float or None")
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+class Spool:
+    """Append-only message store backed by SQLite.
+
+    Messages are appended to a single table in write-ahead-log mode, so
+    spooling is a sequential write and replaying a sequential read in
+    batches of ascending ids. Messages stay on disk until :meth:`delete` is
+    called for them and survive a restart of the process.
+
+    :param path: path of the database file, ``":memory:"`` for a store that
+        does not survive the process
+    :param batch_size: number of messages returned by :meth:`read`
+    :param synchronous: value of SQLite's ``synchronous`` pragma, ``FULL``
+        syncs every message to disk, ``NORMAL`` only at checkpoints
+
+    """
+
+    def __init__(
+        self, path: str, batch_size: int = 500, synchronous: str = "NORMAL"
+    ) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self._lock = threading.Lock()
+        self._inherited: List[sqlite3.Connection] = []
+        self._db = self._open(path)
+
+    def _open(self, path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous={0}".format(self.synchronous))
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "topic TEXT NOT NULL, payload BLOB NOT NULL, "
+            "qos INTEGER NOT NULL, retain INTEGER NOT NULL, properties BLOB)"
+        )
+        return db
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def append(
+        self,
+        topic: str,
+        payload: Any,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Optional[bytes] = None,
+    ) -> int:
+        """Append a message and return its id.
+
+        :param properties: the packed MQTT 5 properties of the message
+
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO messages (topic, payload, qos, retain, properties) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (topic, to_bytes(payload), qos, int(retain), properties),
+            )
+            return cursor.lastrowid or 0
+
+    def read(self, after: int = 0, limit: int = 0) -> List[SpooledMessage]:
+        """Return the oldest messages with an id greater than *after*.
+
+        :param after: id of the last message already read
+        :param limit: maximum number of messages, defaults to ``batch_size``
+
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, topic, payload, qos, retain, properties FROM messages "
+                "WHERE id > ? ORDER BY id LIMIT ?",
+                (after, limit or self.batch_size),
+            ).fetchall()
+        return [
+            SpooledMessage(
+                id,
+                topic,
+                bytes(payload),
+                qos,
+                bool(retain),
+                bytes(properties) if properties is not None else None,
+            )
+            for id, topic, payload, qos, retain, properties in rows
+        ]
+
+    def delete(self, ids: Iterable[int]) -> None:
+        """Delete the messages with the given ids in one transaction."""
+        rows = [(id,) for id in ids]
+        if not rows:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("DELETE FROM messages WHERE id = ?", rows)
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def adopt(self, path: str) -> int:
+        """Move the messages of another spool file into this one.
+
+        The messages are appended in their order and the file is deleted
+        afterwards.
+
+        :param path: path of the database file to adopt
+
+        :returns: the number of adopted messages
+
+        """
+        with self._lock:
+            self._db.execute("ATTACH DATABASE ? AS adopted", (path,))
+            try:
+                self._db.execute("BEGIN")
+                try:
+                    count = self._db.execute(
+                        "INSERT INTO messages (topic, payload, qos, retain, properties) "
+                        "SELECT topic, payload, qos, retain, properties "
+                        "FROM adopted.messages ORDER BY id"
+                    ).rowcount
+                except Exception:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self._db.execute("COMMIT")
+            finally:
+                self._db.execute("DETACH DATABASE adopted")
+        for name in (path, path + "-wal", path + "-shm"):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+        return count
+
+    def adopt_orphans(self, base: str) -> int:
+        """Adopt the spool files of processes that have exited.
+
+        Forked processes spool to ``<base>.<pid>``. The files of processes
+        that do not exist anymore are adopted with :meth:`adopt`, so their
+        messages are replayed by this process. An exclusive lock on
+        ``<base>.lock`` keeps two processes from adopting the same file.
+        Does nothing on platforms without ``fcntl``.
+
+        :param base: the configured path of the spool
+
+        :returns: the number of adopted messages
+
+        """
+        if fcntl is None or base == ":memory:":
+            return 0
+        count = 0
+        with open(base + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                for path in sorted(glob.glob(glob.escape(base) + ".*")):
+                    pid = path[len(base) + 1 :]
+                    if not pid.isdigit() or path == self.path or _process_exists(int(pid)):
+                        continue
+                    try:
+                        adopted = self.adopt(path)
+                    except sqlite3.Error as e:
+                        logger.error("Error adopting spool {0}: {1}".format(path, repr(e)))
+                        continue
+                    logger.info(
+                        "Adopted {0} messages of the spool of process {1}".format(
+                            adopted, pid
+                        )
+                    )
+                    count += adopted
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return count
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def _after_fork(self, path: str) -> None:
+        # a SQLite connection must not be used in a forked child. The
+        # inherited one is kept open, closing it could remove the WAL files
+        # the parent is using.
+        self._inherited.append(self._db)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = self._open(path)
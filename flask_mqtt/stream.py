@@ -0,0 +1,211 @@
+"""Fan-out of received messages to HTTP streaming responses.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+
+import collections
+import json
+import threading
+from collections import namedtuple
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Set
+
+from .codecs import DecodedMessage
+from .router import TopicRouter
+
+#: Snapshot of the streaming listeners
+StreamStats = namedtuple("StreamStats", ["filters", "listeners", "dropped"])
+
+
+class Listener:
+    """Bounded queue of the messages received for one HTTP client.
+
+    Created by :meth:`flask_mqtt.Mqtt.listen`. If the client does not keep up
+    the oldest messages are dropped, so a slow client never blocks the
+    network thread or other clients.
+
+    Iterating a listener yields the messages until it is closed.
+
+    :param topic_filter: the topic filter of the messages
+    :param queue_size: maximum number of messages waiting to be read
+
+    """
+
+    def __init__(self, topic_filter: str, queue_size: int = 100) -> None:
+        self.topic_filter = topic_filter
+        self.queue_size = queue_size
+        #: number of messages dropped because the queue was full
+        self.dropped = 0
+        self.on_close: Optional[Callable[["Listener"], None]] = None
+        self._queue: Deque[Any] = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @property
+    def closed(self) -> bool:
+        """Return True if the listener has been closed."""
+        return self._closed
+
+    def put(self, message: Any) -> None:
+        """Add a message, dropping the oldest one if the queue is full."""
+        with self._cond:
+            if self._closed:
+                return
+            if self.queue_size and len(self._queue) >= self.queue_size:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(message)
+            self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Return the next message or None on timeout or if closed.
+
+        :param timeout: maximum time in seconds to wait, None waits until a
+            message is received or the listener is closed
+
+        """
+        with self._cond:
+            if not self._queue and not self._closed:
+                self._cond.wait(timeout)
+            return self._queue.popleft() if self._queue else None
+
+    def close(self) -> None:
+        """Stop receiving messages and wake up a waiting reader."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            message = self.get()
+            if message is None:
+                return
+            yield message
+
+    def __enter__(self) -> "Listener":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+class StreamHub:
+    """Listeners by topic filter.
+
+    A message is put into the queue of every listener whose filter matches
+    its topic. The caller subscribes a filter when its first listener is
+    added and unsubscribes it when the last one is removed.
+
+    """
+
+    def __init__(self) -> None:
+        self._router = TopicRouter()
+        self._listeners: Dict[str, Set[Listener]] = {}
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._listeners)
+
+    def add(self, listener: Listener) -> bool:
+        """Add a listener, return True if it is the first of its filter."""
+        with self._lock:
+            listeners = self._listeners.get(listener.topic_filter)
+            if listeners is None:
+                listeners = self._listeners[listener.topic_filter] = set()
+                self._router.add(listener.topic_filter, listeners)
+            listeners.add(listener)
+            return len(listeners) == 1
+
+    def remove(self, listener: Listener) -> bool:
+        """Remove a listener, return True if it was the last of its filter."""
+        with self._lock:
+            listeners = self._listeners.get(listener.topic_filter)
+            if listeners is None or listener not in listeners:
+                return False
+            listeners.discard(listener)
+            self._dropped += listener.dropped
+            if listeners:
+                return False
+            del self._listeners[listener.topic_filter]
+            self._router.remove(listener.topic_filter)
+            return True
+
+    def publish(self, topic: str, message: Any) -> None:
+        """Put a message into the queues of the matching listeners."""
+        for listeners in self._router.match(topic):
+            # copied, listeners may be removed by request threads meanwhile
+            for listener in list(listeners):
+                listener.put(message)
+
+    def stats(self) -> StreamStats:
+        """Return the number of filters, listeners and dropped messages."""
+        with self._lock:
+            listeners = [x for members in self._listeners.values() for x in members]
+            return StreamStats(
+                filters=len(self._listeners),
+                listeners=len(listeners),
+                dropped=self._dropped + sum(x.dropped for x in listeners),
+            )
+
+    def close(self) -> None:
+        """Close all listeners."""
+        with self._lock:
+            listeners = [x for members in self._listeners.values() for x in members]
+        for listener in listeners:
+            listener.close()
+
+    def _after_fork(self) -> None:
+        # the listeners belong to requests of the parent
+        self._router = TopicRouter()
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+
+def format_event(message: Any) -> str:
+    """Return the data of the server-sent event of a message.
+
+    A JSON object with the topic and the payload, decoded by the codec of
+    the topic or as UTF-8 text.
+
+    """
+    if isinstance(message, DecodedMessage):
+        payload = message.payload
+    else:
+        payload = message.payload.decode("utf-8", "replace")
+    return json.dumps({"topic": message.topic, "payload": payload}, default=str)
+
+
+def server_sent_events(
+    listener: Listener,
+    formatter: Callable[[Any], str] = format_event,
+    keepalive: float = 15.0,
+) -> Iterator[str]:
+    """Yield the messages of a listener as server-sent events.
+
+    A comment is sent if there was no message for *keepalive* seconds, so
+    proxies keep the connection open. The listener is closed when the
+    client disconnects.
+
+    """
+    try:
+        # sends the response headers right away
+        yield ": connected\n\n"
+        while not listener.closed:
+            message = listener.get(keepalive)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            data = formatter(message)
+            yield "".join("data: {0}\n".format(line) for line in data.split("\n")) + "\n"
+    finally:
+        listener.close()
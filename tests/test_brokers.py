@@ -0,0 +1,62 @@
+import socket
+import sys
+import unittest
+
+from flask_mqtt.brokers import fastest_broker, next_broker, parse_broker, set_client_broker
+
+
+class BrokersTestCase(unittest.TestCase):
+
+    def test_parse_broker(self):
+        self.assertEqual(('mybroker.com', 1883), parse_broker('mybroker.com'))
+        self.assertEqual(('mybroker.com', 8883), parse_broker('mybroker.com', 8883))
+        self.assertEqual(('mybroker.com', 1884), parse_broker('mybroker.com:1884'))
+        self.assertEqual(('mybroker.com', 1884), parse_broker(('mybroker.com', '1884')))
+        self.assertEqual(('::1', 1884), parse_broker('[::1]:1884'))
+        self.assertEqual(('::1', 1883), parse_broker('[::1]'))
+        self.assertEqual(('::1', 1883), parse_broker('::1'))
+
+    def test_next_broker(self):
+        brokers = [('a', 1), ('b', 2)]
+        self.assertEqual(('b', 2), next_broker(brokers, ('a', 1)))
+        self.assertEqual(('a', 1), next_broker(brokers, ('b', 2)))
+        self.assertEqual(('a', 1), next_broker(brokers, ('c', 3)))
+
+    def test_fastest_broker(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        listening = ('127.0.0.1', server.getsockname()[1])
+        self.assertEqual(
+            listening, fastest_broker([('127.0.0.1', closed_port), listening], 2))
+        self.assertIsNone(fastest_broker([('127.0.0.1', closed_port)], 2))
+
+    def test_set_client_broker(self):
+        # use the real paho client, other tests replace it by a mock
+        sys.modules.pop('paho.mqtt.client', None)
+        from paho.mqtt.client import CallbackAPIVersion, Client
+
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        server.settimeout(2)
+        self.addCleanup(server.close)
+        client = Client(CallbackAPIVersion.VERSION2)
+        client.connect_async('127.0.0.1', 1)
+
+        # fails if paho no longer reconnects to the changed broker
+        set_client_broker(client, server.getsockname())
+        client.reconnect()
+        self.addCleanup(client.socket().close)
+        connection, _ = server.accept()
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import threading
+import unittest
+
+from flask_mqtt.cache import LastValueCache
+
+
+class Message:
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class LastValueCacheTestCase(unittest.TestCase):
+
+    def test_get(self):
+        cache = LastValueCache()
+        first, second = Message(b'1'), Message(b'2')
+        cache.put('home/a', first)
+        self.assertIs(first, cache.get('home/a'))
+        cache.put('home/a', second)
+        self.assertIs(second, cache.get('home/a'))
+        self.assertIsNone(cache.get('home/b'))
+        self.assertEqual(0, cache.get('home/b', 0))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(1, cache.bytes)
+
+    def test_empty_payload_removes_topic(self):
+        cache = LastValueCache()
+        cache.put('home/a', Message(b'1'))
+        cache.put('home/a', Message(b''))
+        self.assertNotIn('home/a', cache)
+        self.assertEqual(0, cache.bytes)
+
+    def test_match(self):
+        cache = LastValueCache()
+        for topic in ('home/a/temp', 'home/b/temp', 'home/a/humidity', '$SYS/load'):
+            cache.put(topic, Message(topic))
+        self.assertEqual(
+            ['home/a/temp', 'home/b/temp'], sorted(cache.match('home/+/temp')))
+        self.assertEqual(3, len(cache.match('#')))
+        self.assertEqual(['$SYS/load'], list(cache.match('$SYS/#')))
+
+    def test_max_entries(self):
+        cache = LastValueCache(max_entries=2)
+        cache.put('a', Message(b'1'))
+        cache.put('b', Message(b'1'))
+        cache.put('a', Message(b'2'))
+        cache.put('c', Message(b'1'))
+        # b has not been updated for the longest time
+        self.assertEqual(['a', 'c'], sorted(cache.match('#')))
+
+    def test_max_bytes(self):
+        cache = LastValueCache(max_bytes=10)
+        cache.put('a', Message(b'x' * 6))
+        cache.put('b', Message(b'x' * 6))
+        self.assertEqual(['b'], list(cache.match('#')))
+        cache.put('c', Message(b'x' * 20))
+        self.assertEqual(['c'], list(cache.match('#')))
+        self.assertEqual(20, cache.stats().bytes)
+
+    def test_discard(self):
+        cache = LastValueCache()
+        cache.put('home/a', Message(b'1'))
+        cache.put('home/b', Message(b'1'))
+        cache.put('garden/a', Message(b'1'))
+        self.assertEqual(2, cache.discard('home/#'))
+        self.assertEqual(['garden/a'], list(cache.match('#')))
+        cache.put('garden/b', Message(b'1'))
+        self.assertEqual(1, cache.discard('garden/+', keep=['garden/b', 'home/#']))
+        self.assertEqual(['garden/b'], list(cache.match('#')))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.bytes)
+
+    def test_concurrent_reads(self):
+        cache = LastValueCache(max_entries=50)
+        errors = []
+
+        def read():
+            try:
+                for _ in range(2000):
+                    cache.match('topic/+')
+                    cache.get('topic/1')
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(20000):
+            cache.put('topic/{0}'.format(i % 100), Message(b'1'))
+        for reader in readers:
+            reader.join()
+        self.assertEqual([], errors)
+
+
+if __name__ == '__main__':
+    unittest.main()
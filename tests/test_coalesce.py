@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+
+from flask_mqtt.coalesce import Coalescer
+
+
+class CoalescerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.event = threading.Event()
+
+        def send(*message):
+            self.sent.append(message)
+            self.event.set()
+
+        self.coalescer = Coalescer(send)
+
+    def tearDown(self):
+        self.coalescer.close(flush=False)
+
+    def test_first_message_is_sent_right_away(self):
+        self.assertFalse(self.coalescer.put('a', 10, 1))
+        self.assertFalse(self.coalescer.put('b', 10, 1))
+        self.assertTrue(self.coalescer.put('a', 10, 2))
+        self.assertEqual(1, len(self.coalescer))
+
+    def test_newest_message_is_sent_after_interval(self):
+        self.coalescer.put('a', 0.05, 1)
+        for value in range(2, 100):
+            self.assertTrue(self.coalescer.put('a', 0.05, value, 1, True))
+        self.assertEqual(97, self.coalescer.coalesced)
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual([('a', 99, 1, True, None)], self.sent)
+        self.assertEqual(0, len(self.coalescer))
+
+    def test_rate_limit_after_flush(self):
+        self.coalescer.put('a', 0.05, 1)
+        self.coalescer.put('a', 0.05, 2)
+        self.assertTrue(self.event.wait(5))
+        # the interval starts again with the delayed message
+        self.assertTrue(self.coalescer.put('a', 0.05, 3))
+        time.sleep(0.2)
+        self.assertFalse(self.coalescer.put('a', 0.05, 4))
+        self.assertEqual([2, 3], [message[1] for message in self.sent])
+
+    def test_flush(self):
+        self.coalescer.put('a', 10, 1)
+        self.coalescer.put('a', 10, 2)
+        self.coalescer.flush()
+        self.assertEqual([('a', 2, 0, False, None)], self.sent)
+        self.assertTrue(self.coalescer.put('a', 10, 3))
+
+    def test_close(self):
+        self.coalescer.put('a', 10, 1)
+        self.coalescer.put('a', 10, 2)
+        self.coalescer.put('b', 10, 1)
+        self.coalescer.put('b', 10, 2)
+        self.coalescer.close(flush=False)
+        self.assertEqual([], self.sent)
+
+        self.coalescer.put('a', 10, 3)
+        self.coalescer.close()
+        self.assertEqual([('a', 3, 0, False, None)], self.sent)
+
+    def test_send_errors_are_logged(self):
+        self.coalescer.send = lambda *message: 1 / 0
+        self.coalescer.put('a', 10, 1)
+        self.coalescer.put('a', 10, 2)
+        with self.assertLogs('flask_mqtt.coalesce', 'ERROR'):
+            self.coalescer.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
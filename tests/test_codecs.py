@@ -0,0 +1,48 @@
+import unittest
+
+from flask_mqtt import codecs
+
+
+class CodecsTestCase(unittest.TestCase):
+
+    def test_raw_codec(self):
+        codec = codecs.get_codec('raw')
+        self.assertEqual(b'text', codec.encode('text'))
+        self.assertEqual(b'\x00\x01', codec.decode(b'\x00\x01'))
+
+    def test_json_codec(self):
+        codec = codecs.get_codec('json')
+        payload = codec.encode({'a': [1, 2]})
+        self.assertEqual(b'{"a":[1,2]}', payload)
+        self.assertEqual({'a': [1, 2]}, codec.decode(payload))
+
+    def test_get_codec_returns_instances(self):
+        codec = codecs.JsonCodec()
+        self.assertIs(codec, codecs.get_codec(codec))
+        with self.assertRaises(ValueError):
+            codecs.get_codec('xml')
+
+    @unittest.skipIf(codecs.msgpack is None, 'msgpack not installed')
+    def test_msgpack_codec(self):
+        codec = codecs.get_codec('msgpack')
+        self.assertEqual({'a': b'\x00'}, codec.decode(codec.encode({'a': b'\x00'})))
+
+    @unittest.skipIf(codecs.cbor2 is None, 'cbor2 not installed')
+    def test_cbor_codec(self):
+        codec = codecs.get_codec('cbor')
+        self.assertEqual({'a': 1.5}, codec.decode(codec.encode({'a': 1.5})))
+
+    def test_decoded_message_delegates_attributes(self):
+        class Message:
+            topic = 'home/a'
+            payload = b'1'
+            qos = 1
+
+        message = codecs.DecodedMessage(Message(), 1, codecs.JsonCodec())
+        self.assertEqual(1, message.payload)
+        self.assertEqual(b'1', message.raw_payload)
+        self.assertEqual(1, message.qos)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from flask_mqtt import compression
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def test_zlib(self):
+        compressor = compression.get_compressor('zlib')
+        data = b'temperature' * 100
+        compressed = compressor.compress(data)
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(data, compressor.decompress(compressed))
+
+    def test_get_compressor_returns_instances(self):
+        compressor = compression.ZlibCompressor(level=1)
+        self.assertIs(compressor, compression.get_compressor(compressor))
+        with self.assertRaises(ValueError):
+            compression.get_compressor('brotli')
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard not installed')
+    def test_zstd(self):
+        compressor = compression.get_compressor('zstd')
+        data = b'temperature' * 100
+        self.assertEqual(data, compressor.decompress(compressor.compress(data)))
+
+    @unittest.skipIf(compression.lz4_frame is None, 'lz4 not installed')
+    def test_lz4(self):
+        compressor = compression.get_compressor('lz4')
+        data = b'temperature' * 100
+        self.assertEqual(data, compressor.decompress(compressor.compress(data)))
+
+    def test_decompressed_message_delegates_attributes(self):
+        class Message:
+            topic = 'home/a/$zlib'
+            payload = b'x\x9c3\x04\x00\x002\x002'
+            qos = 1
+
+        message = compression.DecompressedMessage(
+            Message(), 'home/a', b'1', compression.ZlibCompressor())
+        self.assertEqual('home/a', message.topic)
+        self.assertEqual(b'1', message.payload)
+        self.assertEqual(Message.payload, message.raw_payload)
+        self.assertEqual(1, message.qos)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,21 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
 try:
     from unittest.mock import MagicMock
 except ImportError:
     from mock import MagicMock
 
+import flask
 from flask import Flask
 
 # Import the real CallbackAPIVersion from paho-mqtt if available
@@ -48,7 +58,8 @@ class FlaskMQTTTestCase(unittest.TestCase):
         import flask_mqtt
         global Mqtt
         Mqtt = flask_mqtt.Mqtt
-        
+        self.flask_mqtt = flask_mqtt
+
         self.app = Flask(__name__)
 
     def test_early_initialization_app_is_not_none(self):
@@ -208,6 +219,1374 @@ class FlaskMQTTTestCase(unittest.TestCase):
         # Verify the handler was called with the correct parameters
         mock_handler.assert_called_once_with(mock_client, mock_userdata, mock_flags, mock_rc)
 
+    def test_handlers_run_inline_without_dispatch_workers(self):
+        mqtt = Mqtt(self.app)
+        calls = []
+
+        @mqtt.on_topic('home/topic')
+        def handle_topic(client, userdata, message):
+            calls.append(threading.current_thread())
+
+        mqtt._handle_message(mqtt.client, None, MagicMock(topic='home/topic'))
+        self.assertEqual([threading.current_thread()], calls)
+        self.assertEqual(0, mqtt.dispatch_stats().workers)
+
+    def test_dispatch_workers_run_handlers_in_pool(self):
+        self.app.config['MQTT_DISPATCH_WORKERS'] = 2
+        self.app.config['MQTT_DISPATCH_QUEUE_SIZE'] = 10
+        mqtt = Mqtt(self.app)
+        done = threading.Event()
+        threads = []
+
+        @mqtt.on_message()
+        def handle_messages(client, userdata, message):
+            threads.append(threading.current_thread())
+            done.set()
+
+        self.assertEqual('handle_messages', mqtt._message_handler.__name__)
+        mqtt._handle_message(mqtt.client, None, MagicMock(topic='home/topic'))
+        self.assertTrue(done.wait(1))
+        self.assertNotEqual(threading.current_thread(), threads[0])
+
+        stats = mqtt.dispatch_stats()
+        self.assertEqual(2, stats.workers)
+        self.assertEqual(10, stats.queue_size)
+        mqtt._disconnect()
+        self.assertEqual(0, mqtt.dispatch_stats().workers)
+
+    def test_dispatch_queue_depth_and_busy_workers(self):
+        self.app.config['MQTT_DISPATCH_WORKERS'] = 1
+        mqtt = Mqtt(self.app)
+        started = threading.Event()
+        release = threading.Event()
+
+        @mqtt.on_topic('home/topic')
+        def handle_topic(client, userdata, message):
+            started.set()
+            release.wait(1)
+
+        message = MagicMock(topic='home/topic')
+        mqtt._handle_message(mqtt.client, None, message)
+        self.assertTrue(started.wait(1))
+        mqtt._handle_message(mqtt.client, None, message)
+
+        stats = mqtt.dispatch_stats()
+        self.assertEqual(1, stats.busy_workers)
+        self.assertEqual(1, stats.queue_depth)
+        release.set()
+        mqtt._disconnect()
+
+    def test_app_context(self):
+        self.app.config['MQTT_DISPATCH_WORKERS'] = 1
+        self.app.config['MQTT_APP_CONTEXT'] = True
+        mqtt = Mqtt(self.app)
+        apps = []
+        teardowns = []
+
+        @mqtt.on_topic('home/topic')
+        def handle_topic(client, userdata, message):
+            apps.append(flask.current_app._get_current_object())
+            if message.payload == b'fail':
+                raise ValueError(message.payload)
+
+        @mqtt.teardown_message()
+        def teardown(error):
+            teardowns.append(error)
+
+        with unittest.mock.patch.object(
+                self.app, 'app_context', wraps=self.app.app_context) as app_context:
+            for payload in (b'1', b'2', b'fail'):
+                message = MagicMock(topic='home/topic', payload=payload)
+                mqtt._handle_message(mqtt.client, None, message)
+            mqtt._disconnect()
+        # pushed once by the dispatch worker
+        app_context.assert_called_once()
+        self.assertEqual([self.app] * 3, apps)
+        self.assertEqual([None, None], teardowns[:2])
+        self.assertIsInstance(teardowns[2], ValueError)
+        self.assertFalse(flask.has_app_context())
+
+    def test_on_message_only_called_without_topic_handler(self):
+        mqtt = Mqtt(self.app)
+        calls = []
+
+        @mqtt.on_topic('home/+/temperature')
+        def handle_temperature(client, userdata, message):
+            calls.append(('temperature', message.topic))
+
+        @mqtt.on_topic('home/#')
+        def handle_home(client, userdata, message):
+            calls.append(('home', message.topic))
+
+        @mqtt.on_message()
+        def handle_messages(client, userdata, message):
+            calls.append(('fallback', message.topic))
+
+        for topic in ('home/kitchen/temperature', 'home', 'garden/light'):
+            mqtt._handle_message(mqtt.client, None, MagicMock(topic=topic))
+
+        self.assertEqual([
+            ('temperature', 'home/kitchen/temperature'),
+            ('home', 'home/kitchen/temperature'),
+            ('home', 'home'),
+            ('fallback', 'garden/light'),
+        ], calls)
+
+    def test_subscribe_many_splits_packets(self):
+        self.app.config['MQTT_SUBSCRIBE_BATCH_SIZE'] = 2
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.side_effect = [(success, 1), (success, 2)]
+
+        result, mids = mqtt.subscribe_many(['home/a', ('home/b', 1), 'home/c'])
+
+        self.assertEqual(success, result)
+        self.assertEqual([1, 2], mids)
+        self.assertEqual(2, mqtt.client.subscribe.call_count)
+        self.assertEqual([('home/c', 0)], mqtt.client.subscribe.call_args[0][0])
+        self.assertEqual(1, mqtt.topics['home/b'].qos)
+        self.assertEqual(3, len(mqtt.topics))
+
+    def test_subscriptions_are_counted(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+
+        self.assertEqual((success, 1), mqtt.subscribe('home/a'))
+        self.assertEqual((success, 0), mqtt.subscribe('home/a'))
+        self.assertEqual((success, []), mqtt.subscribe_many(['home/a']))
+        self.assertEqual(1, mqtt.client.subscribe.call_count)
+
+        # a higher qos is sent again, a lower one is not
+        mqtt.subscribe('home/a', 1)
+        mqtt.subscribe('home/a', 0)
+        self.assertEqual(2, mqtt.client.subscribe.call_count)
+        self.assertEqual(1, mqtt.topics['home/a'].qos)
+
+        for _ in range(4):
+            self.assertEqual((success, 0), mqtt.unsubscribe('home/a'))
+        mqtt.client.unsubscribe.assert_not_called()
+        self.assertEqual((success, 2), mqtt.unsubscribe('home/a'))
+        mqtt.client.unsubscribe.assert_called_once_with('home/a')
+        self.assertEqual({}, mqtt.topics)
+        self.assertIsNone(mqtt.unsubscribe('home/a'))
+
+    def test_failed_subscription_is_not_counted(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (self.flask_mqtt.MQTT_ERR_NO_CONN, None)
+        mqtt.subscribe('home/a')
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+        mqtt.subscribe('home/a')
+
+        mqtt.unsubscribe('home/a')
+        self.assertEqual({}, mqtt.topics)
+
+    def test_subscribe_on_reconnect_is_not_counted(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+
+        @mqtt.on_connect()
+        def handle_connect(client, userdata, flags, rc):
+            mqtt.subscribe('home/a')
+            mqtt.subscribe('home/b')
+
+        for _ in range(3):
+            mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.subscribe('home/a')
+
+        mqtt.unsubscribe('home/a')
+        mqtt.unsubscribe('home/b')
+        self.assertEqual(['home/a'], list(mqtt.topics))
+        mqtt.unsubscribe('home/a')
+        self.assertEqual({}, mqtt.topics)
+
+    def test_unsubscribe_all_ignores_subscriber_count(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+        mqtt.subscribe_many(['home/a', 'home/b'])
+        mqtt.subscribe('home/a')
+
+        mqtt.unsubscribe_all()
+
+        self.assertEqual(2, mqtt.client.unsubscribe.call_count)
+        self.assertEqual({}, mqtt.topics)
+
+    def test_resubscribe_in_batches_on_connect(self):
+        self.app.config['MQTT_SUBSCRIBE_BATCH_SIZE'] = 10
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.subscribe_many('home/{0}'.format(i) for i in range(25))
+        mqtt.client.subscribe.reset_mock()
+
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+
+        self.assertEqual(3, mqtt.client.subscribe.call_count)
+        self.assertEqual(25, len(mqtt.topics))
+
+    def test_publish_track_resolves_on_acknowledgement(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.return_value = (success, 5)
+
+        future = mqtt.publish('home/topic', 'on', qos=1, track=True)
+        result, mid = future
+        self.assertEqual((success, 5), (result, mid))
+        self.assertFalse(future.done())
+        self.assertFalse(mqtt.wait_for_all([future], timeout=0.01))
+
+        mqtt._handle_publish(mqtt.client, None, 5)
+        self.assertEqual(5, future.result(timeout=0))
+        self.assertTrue(mqtt.wait_for_all([future], timeout=0))
+        self.assertEqual({}, mqtt._pending_acks)
+
+    def test_publish_track_acknowledged_before_registration(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+
+        def publish(topic, payload, qos, retain):
+            # the network thread acknowledges before publish() returns
+            mqtt._handle_publish(mqtt.client, None, 9)
+            return success, 9
+
+        mqtt.client.publish.side_effect = publish
+        future = mqtt.publish('home/topic', 'on', qos=1, track=True)
+        self.assertEqual(9, future.result(timeout=0))
+        self.assertEqual(set(), mqtt._early_acks)
+
+    def test_publish_track_failure(self):
+        mqtt = Mqtt(self.app)
+        mqtt.client.publish.return_value = (self.flask_mqtt.MQTT_ERR_NO_CONN, 1)
+
+        future = mqtt.publish('home/topic', 'on', qos=0, track=True)
+        self.assertIsInstance(future.exception(timeout=0), RuntimeError)
+        self.assertFalse(mqtt.wait_for_all([future]))
+
+    def test_disconnect_fails_tracked_qos0_messages(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.side_effect = [(success, 1), (success, 2)]
+        qos0 = mqtt.publish('home/topic', 'a', qos=0, track=True)
+        qos1 = mqtt.publish('home/topic', 'b', qos=1, track=True)
+
+        mqtt._handle_disconnect(mqtt.client, None, 1)
+
+        self.assertIsInstance(qos0.exception(timeout=0), ConnectionError)
+        self.assertFalse(qos1.done())
+
+    def test_outbound_queue_disabled_by_default(self):
+        mqtt = Mqtt(self.app)
+        self.assertIsNone(mqtt.outbound_stats())
+
+    def test_outbound_drop_newest(self):
+        self.app.config['MQTT_OUTBOUND_MAX_MESSAGES'] = 1
+        self.app.config['MQTT_OUTBOUND_POLICY'] = 'drop-newest'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.client.publish.return_value = (success, 1)
+
+        self.assertEqual((success, 1), mqtt.publish('home/topic', 'a', qos=1))
+        self.assertEqual(
+            (self.flask_mqtt.MQTT_ERR_QUEUE_SIZE, 0),
+            mqtt.publish('home/topic', 'b', qos=1))
+        future = mqtt.publish('home/topic', 'c', qos=1, track=True)
+        self.assertIsInstance(
+            future.exception(timeout=0), self.flask_mqtt.OutboundQueueFull)
+        self.assertEqual(1, mqtt.client.publish.call_count)
+
+        mqtt._handle_publish(mqtt.client, None, 1)
+        self.assertEqual(0, mqtt.outbound_stats().messages)
+        self.assertEqual((success, 1), mqtt.publish('home/topic', 'd', qos=1))
+
+    def test_outbound_block_rejects_in_network_thread(self):
+        self.app.config['MQTT_OUTBOUND_MAX_MESSAGES'] = 1
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.client.publish.return_value = (success, 1)
+        mqtt.client._thread = threading.current_thread()
+
+        mqtt.publish('home/topic', 'a', qos=1)
+        with self.assertLogs('flask_mqtt', 'WARNING'):
+            self.assertEqual(
+                (self.flask_mqtt.MQTT_ERR_QUEUE_SIZE, 0),
+                mqtt.publish('home/topic', 'b', qos=1))
+        self.assertEqual(1, mqtt.client.publish.call_count)
+
+    def test_outbound_raise(self):
+        self.app.config['MQTT_OUTBOUND_MAX_BYTES'] = 4
+        self.app.config['MQTT_OUTBOUND_POLICY'] = 'raise'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.client.publish.return_value = (success, 1)
+
+        mqtt.publish('home/topic', 'abc', qos=1)
+        with self.assertRaises(self.flask_mqtt.OutboundQueueFull):
+            mqtt.publish('home/topic', 'abc', qos=1)
+
+    def test_outbound_releases_failed_and_qos0_messages(self):
+        self.app.config['MQTT_OUTBOUND_MAX_MESSAGES'] = 2
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.client.publish.side_effect = [
+            (self.flask_mqtt.MQTT_ERR_NO_CONN, 1), (success, 2)]
+
+        mqtt.publish('home/topic', 'a', qos=0)
+        mqtt.publish('home/topic', 'b', qos=0)
+        self.assertEqual(1, mqtt.outbound_stats().messages)
+
+        mqtt._handle_disconnect(mqtt.client, None, 1)
+        self.assertEqual(0, mqtt.outbound_stats().messages)
+
+    def test_outbound_holds_messages_while_disconnected(self):
+        self.app.config['MQTT_OUTBOUND_MAX_MESSAGES'] = 2
+        self.app.config['MQTT_OUTBOUND_POLICY'] = 'drop-oldest'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+
+        first = mqtt.publish('home/topic', 'a', qos=1, track=True)
+        mqtt.publish('home/topic', 'b', qos=1)
+        mqtt.publish('home/topic', 'c', qos=1)
+        self.assertIsInstance(
+            first.exception(timeout=0), self.flask_mqtt.OutboundQueueFull)
+        self.assertEqual(2, mqtt.outbound_stats().held)
+        mqtt.client.publish.assert_not_called()
+
+        mqtt.client.publish.side_effect = [(success, 1), (success, 2)]
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+
+        self.assertEqual(
+            ['b', 'c'],
+            [c[0][1] for c in mqtt.client.publish.call_args_list])
+        self.assertEqual(0, mqtt.outbound_stats().held)
+        self.assertEqual(2, mqtt.outbound_stats().messages)
+
+    def test_outbound_water_marks(self):
+        self.app.config['MQTT_OUTBOUND_MAX_MESSAGES'] = 2
+        self.app.config['MQTT_OUTBOUND_HIGH_WATER'] = 1.0
+        self.app.config['MQTT_OUTBOUND_LOW_WATER'] = 0.0
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.client.publish.side_effect = [(success, 1), (success, 2)]
+        events = []
+
+        @mqtt.on_high_water()
+        def handle_high_water(stats):
+            events.append(('high', stats.messages))
+
+        @mqtt.on_low_water()
+        def handle_low_water(stats):
+            events.append(('low', stats.messages))
+
+        mqtt.publish('home/topic', 'a', qos=1)
+        mqtt.publish('home/topic', 'b', qos=1)
+        mqtt._handle_publish(mqtt.client, None, 1)
+        mqtt._handle_publish(mqtt.client, None, 2)
+
+        self.assertEqual([('high', 2), ('low', 0)], events)
+
+    def test_spool_while_disconnected(self):
+        self.app.config['MQTT_SPOOL_PATH'] = ':memory:'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        no_conn = self.flask_mqtt.MQTT_ERR_NO_CONN
+        mqtt.client.publish.return_value = (no_conn, 1)
+
+        self.assertEqual((no_conn, 0), mqtt.publish('home/topic', 'a', qos=1))
+        future = mqtt.publish('home/topic', 'b', qos=2, track=True)
+        mqtt.publish('home/topic', 'c', qos=0)
+        self.assertEqual(2, len(mqtt.spool))
+        self.assertEqual(1, mqtt.client.publish.call_count)
+
+        mqtt.client.publish.reset_mock()
+        mqtt.client.publish.side_effect = [(success, 1), (success, 2), (success, 3)]
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt._spool_thread.join(1)
+
+        self.assertEqual(
+            [('home/topic', b'a', 1, False), ('home/topic', b'b', 2, False)],
+            [c[0] for c in mqtt.client.publish.call_args_list])
+        self.assertFalse(future.done())
+        mqtt._handle_publish(mqtt.client, None, 1)
+        mqtt._handle_publish(mqtt.client, None, 2)
+        self.assertEqual(2, future.result(timeout=0))
+        self.assertEqual(0, len(mqtt.spool))
+
+        # the spool is empty, messages are published directly
+        mqtt.publish('home/topic', 'd', qos=1)
+        self.assertEqual(3, mqtt.client.publish.call_count)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork()')
+    def test_spool_of_exited_worker_is_replayed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['MQTT_SPOOL_PATH'] = os.path.join(directory, 'spool.db')
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+
+        pid = os.fork()
+        if pid == 0:
+            # a worker spooling a message while disconnected before it exits
+            try:
+                mqtt._handle_connect(mqtt.client, None, {}, success)
+                mqtt._handle_disconnect(mqtt.client, None, 1)
+                mqtt.publish('home/topic', 'a', qos=1)
+                os._exit(0 if len(mqtt.spool) == 1 else 1)
+            finally:
+                os._exit(1)
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+        # the next worker replays the message after its connect
+        mqtt._after_fork()
+        mqtt.client.publish.return_value = (success, 1)
+        mqtt._resume_after_fork()
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt._spool_thread.join(1)
+        mqtt.client.publish.assert_called_once_with('home/topic', b'a', 1, False)
+        self.assertEqual(
+            [os.path.basename(mqtt.spool.path)],
+            [name for name in os.listdir(directory) if name.startswith('spool.db.')
+             and name[len('spool.db.'):].isdigit()])
+
+    def test_spool_replay_stops_on_disconnect(self):
+        self.app.config['MQTT_SPOOL_PATH'] = ':memory:'
+        self.app.config['MQTT_SPOOL_BATCH_SIZE'] = 1
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        for payload in ('a', 'b', 'c'):
+            mqtt.publish('home/topic', payload, qos=1)
+
+        def publish(topic, payload, qos, retain):
+            if payload == b'b':
+                mqtt._handle_disconnect(mqtt.client, None, 1)
+            return success, 1
+
+        mqtt.client.publish.side_effect = publish
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt._spool_thread.join(1)
+        self.assertEqual(2, mqtt.client.publish.call_count)
+
+        mqtt.client.publish.reset_mock()
+        mqtt.client.publish.side_effect = None
+        mqtt.client.publish.return_value = (success, 2)
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt._spool_thread.join(1)
+        self.assertEqual(
+            [b'c'], [c[0][1] for c in mqtt.client.publish.call_args_list])
+
+    def test_shared_subscriptions(self):
+        self.app.config['MQTT_SHARED_GROUP'] = 'workers'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+        handled = []
+
+        @mqtt.on_topic('$share/workers/home/+/temp')
+        def handle_temp(client, userdata, message):
+            handled.append(message)
+
+        mqtt.subscribe('home/+/temp', qos=1)
+        mqtt.client.subscribe.assert_called_with(
+            topic='$share/workers/home/+/temp', qos=1)
+        mqtt.subscribe_many(['home/a', ('$SYS/#', 0)])
+        self.assertEqual(
+            [('$share/workers/home/a', 0), ('$SYS/#', 0)],
+            mqtt.client.subscribe.call_args[0][0])
+
+        message = MagicMock(topic='home/kitchen/temp', payload=b'21')
+        mqtt._handle_message(mqtt.client, None, message)
+        self.assertEqual([message], handled)
+
+        self.assertEqual((success, 2), mqtt.unsubscribe('home/+/temp'))
+        mqtt.client.unsubscribe.assert_called_with('$share/workers/home/+/temp')
+
+    def test_unique_client_id(self):
+        self.app.config['MQTT_CLIENT_ID'] = 'myapp'
+        self.app.config['MQTT_CLIENT_ID_UNIQUE'] = True
+        with unittest.mock.patch('os.getpid', return_value=42), \
+                unittest.mock.patch('socket.gethostname', return_value='host'):
+            mqtt = Mqtt(self.app)
+        self.assertEqual('myapp-host-42', mqtt.client_id)
+
+    def _mqtt_v5(self, alias_maximum):
+        self.app.config['MQTT_PROTOCOL_VERSION'] = self.flask_mqtt.MQTTv5
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.return_value = (success, 1)
+        mqtt._handle_connect(
+            mqtt.client, None, {}, success, MagicMock(TopicAliasMaximum=alias_maximum))
+        return mqtt
+
+    def test_connect_v5(self):
+        properties = MagicMock()
+        self.app.config['MQTT_PROTOCOL_VERSION'] = self.flask_mqtt.MQTTv5
+        self.app.config['MQTT_CLEAN_SESSION'] = False
+        self.app.config['MQTT_CONNECT_PROPERTIES'] = properties
+        mqtt = Mqtt(self.app)
+        self.assertEqual(
+            {'keepalive': 60, 'clean_start': False, 'properties': properties},
+            mqtt._connect_kwargs())
+
+    def test_v5_handler_arguments(self):
+        calls = []
+        mqtt = Mqtt(self.app)
+
+        @mqtt.on_connect()
+        def handle_connect(*args):
+            calls.append(args)
+
+        @mqtt.on_disconnect()
+        def handle_disconnect(*args):
+            calls.append(args)
+
+        mqtt._handle_connect(mqtt.client, None, {}, 0, 'connack')
+        mqtt._handle_disconnect(mqtt.client, None, 0, 'disconnect')
+        self.assertEqual(
+            [(mqtt.client, None, {}, 0, 'connack'),
+             (mqtt.client, None, 0, 'disconnect')],
+            calls)
+
+    def test_topic_alias(self):
+        mqtt = self._mqtt_v5(alias_maximum=2)
+        publish = mqtt.client.publish
+
+        def sent():
+            topic, _, _, _, properties = publish.call_args[0]
+            return topic, properties.TopicAlias
+
+        mqtt.publish('home/a', 'x')
+        self.assertEqual(('home/a', 1), sent())
+        mqtt.publish('home/a', 'x')
+        self.assertEqual(('', 1), sent())
+        mqtt.publish('home/b', 'x')
+        self.assertEqual(('home/b', 2), sent())
+        mqtt.publish('home/a', 'x')
+        self.assertEqual(('', 1), sent())
+        # the least recently used alias is reassigned
+        mqtt.publish('home/c', 'x')
+        self.assertEqual(('home/c', 2), sent())
+
+        # messages with QoS > 0 keep their topic
+        mqtt.publish('home/a', 'x', qos=1)
+        publish.assert_called_with('home/a', 'x', 1, False)
+
+    def test_topic_alias_keeps_properties(self):
+        mqtt = self._mqtt_v5(alias_maximum=10)
+        properties = self.flask_mqtt.Properties(self.flask_mqtt.PacketTypes.PUBLISH)
+        properties.MessageExpiryInterval = 60
+        mqtt.publish('home/a', 'x', properties=properties)
+        sent = mqtt.client.publish.call_args[0][4]
+        self.assertEqual(60, sent.MessageExpiryInterval)
+        self.assertEqual(1, sent.TopicAlias)
+        self.assertFalse(hasattr(properties, 'TopicAlias'))
+
+    def test_topic_alias_reset_on_disconnect(self):
+        mqtt = self._mqtt_v5(alias_maximum=10)
+        mqtt.publish('home/a', 'x')
+        mqtt._handle_disconnect(mqtt.client, None, 0)
+        mqtt.publish('home/a', 'x')
+        mqtt.client.publish.assert_called_with('home/a', 'x', 0, False)
+
+        mqtt._handle_connect(
+            mqtt.client, None, {}, 0, MagicMock(TopicAliasMaximum=10))
+        mqtt.publish('home/a', 'x')
+        self.assertEqual('home/a', mqtt.client.publish.call_args[0][0])
+
+    def test_topic_alias_disabled(self):
+        self.app.config['MQTT_TOPIC_ALIAS_MAXIMUM'] = 0
+        mqtt = self._mqtt_v5(alias_maximum=10)
+        mqtt.publish('home/a', 'x')
+        mqtt.publish('home/a', 'x')
+        mqtt.client.publish.assert_called_with('home/a', 'x', 0, False)
+
+    def test_compression_topic_marker(self):
+        self.app.config['MQTT_COMPRESSION'] = 'zlib'
+        self.app.config['MQTT_COMPRESSION_MARKER'] = 'topic'
+        self.app.config['MQTT_COMPRESSION_THRESHOLD'] = 100
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.return_value = (success, 1)
+        handled = []
+
+        @mqtt.on_topic('home/+/log')
+        def handle_log(client, userdata, message):
+            handled.append(message)
+
+        # small payloads are sent unchanged
+        mqtt.publish('home/a/log', 'short')
+        mqtt.client.publish.assert_called_with('home/a/log', 'short', 0, False)
+
+        data = 'line\n' * 100
+        mqtt.publish('home/a/log', data)
+        topic, payload = mqtt.client.publish.call_args[0][:2]
+        self.assertEqual('home/a/log/$zlib', topic)
+        self.assertEqual(data.encode(), mqtt.compressor.decompress(payload))
+
+        mqtt._handle_message(
+            mqtt.client, None, MagicMock(topic=topic, payload=payload))
+        self.assertEqual('home/a/log', handled[0].topic)
+        self.assertEqual(data.encode(), handled[0].payload)
+
+    def test_compression_property_marker(self):
+        self.app.config['MQTT_PROTOCOL_VERSION'] = self.flask_mqtt.MQTTv5
+        self.app.config['MQTT_COMPRESSION'] = 'zlib'
+        mqtt = Mqtt(self.app)
+        mqtt.client.publish.return_value = (self.flask_mqtt.MQTT_ERR_SUCCESS, 1)
+        handled = []
+        mqtt.register_codec('home/#', 'json')
+
+        @mqtt.on_topic('home/+/state')
+        def handle_state(client, userdata, message):
+            handled.append(message)
+
+        state = {'values': list(range(1000))}
+        mqtt.publish_many([('home/a/state', state)])
+        topic, payload, _, _, properties = mqtt.client.publish.call_args[0]
+        self.assertEqual('home/a/state', topic)
+        self.assertEqual([('content-encoding', 'zlib')], properties.UserProperty)
+
+        mqtt._handle_message(
+            mqtt.client, None,
+            MagicMock(topic=topic, payload=payload, properties=properties))
+        self.assertEqual(state, handled[0].payload)
+
+    def test_compression_invalid_payload_is_dropped(self):
+        self.app.config['MQTT_COMPRESSION'] = 'zlib'
+        self.app.config['MQTT_COMPRESSION_MARKER'] = 'topic'
+        mqtt = Mqtt(self.app)
+        handled = []
+        mqtt.on_message()(lambda client, userdata, message: handled.append(message))
+        with self.assertLogs('flask_mqtt', 'ERROR'):
+            mqtt._handle_message(
+                mqtt.client, None, MagicMock(topic='home/a/$zlib', payload=b'x'))
+        self.assertEqual([], handled)
+
+    def test_decompression_without_compression_configured(self):
+        import zlib
+        mqtt = Mqtt(self.app)
+        handled = []
+        mqtt.on_message()(lambda client, userdata, message: handled.append(message))
+        data = b'line\n' * 100
+        properties = MagicMock(UserProperty=[('content-encoding', 'zlib')])
+        mqtt._handle_message(
+            mqtt.client, None,
+            MagicMock(topic='home/a', payload=zlib.compress(data), properties=properties))
+        mqtt._handle_message(
+            mqtt.client, None,
+            MagicMock(topic='home/b/$zlib', payload=zlib.compress(data), properties=None))
+        self.assertEqual([('home/a', data), ('home/b', data)],
+                         [(m.topic, m.payload) for m in handled])
+
+        # other encodings and topic levels are passed unchanged
+        properties = MagicMock(UserProperty=[('content-encoding', 'identity')])
+        mqtt._handle_message(
+            mqtt.client, None, MagicMock(topic='home/c', payload=b'x', properties=properties))
+        mqtt._handle_message(
+            mqtt.client, None, MagicMock(topic='home/$d', payload=b'x', properties=None))
+        self.assertEqual([('home/c', b'x'), ('home/$d', b'x')],
+                         [(m.topic, m.payload) for m in handled[2:]])
+
+    def test_compression_property_marker_requires_v5(self):
+        self.app.config['MQTT_COMPRESSION'] = 'zlib'
+        self.app.config['MQTT_COMPRESSION_MARKER'] = 'property'
+        with self.assertRaises(ValueError):
+            Mqtt(self.app)
+
+    def test_compression_topic_marker_not_chosen_implicitly(self):
+        self.app.config['MQTT_COMPRESSION'] = 'zlib'
+        with self.assertRaises(ValueError):
+            Mqtt(self.app)
+
+    def test_coalesce(self):
+        self.app.config['MQTT_COALESCE'] = {'sensors/#': 10}
+        mqtt = Mqtt(self.app)
+        mqtt.register_codec('sensors/#', 'json')
+        publish = mqtt.client.publish
+        publish.return_value = (self.flask_mqtt.MQTT_ERR_SUCCESS, 1)
+
+        for value in range(100):
+            mqtt.publish('sensors/a', {'value': value})
+        mqtt.publish_many([('sensors/b', 1), ('sensors/b', 2), ('other', 3)])
+        self.assertEqual(
+            [('sensors/a', b'{"value":0}', 0, False),
+             ('sensors/b', b'1', 0, False),
+             ('other', 3, 0, False)],
+            [c[0] for c in publish.call_args_list])
+
+        # tracked messages are not coalesced
+        mqtt.publish('sensors/a', 1, track=True)
+        self.assertEqual(4, publish.call_count)
+
+        publish.reset_mock()
+        mqtt._disconnect()
+        self.assertEqual(
+            [('sensors/a', b'{"value":99}', 0, False), ('sensors/b', b'2', 0, False)],
+            [c[0] for c in publish.call_args_list])
+
+    def test_coalesce_without_flush_on_shutdown(self):
+        self.app.config['MQTT_COALESCE_FLUSH'] = False
+        mqtt = Mqtt(self.app)
+        mqtt.coalesce('sensors/#', 10)
+        mqtt.client.publish.return_value = (self.flask_mqtt.MQTT_ERR_SUCCESS, 1)
+        mqtt.publish('sensors/a', 1)
+        self.assertEqual((self.flask_mqtt.MQTT_ERR_SUCCESS, 0), mqtt.publish('sensors/a', 2))
+        mqtt._disconnect()
+        self.assertEqual(1, mqtt.client.publish.call_count)
+        with self.assertRaises(ValueError):
+            mqtt.coalesce('sensors/#', 0)
+
+    def test_last_value_cache(self):
+        self.app.config['MQTT_CACHE_ENABLED'] = True
+        mqtt = Mqtt(self.app)
+        mqtt.register_codec('home/#', 'json')
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+        mqtt.subscribe('home/#')
+
+        for value in (b'1', b'2'):
+            mqtt._handle_message(
+                mqtt.client, None, MagicMock(topic='home/a', payload=value))
+        mqtt._handle_message(
+            mqtt.client, None, MagicMock(topic='home/b', payload=b'3'))
+        self.assertEqual(2, mqtt.last('home/a').payload)
+        self.assertIsNone(mqtt.last('home/c'))
+        self.assertEqual(
+            {'home/a': 2, 'home/b': 3},
+            {t: m.payload for t, m in mqtt.last_matching('home/+').items()})
+        self.assertEqual(2, mqtt.cache_stats().entries)
+
+        mqtt.unsubscribe('home/#')
+        self.assertEqual({}, mqtt.last_matching('#'))
+
+    def test_last_value_cache_overlapping_filters(self):
+        self.app.config['MQTT_CACHE_ENABLED'] = True
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.client.unsubscribe.return_value = (success, 2)
+        mqtt.subscribe('a/+')
+        mqtt.subscribe('a/#')
+        for topic in ('a/b', 'a/b/c'):
+            mqtt._handle_message(mqtt.client, None, MagicMock(topic=topic, payload=b'1'))
+
+        # a/# still receives a/b
+        mqtt.unsubscribe('a/+')
+        self.assertEqual(['a/b', 'a/b/c'], sorted(mqtt.last_matching('#')))
+        mqtt.unsubscribe('a/#')
+        self.assertEqual({}, mqtt.last_matching('#'))
+
+    def test_last_value_cache_disabled(self):
+        mqtt = Mqtt(self.app)
+        self.assertIsNone(mqtt.cache_stats())
+        with self.assertRaises(RuntimeError):
+            mqtt.last('home/a')
+
+    def _requester(self):
+        self.app.config['MQTT_CLIENT_ID'] = 'app'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.return_value = (success, 1)
+        mqtt.client.subscribe.return_value = (success, 1)
+        return mqtt
+
+    def test_request_envelope(self):
+        mqtt = self._requester()
+        first = mqtt.send_request('devices/42/commands', {'command': 'reboot'})
+        second = mqtt.send_request('devices/43/commands', b'status')
+        # one subscription for all responses
+        mqtt.client.subscribe.assert_called_once_with(topic='responses/app', qos=1)
+        self.assertIn('responses/app', mqtt.topics)
+
+        topic, payload, qos, _ = mqtt.client.publish.call_args_list[0][0]
+        self.assertEqual(('devices/42/commands', 1), (topic, qos))
+        envelope = json.loads(payload)
+        self.assertEqual('responses/app', envelope['response_topic'])
+        self.assertEqual({'command': 'reboot'}, envelope['payload'])
+        self.assertEqual('status', json.loads(
+            mqtt.client.publish.call_args_list[1][0][1])['payload'])
+
+        # the responder sends the envelope back with its payload
+        request = MagicMock(topic=topic, payload=payload)
+        mqtt.respond(request, 'ok')
+        response_topic, response, _, _ = mqtt.client.publish.call_args[0]
+        self.assertEqual('responses/app', response_topic)
+        mqtt._handle_message(
+            mqtt.client, None, MagicMock(topic=response_topic, payload=response))
+        self.assertEqual('ok', first.result(1).payload)
+        self.assertFalse(second.done())
+        self.assertEqual(1, len(mqtt._requests))
+
+    def test_request_envelope_binary_payload(self):
+        mqtt = self._requester()
+        future = mqtt.send_request('devices/42/image', b'\xff\xd8\x00')
+        topic, payload, _, _ = mqtt.client.publish.call_args[0]
+        envelope = json.loads(payload)
+        self.assertEqual('base64', envelope['encoding'])
+        self.assertEqual('/9gA', envelope['payload'])
+
+        mqtt.respond(MagicMock(topic=topic, payload=payload), b'\x89PNG\x00')
+        response_topic, response, _, _ = mqtt.client.publish.call_args[0]
+        mqtt._handle_message(
+            mqtt.client, None, MagicMock(topic=response_topic, payload=response))
+        self.assertEqual(b'\x89PNG\x00', future.result(1).payload)
+
+    def test_concurrent_requests_subscribe_once(self):
+        mqtt = self._requester()
+        subscribed = threading.Barrier(2, timeout=0.1)
+
+        def subscribe(*args, **kwargs):
+            # a second thread must not get past the check meanwhile
+            try:
+                subscribed.wait()
+            except threading.BrokenBarrierError:
+                pass
+            return self.flask_mqtt.MQTT_ERR_SUCCESS, 1
+
+        mqtt.client.subscribe.side_effect = subscribe
+        threads = [
+            threading.Thread(target=mqtt.send_request, args=('devices/42/commands',))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, mqtt.client.subscribe.call_count)
+
+    def test_request_v5(self):
+        self.app.config['MQTT_PROTOCOL_VERSION'] = self.flask_mqtt.MQTTv5
+        self.app.config['MQTT_RESPONSE_TOPIC'] = 'replies/app'
+        mqtt = self._requester()
+        future = mqtt.send_request('devices/42/commands', 'reboot')
+        topic, payload, _, _, properties = mqtt.client.publish.call_args[0]
+        self.assertEqual('reboot', payload)
+        self.assertEqual('replies/app', properties.ResponseTopic)
+
+        request = MagicMock(topic=topic, payload=payload, properties=properties)
+        mqtt.respond(request, 'ok')
+        response_topic, response, _, _, response_properties = mqtt.client.publish.call_args[0]
+        self.assertEqual('replies/app', response_topic)
+        self.assertEqual(properties.CorrelationData, response_properties.CorrelationData)
+        mqtt._handle_message(mqtt.client, None, MagicMock(
+            topic=response_topic, payload=response, properties=response_properties))
+        self.assertEqual('ok', future.result(1).payload)
+
+    def test_request_timeout(self):
+        mqtt = self._requester()
+        with self.assertRaises(TimeoutError):
+            mqtt.request('devices/42/commands', timeout=0.01)
+        self.assertEqual({}, mqtt._requests)
+
+        # late responses are ignored
+        envelope = json.loads(mqtt.client.publish.call_args[0][1])
+        mqtt._handle_message(mqtt.client, None, MagicMock(
+            topic='responses/app', payload=json.dumps(envelope)))
+
+    def _pool(self, **kwargs):
+        # give every connection of the pool its own client mock
+        sys.modules['paho.mqtt.client'].Client.side_effect = (
+            lambda *args, **kw: MagicMock())
+        return self.flask_mqtt.MqttPool(self.app, **kwargs)
+
+    def test_pool_client_ids(self):
+        self.app.config['MQTT_CLIENT_ID'] = 'myapp'
+        self.app.config['MQTT_POOL_SIZE'] = 3
+        pool = self._pool()
+        self.assertEqual(
+            ['myapp-0', 'myapp-1', 'myapp-2'],
+            [member.client_id for member in pool.members])
+
+    def test_pool_publish_by_topic(self):
+        pool = self._pool(size=4)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        for member in pool.members:
+            member.client.publish.return_value = (success, 1)
+
+        for i in range(20):
+            pool.publish('home/{0}'.format(i % 5), str(i))
+
+        for i in range(5):
+            topic = 'home/{0}'.format(i)
+            members = [m for m in pool.members
+                       if any(c[0][0] == topic for c in m.client.publish.call_args_list)]
+            self.assertEqual([pool.member_for(topic)], members)
+
+    def test_pool_publish_round_robin(self):
+        pool = self._pool(size=2, strategy='round-robin')
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        for member in pool.members:
+            member.client.publish.return_value = (success, 1)
+
+        for i in range(4):
+            pool.publish('home/topic', str(i))
+
+        for member in pool.members:
+            self.assertEqual(2, member.client.publish.call_count)
+
+    def test_pool_publish_many_keeps_order_of_mids(self):
+        pool = self._pool(size=3)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        for index, member in enumerate(pool.members):
+            member.client.publish.return_value = (success, index)
+
+        messages = [('home/{0}'.format(i), 'x') for i in range(10)]
+        result, mids = pool.publish_many(messages)
+
+        self.assertEqual(success, result)
+        self.assertEqual(
+            [pool.members.index(pool.member_for(m[0])) for m in messages], mids)
+
+    def test_pool_subscribes_on_one_connection(self):
+        pool = self._pool(size=2)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        for member in pool.members:
+            member.client.subscribe.return_value = (success, 1)
+        handled = []
+
+        @pool.on_topic('home/#')
+        def handle_home(client, userdata, message):
+            handled.append(message)
+
+        pool.subscribe('home/#')
+        pool.subscribe_many(['home/a', 'home/b'])
+
+        pool.members[0].client.subscribe.assert_called()
+        pool.members[1].client.subscribe.assert_not_called()
+        self.assertEqual({'home/#', 'home/a', 'home/b'}, set(pool.topics))
+        for member in pool.members:
+            self.assertEqual(1, len(member._router))
+
+    def test_pool_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            self._pool(strategy='random')
+
+    def test_publish_many_track(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.side_effect = [(success, 1), (success, 2)]
+
+        result, futures = mqtt.publish_many(
+            [('home/a', 'a', 1), ('home/b', 'b', 2)], track=True)
+        for mid in (2, 1):
+            mqtt._handle_publish(mqtt.client, None, mid)
+
+        self.assertTrue(mqtt.wait_for_all(futures, timeout=1))
+        self.assertEqual([1, 2], [f.result() for f in futures])
+
+    def test_metrics_disabled_by_default(self):
+        mqtt = Mqtt(self.app)
+        self.assertIsNone(mqtt.metrics)
+
+    def test_metrics(self):
+        self.app.config['MQTT_METRICS_ENABLED'] = True
+        self.app.config['MQTT_METRICS_ROUTE'] = '/metrics'
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.return_value = (success, 3)
+
+        @mqtt.on_topic('home/+')
+        def handle_home(client, userdata, message):
+            pass
+
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt._handle_message(mqtt.client, None, MagicMock(topic='home/a'))
+        mqtt.publish('home/b', 'on', qos=1)
+        mqtt._handle_publish(mqtt.client, None, 3)
+
+        self.assertEqual(1, mqtt.metrics.messages_received.value('home/a'))
+        self.assertEqual(1, mqtt.metrics.messages_published.value('home/b'))
+        self.assertEqual(1, mqtt.metrics.publish_ack_seconds.count())
+        self.assertEqual(1, mqtt.metrics.handler_seconds.count('handle_home'))
+        self.assertEqual(1, mqtt.metrics.connects.total())
+
+        response = self.app.test_client().get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'mqtt_connected 1', response.data)
+
+    def test_codec_decodes_payload_once(self):
+        mqtt = Mqtt(self.app)
+        mqtt.register_codec('sensors/#', 'json')
+        received = []
+
+        @mqtt.on_topic('sensors/+/temperature')
+        def handle_temperature(client, userdata, message):
+            received.append(message)
+
+        @mqtt.on_topic('sensors/#')
+        def handle_sensors(client, userdata, message):
+            received.append(message)
+
+        message = MagicMock(topic='sensors/kitchen/temperature',
+                            payload=b'{"value": 21.5}')
+        codec = mqtt._codecs.match('sensors/a')[0]
+        with unittest.mock.patch.object(
+                type(codec), 'decode', wraps=codec.decode) as decode:
+            mqtt._handle_message(mqtt.client, None, message)
+
+        self.assertEqual(1, decode.call_count)
+        self.assertIs(received[0], received[1])
+        self.assertEqual({'value': 21.5}, received[0].payload)
+        self.assertEqual(b'{"value": 21.5}', received[0].raw_payload)
+        self.assertEqual('sensors/kitchen/temperature', received[0].topic)
+
+    def test_codec_decode_error_drops_message(self):
+        mqtt = Mqtt(self.app)
+        handler = MagicMock(__name__='handler')
+        mqtt.on_topic('sensors/#', codec='json')(handler)
+
+        with self.assertLogs('flask_mqtt', level='ERROR'):
+            mqtt._handle_message(mqtt.client, None,
+                                 MagicMock(topic='sensors/a', payload=b'{'))
+        handler.assert_not_called()
+
+    def test_codec_encodes_published_objects(self):
+        mqtt = Mqtt(self.app)
+        mqtt.register_codec('sensors/#', 'json')
+        mqtt.client.publish.return_value = (self.flask_mqtt.MQTT_ERR_SUCCESS, 1)
+
+        mqtt.publish('sensors/a', {'value': 1})
+        mqtt.client.publish.assert_called_with(
+            'sensors/a', b'{"value":1}', 0, False)
+
+        mqtt.publish('sensors/a', b'raw')
+        mqtt.client.publish.assert_called_with('sensors/a', b'raw', 0, False)
+
+        mqtt.publish('other', 'text')
+        mqtt.client.publish.assert_called_with('other', 'text', 0, False)
+
+    def test_publish_many(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.side_effect = [(success, 1), (success, 2)]
+
+        with self.assertLogs('flask_mqtt', level='DEBUG') as logs:
+            result, mids = mqtt.publish_many(
+                [('home/a', 'a'), ('home/b', 'b', 1, True)])
+
+        self.assertEqual(success, result)
+        self.assertEqual([1, 2], mids)
+        self.assertEqual(1, len(logs.output))
+        mqtt.client.publish.assert_called_with('home/b', 'b', 1, True)
+
+    def test_publish_many_reports_first_error(self):
+        mqtt = Mqtt(self.app)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.side_effect = [(success, 1), (4, 2), (5, 3)]
+
+        result, mids = mqtt.publish_many(
+            [('home/a', 'a'), ('home/b', 'b'), ('home/c', 'c')])
+
+        self.assertEqual(4, result)
+        self.assertEqual([1, 2, 3], mids)
+
+    def test_connect_timeout_per_socket(self):
+        self.app.config['MQTT_CONNECTION_TIMEOUT'] = 3
+        default = socket.getdefaulttimeout()
+        mqtt = Mqtt(self.app)
+        self.assertEqual(3, mqtt.client.connect_timeout)
+        self.assertEqual(default, socket.getdefaulttimeout())
+
+    def test_broker_urls(self):
+        self.app.config['MQTT_BROKER_PORT'] = 1884
+        self.app.config['MQTT_BROKER_URLS'] = ['a', 'b:1885', ('c', 1886)]
+        with unittest.mock.patch.object(
+                self.flask_mqtt, 'fastest_broker', return_value=('b', 1885)) as fastest:
+            mqtt = Mqtt(self.app)
+        brokers = [('a', 1884), ('b', 1885), ('c', 1886)]
+        fastest.assert_called_once_with(brokers, 5)
+        self.assertEqual(brokers, mqtt.brokers)
+        self.assertEqual(('b', 1885), (mqtt.broker_url, mqtt.broker_port))
+        self.assertEqual(('b', 1885), mqtt.client.connect.call_args[0])
+
+    def _join_probe(self):
+        for thread in threading.enumerate():
+            if thread.name == 'flask-mqtt-failover':
+                thread.join(1)
+
+    def test_broker_urls_fail_over(self):
+        self.app.config['MQTT_BROKER_URLS'] = ['a', 'b', 'c']
+        self.app.config['MQTT_METRICS_ENABLED'] = True
+        with unittest.mock.patch.object(
+                self.flask_mqtt, 'fastest_broker', return_value=None):
+            mqtt = Mqtt(self.app)
+            self.assertEqual('a', mqtt.broker_url)
+
+            # a disconnect requested by the application keeps the broker
+            mqtt._handle_disconnect(mqtt.client, None, self.flask_mqtt.MQTT_ERR_SUCCESS)
+            self.assertEqual('a', mqtt.broker_url)
+
+            # without a reachable broker the next one in the list is tried
+            mqtt._handle_disconnect(mqtt.client, None, 7)
+            self.assertEqual(('b', 1883), (mqtt.client._host, mqtt.client._port))
+            self._join_probe()
+            mqtt._handle_connect_fail(mqtt.client, None)
+            self.assertEqual('c', mqtt.broker_url)
+            self._join_probe()
+
+        with unittest.mock.patch.object(
+                self.flask_mqtt, 'fastest_broker', return_value=('b', 1883)) as fastest:
+            mqtt._handle_disconnect(mqtt.client, None, 7)
+            self._join_probe()
+        # the fastest of the other brokers replaces the next one
+        fastest.assert_called_once_with([('a', 1883), ('b', 1883)], 5)
+        self.assertEqual(('b', 1883), (mqtt.broker_url, mqtt.broker_port))
+        self.assertEqual('b', mqtt.client._host)
+        self.assertEqual(3, mqtt.metrics.failovers.value())
+
+    def test_fail_over_does_not_block_network_thread(self):
+        self.app.config['MQTT_BROKER_URLS'] = ['a', 'b', 'c']
+        with unittest.mock.patch.object(
+                self.flask_mqtt, 'fastest_broker', return_value=None):
+            mqtt = Mqtt(self.app)
+        probing = threading.Event()
+
+        def slow_probe(brokers, timeout):
+            probing.wait(1)
+            return ('c', 1883)
+
+        with unittest.mock.patch.object(self.flask_mqtt, 'fastest_broker', slow_probe):
+            start = time.monotonic()
+            mqtt._handle_disconnect(mqtt.client, None, 7)
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertEqual('b', mqtt.client._host)
+            # a probe finishing after the reconnect keeps the broker
+            mqtt.connected = True
+            probing.set()
+            self._join_probe()
+        self.assertEqual('b', mqtt.client._host)
+
+    def _starting(self, **config):
+        # the connect is started in a background thread
+        self.app.config['MQTT_STARTUP_BUDGET'] = 0.01
+        self.app.config.update(config)
+        mqtt = Mqtt(self.app)
+        for _ in range(100):
+            if mqtt.client.loop_start.called:
+                break
+            threading.Event().wait(0.01)
+        mqtt.client.connect_async.assert_called_once()
+        self.assertFalse(mqtt.wait_for_connection(0))
+        return mqtt
+
+    def test_startup_budget_buffers_messages(self):
+        mqtt = self._starting()
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.publish.return_value = (success, 1)
+        self.assertEqual((success, 0), mqtt.publish('home/a', 'online', retain=True))
+        future = mqtt.publish('home/b', 'x', qos=1, track=True)
+        mqtt.publish_many([('home/c', 'y')])
+        mqtt.client.publish.assert_not_called()
+
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        self.assertTrue(mqtt.wait_for_connection(0))
+        self.assertEqual(
+            ['home/a', 'home/b', 'home/c'],
+            [c[0][0] for c in mqtt.client.publish.call_args_list])
+        self.assertEqual(1, future.mid)
+        mqtt._handle_publish(mqtt.client, None, 1)
+        self.assertEqual(1, future.result(0))
+
+        # sent right away after the first connect
+        mqtt.publish('home/d', 'z')
+        self.assertEqual(4, mqtt.client.publish.call_count)
+
+    def test_startup_budget_buffer_size(self):
+        mqtt = self._starting(MQTT_STARTUP_BUFFER_SIZE=2)
+        futures = [mqtt.publish('home/a', i, track=True) for i in range(3)]
+        self.assertRaises(ConnectionError, futures[0].result, 0)
+        self.assertEqual([1, 2], [m[1] for m in mqtt._startup_buffer])
+
+    def test_startup_budget_rejects_messages(self):
+        mqtt = self._starting(MQTT_STARTUP_POLICY='reject')
+        self.assertEqual(
+            (self.flask_mqtt.MQTT_ERR_NO_CONN, 0), mqtt.publish('home/a', 'online'))
+        future = mqtt.publish('home/a', 'online', qos=1, track=True)
+        self.assertRaises(ConnectionError, future.result, 0)
+        mqtt.client.publish.assert_not_called()
+
+    def test_unknown_startup_policy(self):
+        self.app.config['MQTT_STARTUP_POLICY'] = 'wait'
+        self.assertRaises(ValueError, Mqtt, self.app)
+
+    def test_after_fork(self):
+        self.app.config['MQTT_CLIENT_ID'] = 'web'
+        mqtt = Mqtt(self.app)
+        self.assertIn(mqtt, self.flask_mqtt._instances)
+        success = self.flask_mqtt.MQTT_ERR_SUCCESS
+        mqtt.client.subscribe.return_value = (success, 1)
+        mqtt.subscribe('home/a')
+        mqtt._subscribe_responses()
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        sock = mqtt.client._sock
+        mqtt.client.connect.reset_mock()
+
+        with unittest.mock.patch('os.getpid', return_value=42):
+            mqtt._after_fork()
+        # the inherited socket is closed without a DISCONNECT packet
+        sock.close.assert_called_once()
+        mqtt.client.disconnect.assert_not_called()
+        self.assertFalse(mqtt.connected)
+        self.assertEqual('web-{0}-42'.format(socket.gethostname()), mqtt.client_id)
+        self.assertEqual(mqtt.client_id.encode('utf-8'), mqtt.client._client_id)
+        self.assertEqual(['home/a'], list(mqtt.topics))
+        self.assertIsNone(mqtt.response_topic)
+        mqtt.client.connect.assert_not_called()
+        mqtt.client.connect_async.assert_not_called()
+
+        # connected on first use, messages are buffered until then
+        mqtt.client.publish.return_value = (success, 1)
+        self.assertEqual((success, 0), mqtt.publish('home/a', 'x'))
+        mqtt.client.publish.assert_not_called()
+        for _ in range(100):
+            if mqtt.client.loop_start.called:
+                break
+            threading.Event().wait(0.01)
+        mqtt.client.connect_async.assert_called_once()
+        mqtt._handle_connect(mqtt.client, None, {}, success)
+        mqtt.client.publish.assert_called_once()
+        self.assertTrue(mqtt.wait_for_connection(0))
+
+    def test_after_fork_on_request(self):
+        mqtt = Mqtt(self.app)
+        self.app.add_url_rule('/', view_func=lambda: 'ok')
+        mqtt._after_fork()
+        mqtt.client.loop_start.reset_mock()
+        self.app.test_client().get('/')
+        self.assertFalse(mqtt._fork_pending)
+        for _ in range(100):
+            if mqtt.client.loop_start.called:
+                break
+            threading.Event().wait(0.01)
+        mqtt.client.loop_start.assert_called_once()
+
+        # later requests do not take the lock
+        mqtt._startup_lock = MagicMock()
+        self.app.test_client().get('/')
+        mqtt._startup_lock.__enter__.assert_not_called()
+
+    def test_disconnected_not_reset_after_fork(self):
+        mqtt = Mqtt(self.app)
+        mqtt._disconnect()
+        self.assertNotIn(mqtt, self.flask_mqtt._instances)
+
+
+class AsyncMqttTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        try:
+            sys.modules.pop('flask_mqtt')
+        except KeyError:
+            pass
+
+        mock_mqtt = MagicMock()
+        if has_callback_api_version:
+            mock_mqtt.CallbackAPIVersion = RealCallbackAPIVersion
+        sys.modules['paho.mqtt.client'] = mock_mqtt
+
+        import flask_mqtt
+        self.flask_mqtt = flask_mqtt
+        self.app = Flask(__name__)
+
+    async def asyncSetUp(self):
+        self.mqtt = self.flask_mqtt.AsyncMqtt(
+            self.app, loop=asyncio.get_running_loop())
+        await asyncio.sleep(0.01)
+
+    async def test_connect_without_network_thread(self):
+        self.assertEqual(1, self.mqtt.client.connect.call_count)
+        self.assertEqual(0, self.mqtt.client.loop_start.call_count)
+        await self.mqtt.disconnect()
+        self.assertEqual(1, self.mqtt.client.disconnect.call_count)
+
+    async def test_disconnect_flushes_coalesced_messages(self):
+        self.app.config['MQTT_COALESCE'] = {'sensors/#': 10}
+        mqtt = self.flask_mqtt.AsyncMqtt(self.app, loop=asyncio.get_running_loop())
+        await asyncio.sleep(0.01)
+        publish = mqtt.client.publish
+        publish.return_value = (self.flask_mqtt.MQTT_ERR_SUCCESS, 1)
+
+        mqtt.publish_many([('sensors/a', b'1'), ('sensors/a', b'2')])
+        self.assertEqual(1, publish.call_count)
+
+        await mqtt.disconnect()
+        self.assertEqual(('sensors/a', b'2', 0, False), publish.call_args[0])
+        self.assertEqual(1, mqtt.client.disconnect.call_count)
+        self.assertIsNone(mqtt._coalescer._thread)
+
+    async def test_publish_waits_for_acknowledgement(self):
+        self.mqtt.client.publish.return_value = (
+            self.flask_mqtt.MQTT_ERR_SUCCESS, 7)
+        task = asyncio.ensure_future(self.mqtt.publish('home/topic', 'on', qos=1))
+        await asyncio.sleep(0)
+        self.assertFalse(task.done())
+
+        self.mqtt._handle_publish(self.mqtt.client, None, 7)
+        self.assertEqual(7, await task)
+        self.assertEqual({}, self.mqtt._pending_acks)
+
+    async def test_publish_timeout(self):
+        self.mqtt.client.publish.return_value = (
+            self.flask_mqtt.MQTT_ERR_SUCCESS, 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.mqtt.publish('home/topic', 'on', qos=1, timeout=0.01)
+        self.assertEqual({}, self.mqtt._pending_acks)
+
+    async def test_subscribe_waits_for_suback(self):
+        self.mqtt.client.subscribe.return_value = (
+            self.flask_mqtt.MQTT_ERR_SUCCESS, 3)
+        task = asyncio.ensure_future(self.mqtt.subscribe('home/topic', qos=1))
+        await asyncio.sleep(0)
+        self.mqtt._handle_subscribe(self.mqtt.client, None, 3, (1,))
+        self.assertEqual((1,), await task)
+        self.assertIn('home/topic', self.mqtt.topics)
+
+    async def test_counted_subscription_does_not_wait(self):
+        self.mqtt.client.subscribe.return_value = (
+            self.flask_mqtt.MQTT_ERR_SUCCESS, 3)
+        self.mqtt.client.unsubscribe.return_value = (
+            self.flask_mqtt.MQTT_ERR_SUCCESS, 4)
+        task = asyncio.ensure_future(self.mqtt.subscribe('home/topic', qos=1))
+        await asyncio.sleep(0)
+        self.mqtt._handle_subscribe(self.mqtt.client, None, 3, (1,))
+        await task
+
+        self.assertEqual((1,), await self.mqtt.subscribe(('home/topic', 0), timeout=1))
+        self.assertEqual(0, await self.mqtt.unsubscribe('home/topic', timeout=1))
+        self.assertIn('home/topic', self.mqtt.topics)
+
+    async def test_disconnect_fails_pending_subscribe(self):
+        self.mqtt.client.subscribe.return_value = (
+            self.flask_mqtt.MQTT_ERR_SUCCESS, 3)
+        task = asyncio.ensure_future(self.mqtt.subscribe('home/topic'))
+        await asyncio.sleep(0)
+        self.mqtt._handle_disconnect(self.mqtt.client, None, 1)
+        with self.assertRaises(ConnectionError):
+            await task
+
+    async def test_async_topic_handler(self):
+        received = asyncio.Event()
+
+        @self.mqtt.on_topic('home/topic')
+        async def handle_topic(client, userdata, message):
+            received.set()
+
+        self.mqtt._handle_message(
+            self.mqtt.client, None, MagicMock(topic='home/topic'))
+        await asyncio.wait_for(received.wait(), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -70,8 +70,14 @@ class FlaskMQTTTestCase(unittest.TestCase):
         self.assertEqual(1, len(self.mqtt.topics))
         self.assertEqual(('test', 2), self.mqtt.topics['test'])
 
-        # unsubscribe
-        self.mqtt.unsubscribe('test')
+        # a lower qos keeps the higher one
+        self.mqtt.subscribe('test', 0)
+        self.assertEqual(('test', 2), self.mqtt.topics['test'])
+
+        # unsubscribe once for every subscribe
+        for _ in range(3):
+            self.assertEqual(1, len(self.mqtt.topics))
+            self.mqtt.unsubscribe('test')
         self.assertEqual(0, len(self.mqtt.topics))
 
     def test_topic_count(self):
@@ -82,6 +88,11 @@ class FlaskMQTTTestCase(unittest.TestCase):
 
         ret, mid = self.mqtt.subscribe('test')
         self.assertEqual(1, len(self.mqtt.topics))
+        self.assertEqual(0, mid)
+
+        # the topic has another subscriber
+        self.mqtt.unsubscribe('test')
+        self.assertEqual(1, len(self.mqtt.topics))
 
         self.mqtt.unsubscribe('test')
         self.assertEqual(0, len(self.mqtt.topics))
@@ -0,0 +1,304 @@
+import json
+import sys
+import unittest
+
+from flask import Flask
+
+from flask_mqtt import loopback
+from flask_mqtt.loopback import LoopbackBroker, LoopbackClient
+
+
+class Recorder:
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, name):
+        def callback(client, userdata, *args):
+            self.calls.append((name,) + args)
+        return callback
+
+    def messages(self):
+        return [
+            (args[0].topic, args[0].payload, args[0].qos, args[0].retain)
+            for args in (call[1:] for call in self.calls if call[0] == 'message')
+        ]
+
+
+def connected_client(broker, client_id=''):
+    client = LoopbackClient(client_id, broker=broker)
+    recorder = Recorder()
+    for name in ('connect', 'disconnect', 'message', 'publish', 'subscribe', 'unsubscribe'):
+        setattr(client, 'on_' + name, recorder(name))
+    client.connect()
+    return client, recorder
+
+
+class LoopbackClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LoopbackBroker()
+
+    def test_connect(self):
+        client, recorder = connected_client(self.broker)
+        self.assertEqual([('connect', {'session present': 0}, 0)], recorder.calls)
+        self.assertTrue(client.is_connected())
+        self.assertEqual(1, len(self.broker))
+        self.assertEqual(0, client.disconnect())
+        self.assertEqual(('disconnect', 0), recorder.calls[-1])
+        self.assertEqual(0, len(self.broker))
+
+    def test_wildcards(self):
+        publisher, _ = connected_client(self.broker)
+        subscriber, recorder = connected_client(self.broker)
+        subscriber.subscribe([('home/+/temperature', 1), ('home/#', 0), ('+/x', 0)])
+        publisher.publish('home/kitchen/temperature', 21, qos=1)
+        publisher.publish('home', 'on')
+        publisher.publish('office/light', 'off')
+        publisher.publish('$SYS/x', 'system')
+        # delivered once, with the highest granted QoS
+        self.assertEqual([
+            ('home/kitchen/temperature', b'21', 1, False),
+            ('home', b'on', 0, False),
+        ], recorder.messages())
+
+    def test_publish_acknowledged_before_return(self):
+        client, recorder = connected_client(self.broker)
+        rc, mid = client.publish('home/a', b'1', qos=2)
+        self.assertEqual(0, rc)
+        self.assertEqual(('publish', mid), recorder.calls[-1])
+
+    def test_retained(self):
+        publisher, _ = connected_client(self.broker)
+        publisher.publish('home/a', b'1', retain=True)
+        publisher.publish('home/b', b'2', qos=1, retain=True)
+        self.assertEqual(b'1', self.broker.retained('home/a'))
+
+        subscriber, recorder = connected_client(self.broker)
+        subscriber.subscribe('home/+', qos=1)
+        # the SUBACK comes before the retained messages
+        self.assertEqual('subscribe', recorder.calls[1][0])
+        self.assertEqual([
+            ('home/a', b'1', 0, True),
+            ('home/b', b'2', 1, True),
+        ], recorder.messages())
+
+        # an empty payload clears the retained message
+        publisher.publish('home/a', b'', retain=True)
+        self.assertIsNone(self.broker.retained('home/a'))
+
+    def test_unsubscribe(self):
+        publisher, _ = connected_client(self.broker)
+        subscriber, recorder = connected_client(self.broker)
+        subscriber.subscribe('home/a')
+        subscriber.unsubscribe('home/a')
+        publisher.publish('home/a', b'1')
+        self.assertEqual([], recorder.messages())
+        self.assertEqual('unsubscribe', recorder.calls[-1][0])
+
+    def test_shared_subscription(self):
+        publisher, _ = connected_client(self.broker)
+        first, first_recorder = connected_client(self.broker)
+        second, second_recorder = connected_client(self.broker)
+        first.subscribe('$share/group/jobs')
+        second.subscribe('$share/group/jobs')
+        for i in range(4):
+            publisher.publish('jobs', i)
+        self.assertEqual([b'0', b'2'], [m[1] for m in first_recorder.messages()])
+        self.assertEqual([b'1', b'3'], [m[1] for m in second_recorder.messages()])
+
+    def test_nested_publish(self):
+        client, _ = connected_client(self.broker)
+        client.subscribe('#')
+        topics = []
+
+        def handle_message(client, userdata, message):
+            topics.append(message.topic)
+            if message.topic == 'ping':
+                client.publish('pong')
+            topics.append('end of ' + message.topic)
+
+        client.on_message = handle_message
+        client.publish('ping')
+        # delivered before publish() returns, depth first
+        self.assertEqual(['ping', 'pong', 'end of pong', 'end of ping'], topics)
+
+    def test_publish_while_disconnected(self):
+        client = LoopbackClient(broker=self.broker)
+        self.assertEqual(4, client.publish('home/a', b'0').rc)
+        rc, mid = client.publish('home/a', b'1', qos=1, retain=True)
+        self.assertEqual(4, rc)
+        self.assertIsNone(self.broker.retained('home/a'))
+        # QoS > 0 messages are sent on connect
+        client.connect()
+        self.assertEqual(b'1', self.broker.retained('home/a'))
+        self.assertEqual((4, None), LoopbackClient(broker=self.broker).subscribe('home/a'))
+
+    def test_drop_connections(self):
+        client, recorder = connected_client(self.broker)
+        client.will_set('status', b'offline', retain=True)
+        client.loop_start()
+        client.subscribe('home/a')
+        self.broker.drop_connections()
+        self.assertEqual(('disconnect', 7), recorder.calls[-2])
+        self.assertEqual('connect', recorder.calls[-1][0])
+        self.assertEqual(b'offline', self.broker.retained('status'))
+        # the session is not persistent
+        self.broker.publish('home/a', b'1')
+        self.assertEqual([], recorder.messages())
+
+    def test_invalid_arguments(self):
+        client, _ = connected_client(self.broker)
+        self.assertRaises(ValueError, client.publish, 'home/#', b'1')
+        self.assertRaises(ValueError, client.publish, 'home/a', b'1', 3)
+        self.assertRaises(TypeError, client.publish, 'home/a', object())
+
+    def test_get_broker(self):
+        loopback.reset()
+        broker = loopback.get_broker('localhost', 1883)
+        self.assertIs(broker, loopback.get_broker('localhost', 1883))
+        self.assertIsNot(broker, loopback.get_broker('localhost', 1884))
+        loopback.reset()
+        self.assertIsNot(broker, loopback.get_broker('localhost', 1883))
+
+
+class MqttLoopbackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # use the real paho client, other tests replace it by a mock
+        sys.modules.pop('paho.mqtt.client', None)
+        sys.modules.pop('flask_mqtt', None)
+        import flask_mqtt
+        self.flask_mqtt = flask_mqtt
+        loopback.reset()
+
+    def mqtt(self, name, **config):
+        app = Flask(name)
+        app.config.update(MQTT_TRANSPORT='loopback', MQTT_CLIENT_ID=name, **config)
+        mqtt = self.flask_mqtt.Mqtt(app)
+        self.addCleanup(mqtt._disconnect)
+        return mqtt
+
+    def test_publish_and_subscribe(self):
+        publisher = self.mqtt('publisher')
+        subscriber = self.mqtt('subscriber')
+        self.assertIsInstance(publisher.client, LoopbackClient)
+        self.assertTrue(publisher.connected)
+        received = []
+
+        @subscriber.on_topic('home/+/temperature')
+        def handle_temperature(client, userdata, message):
+            received.append((message.topic, message.payload))
+
+        publisher.publish('home/kitchen/temperature', '20', retain=True)
+        subscriber.subscribe('home/+/temperature')
+        future = publisher.publish('home/office/temperature', '21', qos=1, track=True)
+        self.assertTrue(future.done())
+        self.assertEqual([
+            ('home/kitchen/temperature', b'20'),
+            ('home/office/temperature', b'21'),
+        ], received)
+
+    def test_request(self):
+        requester = self.mqtt('requester', MQTT_PROTOCOL_VERSION=self.flask_mqtt.MQTTv5)
+        responder = self.mqtt('responder', MQTT_PROTOCOL_VERSION=self.flask_mqtt.MQTTv5)
+
+        @responder.on_topic('rpc/echo')
+        def handle_echo(client, userdata, message):
+            responder.respond(message, message.payload)
+
+        responder.subscribe('rpc/echo')
+        self.assertEqual(b'hello', requester.request('rpc/echo', b'hello', timeout=1).payload)
+
+    def test_request_envelope_with_codecs(self):
+        requester = self.mqtt('requester')
+        responder = self.mqtt('responder')
+        # e.g. a logger of another application
+        other = self.mqtt('other')
+        for mqtt in (requester, responder):
+            mqtt.register_codec('rpc/#', 'json')
+            mqtt.register_codec('responses/#', 'json')
+        requests = []
+        seen = []
+
+        @responder.on_topic('rpc/sum')
+        def handle_sum(client, userdata, message):
+            requests.append(message.payload)
+            responder.respond(message, {'sum': sum(message.payload['payload'])})
+
+        responder.subscribe('rpc/sum')
+        other.on_message()(lambda client, userdata, message: seen.append(message.payload))
+        other.subscribe('#')
+
+        response = requester.request('rpc/sum', [1, 2, 3], timeout=1)
+        self.assertEqual({'sum': 6}, response.payload)
+        # the envelope is encoded once, as a JSON object
+        self.assertIsInstance(requests[0], dict)
+        self.assertEqual([1, 2, 3], requests[0]['payload'])
+        self.assertCountEqual([[1, 2, 3], {'sum': 6}], [json.loads(p)['payload'] for p in seen])
+
+    def test_compressed_messages_keep_their_topic(self):
+        publisher = self.mqtt(
+            'publisher', MQTT_PROTOCOL_VERSION=self.flask_mqtt.MQTTv5,
+            MQTT_COMPRESSION='zlib', MQTT_COMPRESSION_THRESHOLD=10)
+        # a subscriber without compression, e.g. of another application
+        plain = self.mqtt('plain', MQTT_PROTOCOL_VERSION=self.flask_mqtt.MQTTv5)
+        received = []
+        plain.on_topic('sensors/+')(
+            lambda client, userdata, message: received.append((message.topic, message.payload)))
+        plain.subscribe('sensors/+')
+
+        publisher.publish('sensors/kitchen', 'x' * 100, retain=True)
+        publisher.publish('sensors/kitchen', '21.5', retain=True)
+        # marked messages are decompressed without MQTT_COMPRESSION
+        self.assertEqual(
+            [('sensors/kitchen', b'x' * 100), ('sensors/kitchen', b'21.5')], received)
+
+        # the newest retained value replaces the compressed one
+        subscriber = self.mqtt(
+            'subscriber', MQTT_PROTOCOL_VERSION=self.flask_mqtt.MQTTv5,
+            MQTT_COMPRESSION='zlib')
+        retained = []
+        subscriber.on_topic('sensors/+')(
+            lambda client, userdata, message: retained.append(message.payload))
+        subscriber.subscribe('sensors/+')
+        self.assertEqual([b'21.5'], retained)
+
+        publisher.publish('sensors/kitchen', 'x' * 100)
+        self.assertEqual([b'21.5', b'x' * 100], retained)
+
+    def test_resubscribe_after_connection_loss(self):
+        mqtt = self.mqtt('client')
+        received = []
+        mqtt.on_topic('home/a')(lambda client, userdata, message: received.append(message))
+        mqtt.subscribe('home/a')
+        broker = loopback.get_broker('localhost', 1883)
+        broker.drop_connections()
+        self.assertTrue(mqtt.connected)
+        broker.publish('home/a', b'1')
+        self.assertEqual(1, len(received))
+
+    def test_after_fork(self):
+        mqtt = self.mqtt('client')
+        received = []
+        mqtt.on_topic('home/a')(lambda client, userdata, message: received.append(message))
+        mqtt.subscribe('home/a')
+        client = mqtt.client
+        # a forked child has brokers of its own
+        loopback.reset()
+        mqtt._after_fork()
+        self.assertFalse(mqtt.connected)
+
+        mqtt.publish('home/a', b'1')
+        self.assertTrue(mqtt.wait_for_connection(1))
+        self.assertIsNot(client, mqtt.client)
+        self.assertEqual([b'1'], [m.payload for m in received])
+
+    def test_async_mqtt_not_supported(self):
+        app = Flask(__name__)
+        app.config['MQTT_TRANSPORT'] = 'loopback'
+        self.assertRaises(ValueError, self.flask_mqtt.AsyncMqtt, app)
+
+
+if __name__ == '__main__':
+    unittest.main()
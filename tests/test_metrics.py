@@ -0,0 +1,49 @@
+import unittest
+
+from flask_mqtt.metrics import OTHER, Counter, Histogram, Metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_counter(self):
+        counter = Counter('mqtt_messages_total', 'Messages.', 'topic')
+        counter.inc('home/a')
+        counter.inc('home/a')
+        counter.inc('home/b', 3)
+        self.assertEqual(2, counter.value('home/a'))
+        self.assertEqual(5, counter.total())
+        self.assertIn('mqtt_messages_total{topic="home/b"} 3', counter.render())
+
+    def test_counter_limits_label_values(self):
+        counter = Counter('mqtt_messages_total', 'Messages.', 'topic', max_labels=2)
+        for topic in ('a', 'b', 'c', 'd', 'a'):
+            counter.inc(topic)
+        self.assertEqual(2, counter.value('a'))
+        self.assertEqual(2, counter.value(OTHER))
+
+    def test_histogram(self):
+        histogram = Histogram('mqtt_seconds', 'Seconds.', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(4, histogram.count())
+        self.assertAlmostEqual(6.05, histogram.sum())
+
+        lines = histogram.render()
+        self.assertIn('mqtt_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('mqtt_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('mqtt_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('mqtt_seconds_count 4', lines)
+
+    def test_render_prometheus_text(self):
+        metrics = Metrics(prefix='mqtt2')
+        metrics.add_gauge('connected', 'Connected.', lambda: 1)
+        metrics.connects.inc()
+
+        text = metrics.render()
+        self.assertIn('# TYPE mqtt2_connects_total counter\nmqtt2_connects_total 1\n', text)
+        self.assertIn('# TYPE mqtt2_connected gauge\nmqtt2_connected 1\n', text)
+        self.assertTrue(text.endswith('\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
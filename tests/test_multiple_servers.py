@@ -151,7 +151,9 @@ class FlaskMQTTTestCase(unittest.TestCase):
         self.assertEqual(1, len(self.mqtt.topics))
         self.assertEqual(('mqtt/test', 2), self.mqtt.topics['mqtt/test'])
 
-        # unsubscribe
+        # unsubscribe once for every subscribe
+        self.mqtt.unsubscribe('mqtt/test')
+        self.assertEqual(1, len(self.mqtt.topics))
         self.mqtt.unsubscribe('mqtt/test')
         self.assertEqual(0, len(self.mqtt.topics))
         
@@ -166,7 +168,9 @@ class FlaskMQTTTestCase(unittest.TestCase):
         self.assertEqual(1, len(self.mqtt2.topics))
         self.assertEqual(('mqtt2/test', 2), self.mqtt2.topics['mqtt2/test'])
 
-        # unsubscribe
+        # unsubscribe once for every subscribe
+        self.mqtt2.unsubscribe('mqtt2/test')
+        self.assertEqual(1, len(self.mqtt2.topics))
         self.mqtt2.unsubscribe('mqtt2/test')
         self.assertEqual(0, len(self.mqtt2.topics))
         
@@ -181,7 +185,9 @@ class FlaskMQTTTestCase(unittest.TestCase):
         self.assertEqual(1, len(self.mqtt3.topics))
         self.assertEqual(('mqtt3/test', 2), self.mqtt3.topics['mqtt3/test'])
 
-        # unsubscribe
+        # unsubscribe once for every subscribe
+        self.mqtt3.unsubscribe('mqtt3/test')
+        self.assertEqual(1, len(self.mqtt3.topics))
         self.mqtt3.unsubscribe('mqtt3/test')
         self.assertEqual(0, len(self.mqtt3.topics))
         
@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+from flask_mqtt.outbound import (
+    OutboundMessage,
+    OutboundQueue,
+    OutboundQueueFull,
+    payload_size,
+)
+
+
+class OutboundQueueTestCase(unittest.TestCase):
+
+    def test_payload_size(self):
+        self.assertEqual(0, payload_size(None))
+        self.assertEqual(3, payload_size(b'abc'))
+        self.assertEqual(2, payload_size('ä'))
+        self.assertEqual(4, payload_size(1.25))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(max_messages=1, policy='ignore')
+
+    def test_drop_newest(self):
+        queue = OutboundQueue(max_messages=2, policy='drop-newest')
+        self.assertEqual((True, []), queue.acquire(1))
+        self.assertEqual((True, []), queue.acquire(1))
+        self.assertEqual((False, []), queue.acquire(1))
+        queue.release(1)
+        self.assertEqual((True, []), queue.acquire(1))
+
+    def test_max_bytes(self):
+        queue = OutboundQueue(max_bytes=10, policy='drop-newest')
+        self.assertTrue(queue.acquire(8)[0])
+        self.assertFalse(queue.acquire(3)[0])
+        self.assertTrue(queue.acquire(2)[0])
+        self.assertEqual(10, queue.bytes)
+
+    def test_oversized_message_fits_empty_queue(self):
+        queue = OutboundQueue(max_bytes=10, policy='drop-newest')
+        self.assertTrue(queue.acquire(100)[0])
+        self.assertFalse(queue.acquire(1)[0])
+
+    def test_raise(self):
+        queue = OutboundQueue(max_messages=1, policy='raise')
+        queue.acquire(1)
+        with self.assertRaises(OutboundQueueFull):
+            queue.acquire(1)
+
+    def test_drop_oldest_drops_held_messages(self):
+        queue = OutboundQueue(max_messages=2, policy='drop-oldest')
+        for topic in ('a', 'b'):
+            queue.acquire(1)
+            message = OutboundMessage(topic, b'x', 1, False, 1, None)
+            self.assertTrue(queue.hold(message, lambda: True))
+
+        admitted, dropped = queue.acquire(1)
+
+        self.assertTrue(admitted)
+        self.assertEqual(['a'], [item.topic for item in dropped])
+        self.assertEqual(['b'], [item.topic for item in queue.take_held()])
+        self.assertEqual(2, queue.messages)
+
+    def test_hold_condition(self):
+        queue = OutboundQueue(max_messages=2)
+        queue.acquire(1)
+        message = OutboundMessage('a', b'x', 1, False, 1, None)
+        self.assertFalse(queue.hold(message, lambda: False))
+        self.assertEqual(0, queue.stats().held)
+
+    def test_block_waits_for_release(self):
+        queue = OutboundQueue(max_messages=1)
+        queue.acquire(1)
+        timer = threading.Timer(0.05, queue.release, (1,))
+        timer.start()
+        self.assertEqual((True, []), queue.acquire(1))
+        timer.join()
+
+    def test_block_timeout(self):
+        queue = OutboundQueue(max_messages=1, timeout=0.01)
+        queue.acquire(1)
+        self.assertEqual((False, []), queue.acquire(1))
+
+    def test_block_without_blocking(self):
+        queue = OutboundQueue(max_messages=1)
+        queue.acquire(1)
+        self.assertEqual((False, []), queue.acquire(1, block=False))
+
+    def test_water_marks(self):
+        queue = OutboundQueue(max_messages=4, high_water=0.75, low_water=0.25)
+        events = []
+        queue.on_high_water = lambda stats: events.append(('high', stats.messages))
+        queue.on_low_water = lambda stats: events.append(('low', stats.messages))
+
+        for _ in range(4):
+            queue.acquire(1)
+        for _ in range(4):
+            queue.release(1)
+
+        self.assertEqual([('high', 3), ('low', 1)], events)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+from flask_mqtt.router import TopicRouter, filter_covers, strip_share, topic_matches
+
+
+class TopicRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = TopicRouter()
+
+    def test_exact_match(self):
+        self.router.add('home/kitchen/light', 'light')
+        self.assertEqual(('light',), self.router.match('home/kitchen/light'))
+        self.assertEqual((), self.router.match('home/kitchen'))
+        self.assertEqual((), self.router.match('home/kitchen/light/state'))
+
+    def test_single_level_wildcard(self):
+        self.router.add('home/+/light', 'light')
+        self.assertEqual(('light',), self.router.match('home/kitchen/light'))
+        self.assertEqual(('light',), self.router.match('home//light'))
+        self.assertEqual((), self.router.match('home/kitchen/floor/light'))
+
+    def test_multi_level_wildcard(self):
+        self.router.add('home/#', 'home')
+        self.router.add('#', 'all')
+        self.assertEqual(('home', 'all'), self.router.match('home'))
+        self.assertEqual(('home', 'all'), self.router.match('home/a/b/c'))
+        self.assertEqual(('all',), self.router.match('garden'))
+
+    def test_wildcards_do_not_match_system_topics(self):
+        self.router.add('#', 'all')
+        self.router.add('+/broker/uptime', 'uptime')
+        self.router.add('$SYS/#', 'sys')
+        self.assertEqual(('sys',), self.router.match('$SYS/broker/uptime'))
+
+    def test_match_in_registration_order(self):
+        self.router.add('a/#', 1)
+        self.router.add('a/b', 2)
+        self.router.add('a/+', 3)
+        self.assertEqual((1, 2, 3), self.router.match('a/b'))
+
+    def test_add_replaces_value(self):
+        self.router.add('a/b', 1)
+        self.assertEqual((1,), self.router.match('a/b'))
+        self.router.add('a/b', 2)
+        self.assertEqual((2,), self.router.match('a/b'))
+        self.assertEqual(1, len(self.router))
+
+    def test_remove_invalidates_cache(self):
+        self.router.add('a/+', 1)
+        self.router.add('a/+/c', 2)
+        self.assertEqual((1,), self.router.match('a/b'))
+        self.assertEqual(1, self.router.remove('a/+'))
+        self.assertEqual((), self.router.match('a/b'))
+        self.assertEqual((2,), self.router.match('a/b/c'))
+        self.assertIsNone(self.router.remove('a/+'))
+        self.assertEqual([('a/+/c', 2)], list(self.router.items()))
+
+    def test_cache_is_bounded(self):
+        router = TopicRouter(cache_size=10)
+        router.add('#', 1)
+        for i in range(100):
+            router.match('topic/{0}'.format(i))
+        self.assertLessEqual(len(router._cache), 10)
+
+    def test_many_filters(self):
+        for i in range(2000):
+            self.router.add('devices/{0}/state'.format(i), i)
+        self.assertEqual((1234,), self.router.match('devices/1234/state'))
+
+    def test_strip_share(self):
+        self.assertEqual('home/+/temp', strip_share('$share/workers/home/+/temp'))
+        self.assertEqual('#', strip_share('$share/workers/#'))
+        self.assertEqual('home/temp', strip_share('home/temp'))
+        self.assertEqual('$SYS/broker', strip_share('$SYS/broker'))
+
+    def test_topic_matches(self):
+        self.assertTrue(topic_matches('a/+/c', 'a/b/c'))
+        self.assertTrue(topic_matches('a/#', 'a'))
+        self.assertTrue(topic_matches('a/#', 'a/b/c'))
+        self.assertTrue(topic_matches('a/b', 'a/b'))
+        self.assertFalse(topic_matches('a/+', 'a'))
+        self.assertFalse(topic_matches('a/+', 'a/b/c'))
+        self.assertFalse(topic_matches('a/b/c', 'a/b'))
+        self.assertFalse(topic_matches('#', '$SYS/load'))
+        self.assertTrue(topic_matches('$SYS/#', '$SYS/load'))
+
+    def test_filter_covers(self):
+        self.assertTrue(filter_covers('a/#', 'a/+/c'))
+        self.assertTrue(filter_covers('a/#', 'a/#'))
+        self.assertTrue(filter_covers('a/+', 'a/b'))
+        self.assertTrue(filter_covers('a/+', 'a/+'))
+        self.assertTrue(filter_covers('#', 'a/#'))
+        self.assertFalse(filter_covers('a/+', 'a/#'))
+        self.assertFalse(filter_covers('a/b', 'a/+'))
+        self.assertFalse(filter_covers('a/+/c', 'a/b'))
+        self.assertFalse(filter_covers('a/b/#', '+/b'))
+        self.assertFalse(filter_covers('#', '$SYS/#'))
+
+
+if __name__ == '__main__':
+    unittest.main()
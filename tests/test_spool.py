@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask_mqtt.spool import Spool, to_bytes
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_to_bytes(self):
+        self.assertEqual(b'', to_bytes(None))
+        self.assertEqual(b'abc', to_bytes(bytearray(b'abc')))
+        self.assertEqual(b'\xc3\xa4', to_bytes('ä'))
+        self.assertEqual(b'1.5', to_bytes(1.5))
+        with self.assertRaises(TypeError):
+            to_bytes(object())
+
+    def test_read_in_order(self):
+        spool = Spool(self.path, batch_size=2)
+        ids = [spool.append('home/{0}'.format(i), 'x', 1) for i in range(5)]
+
+        first = spool.read()
+        second = spool.read(first[-1].id)
+
+        self.assertEqual(ids[:2], [m.id for m in first])
+        self.assertEqual(['home/2', 'home/3'], [m.topic for m in second])
+        self.assertEqual(b'x', first[0].payload)
+        self.assertEqual(1, first[0].qos)
+        self.assertFalse(first[0].retain)
+        self.assertIsNone(first[0].properties)
+        self.assertEqual(5, len(spool))
+
+    def test_delete(self):
+        spool = Spool(self.path)
+        ids = [spool.append('home/topic', str(i), 1) for i in range(3)]
+        spool.delete(ids[:2])
+        spool.delete([])
+        self.assertEqual([b'2'], [m.payload for m in spool.read()])
+
+    def test_survives_reopen(self):
+        spool = Spool(self.path)
+        spool.append('home/topic', b'on', 2, True, b'\x02\x01\x01')
+        spool.close()
+
+        spool = Spool(self.path)
+        message = spool.read()[0]
+        self.assertEqual(
+            ('home/topic', b'on', 2, True, b'\x02\x01\x01'), message[1:])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork()')
+    def test_adopt_orphans(self):
+        pid = os.fork()
+        if pid == 0:
+            # a worker spooling a message before it exits
+            try:
+                Spool('{0}.{1}'.format(self.path, os.getpid())).append('home/a', 'x', 1)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        # the spool of a running process is not adopted
+        running = '{0}.{1}'.format(self.path, os.getpid())
+        Spool(running).append('home/b', 'y', 1)
+
+        spool = Spool(self.path)
+        spool.append('home/c', 'z', 1)
+        self.assertEqual(1, spool.adopt_orphans(self.path))
+        self.assertEqual(['home/c', 'home/a'], [m.topic for m in spool.read()])
+        self.assertFalse(os.path.exists('{0}.{1}'.format(self.path, pid)))
+        self.assertTrue(os.path.exists(running))
+        self.assertEqual(0, spool.adopt_orphans(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import sys
+import threading
+import unittest
+
+from flask import Flask
+
+from flask_mqtt import loopback
+from flask_mqtt.stream import Listener, StreamHub, format_event, server_sent_events
+
+
+class Message:
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class ListenerTestCase(unittest.TestCase):
+
+    def test_get(self):
+        listener = Listener('home/#')
+        message = Message('home/a', b'1')
+        listener.put(message)
+        self.assertIs(message, listener.get(0))
+        self.assertIsNone(listener.get(0.01))
+
+    def test_slow_listener_drops_oldest(self):
+        listener = Listener('home/#', queue_size=2)
+        for i in range(5):
+            listener.put(i)
+        self.assertEqual(3, listener.dropped)
+        self.assertEqual([3, 4], [listener.get(0), listener.get(0)])
+
+    def test_close_wakes_up_reader(self):
+        listener = Listener('home/#')
+        closed = []
+        listener.on_close = closed.append
+        thread = threading.Thread(target=lambda: self.assertEqual([], list(listener)))
+        thread.start()
+        listener.close()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([listener], closed)
+        # messages are ignored after close
+        listener.put(1)
+        self.assertEqual(0, len(listener))
+
+
+class StreamHubTestCase(unittest.TestCase):
+
+    def test_fan_out(self):
+        hub = StreamHub()
+        first, second, other = Listener('home/#'), Listener('home/#'), Listener('office/+')
+        self.assertTrue(hub.add(first))
+        self.assertFalse(hub.add(second))
+        self.assertTrue(hub.add(other))
+        hub.publish('home/a', 'message')
+        self.assertEqual(['message', 'message', None], [x.get(0) for x in (first, second, other)])
+        self.assertEqual((2, 3, 0), hub.stats())
+
+        self.assertFalse(hub.remove(first))
+        self.assertTrue(hub.remove(second))
+        self.assertFalse(hub.remove(second))
+        hub.publish('home/a', 'message')
+        self.assertEqual(1, len(hub))
+
+    def test_close(self):
+        hub = StreamHub()
+        listeners = [Listener('home/#'), Listener('office/+')]
+        for listener in listeners:
+            listener.on_close = hub.remove
+            hub.add(listener)
+        hub.close()
+        self.assertTrue(all(x.closed for x in listeners))
+        self.assertEqual(0, len(hub))
+
+
+class ServerSentEventsTestCase(unittest.TestCase):
+
+    def test_events(self):
+        listener = Listener('home/#')
+        events = server_sent_events(listener, keepalive=0.01)
+        self.assertEqual(': connected\n\n', next(events))
+        self.assertEqual(': keepalive\n\n', next(events))
+        listener.put(Message('home/a', b'21.5'))
+        self.assertEqual(
+            'data: {"topic": "home/a", "payload": "21.5"}\n\n', next(events))
+        events.close()
+        self.assertTrue(listener.closed)
+
+    def test_multi_line_data(self):
+        listener = Listener('home/#')
+        listener.put(Message('home/a', b'1\n2'))
+        events = server_sent_events(
+            listener, formatter=lambda message: message.payload.decode())
+        next(events)
+        self.assertEqual('data: 1\ndata: 2\n\n', next(events))
+
+    def test_format_event(self):
+        self.assertEqual(
+            '{"topic": "home/a", "payload": "\\ufffd"}', format_event(Message('home/a', b'\xff')))
+
+
+class MqttStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # use the real paho client, other tests replace it by a mock
+        sys.modules.pop('paho.mqtt.client', None)
+        sys.modules.pop('flask_mqtt', None)
+        import flask_mqtt
+        loopback.reset()
+        self.app = Flask(__name__)
+        self.app.config.update(MQTT_TRANSPORT='loopback', MQTT_STREAM_QUEUE_SIZE=10)
+        self.mqtt = flask_mqtt.Mqtt(self.app)
+        self.addCleanup(self.mqtt._disconnect)
+
+    def test_one_subscription_per_filter(self):
+        mqtt = self.mqtt
+        broker = loopback.get_broker('localhost', 1883)
+        first = mqtt.listen('home/#')
+        second = mqtt.listen('home/#', queue_size=1)
+        self.assertEqual(['home/#'], list(mqtt.topics))
+        broker.publish('home/a', b'1')
+        broker.publish('home/a', b'2')
+        self.assertEqual([b'1', b'2'], [first.get(0).payload, first.get(0).payload])
+        self.assertEqual(b'2', second.get(0).payload)
+        self.assertEqual((1, 2, 1), mqtt.stream_stats())
+
+        first.close()
+        self.assertEqual(['home/#'], list(mqtt.topics))
+        second.close()
+        self.assertEqual({}, mqtt.topics)
+        broker.publish('home/a', b'3')
+        self.assertEqual((0, 0, 1), mqtt.stream_stats())
+
+    def test_filter_subscribed_by_the_application(self):
+        mqtt = self.mqtt
+        mqtt.subscribe('home/#')
+        with mqtt.listen('home/#') as listener:
+            loopback.get_broker('localhost', 1883).publish('home/a', b'1')
+            self.assertEqual(b'1', listener.get(0).payload)
+        self.assertEqual(['home/#'], list(mqtt.topics))
+
+    def test_application_subscribes_after_listener(self):
+        mqtt = self.mqtt
+        listener = mqtt.listen('home/#')
+        mqtt.subscribe('home/#')
+        listener.close()
+        self.assertEqual(['home/#'], list(mqtt.topics))
+        mqtt.unsubscribe('home/#')
+        self.assertEqual({}, mqtt.topics)
+
+    def test_streamed_messages_skip_handlers(self):
+        mqtt = self.mqtt
+        broker = loopback.get_broker('localhost', 1883)
+        handled = []
+        mqtt.on_message()(lambda client, userdata, message: handled.append(message.topic))
+        listener = mqtt.listen('home/#')
+        broker.publish('home/a', b'1')
+        self.assertEqual(b'1', listener.get(0).payload)
+        self.assertEqual([], handled)
+
+        mqtt.subscribe('home/b')
+        broker.publish('home/b', b'2')
+        self.assertEqual(b'2', listener.get(0).payload)
+        self.assertEqual(['home/b'], handled)
+        listener.close()
+
+    def test_shared_group_with_listener(self):
+        workers = []
+        for name in ('a', 'b'):
+            app = Flask(name)
+            app.config.update(
+                MQTT_TRANSPORT='loopback', MQTT_CLIENT_ID=name, MQTT_SHARED_GROUP='g')
+            worker = type(self.mqtt)(app)
+            self.addCleanup(worker._disconnect)
+            worker.handled = []
+            worker.on_topic('sensors/#')(
+                lambda client, userdata, message, worker=worker: worker.handled.append(message))
+            worker.subscribe('sensors/#')
+            workers.append(worker)
+        a, b = workers
+        listener = a.listen('sensors/temp/+')
+        # the shared subscription covers the filter
+        self.assertEqual(['$share/g/sensors/#'], list(a.topics))
+
+        broker = loopback.get_broker('localhost', 1883)
+        for i in range(10):
+            broker.publish('sensors/temp/{0}'.format(i), b'1')
+        self.assertEqual((5, 5), (len(a.handled), len(b.handled)))
+        self.assertEqual(5, len(listener))
+        listener.close()
+        self.assertEqual(['$share/g/sensors/#'], list(a.topics))
+
+    def test_listener_before_shared_subscription(self):
+        self.mqtt.shared_group = 'g'
+        mqtt = self.mqtt
+        listener = mqtt.listen('sensors/#')
+        self.assertEqual(['sensors/#'], list(mqtt.topics))
+        mqtt.subscribe('sensors/#')
+        self.assertEqual(['$share/g/sensors/#'], list(mqtt.topics))
+        mqtt.unsubscribe('sensors/#')
+        self.assertEqual(['sensors/#'], list(mqtt.topics))
+        loopback.get_broker('localhost', 1883).publish('sensors/a', b'1')
+        self.assertEqual(b'1', listener.get(0).payload)
+        listener.close()
+        self.assertEqual({}, mqtt.topics)
+
+    def test_stream(self):
+        mqtt = self.mqtt
+
+        @self.app.route('/events')
+        def events():
+            return mqtt.stream('home/#')
+
+        response = self.app.test_client().get('/events', buffered=False)
+        self.assertEqual('text/event-stream', response.mimetype)
+        chunks = iter(response.response)
+        self.assertEqual(b': connected\n\n', next(chunks))
+        mqtt.publish('home/a', '1')
+        self.assertEqual(b'data: {"topic": "home/a", "payload": "1"}\n\n', next(chunks))
+        response.close()
+        self.assertEqual({}, mqtt.topics)
+
+    def test_disconnect_ends_streams(self):
+        listener = self.mqtt.listen('home/#')
+        self.mqtt._disconnect()
+        self.assertTrue(listener.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()